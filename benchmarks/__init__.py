@@ -0,0 +1,32 @@
+"""
+Micro-benchmarks for the PayFort payment processor hot paths.
+
+The benchmarks run inside the same environment as the tests, where the openedx/ecommerce code is importable.
+"""
+import os
+from contextlib import contextmanager
+
+
+def setup_django():
+    """Set up Django so the ecommerce_payfort modules can be imported."""
+    import django  # pylint: disable=import-outside-toplevel
+
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "ecommerce.settings.payfort")
+    django.setup()
+
+
+@contextmanager
+def benchmark_database():
+    """Create the test database for the fixtures of the benchmarks, and destroy it afterwards."""
+    # pylint: disable=import-outside-toplevel
+    from django.test.runner import DiscoverRunner
+    from django.test.utils import setup_test_environment, teardown_test_environment
+
+    runner = DiscoverRunner(verbosity=0, interactive=False)
+    setup_test_environment()
+    old_config = runner.setup_databases()
+    try:
+        yield
+    finally:
+        runner.teardown_databases(old_config)
+        teardown_test_environment()
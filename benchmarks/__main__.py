@@ -0,0 +1,59 @@
+"""
+Run the benchmarks of the PayFort payment processor.
+
+Usage:
+
+    bash ./scripts/tox_install_ecommerce_run_pytest.sh python -m benchmarks --output bench_output.json
+    bash ./scripts/tox_install_ecommerce_run_pytest.sh python -m benchmarks --baseline baseline.json
+
+The command fails when a benchmark is slower than the baseline by more than --max-regression percent.
+"""
+import argparse
+import sys
+
+from benchmarks import benchmark_database, runner, setup_django
+
+DEFAULT_MAX_REGRESSION = 20
+
+
+def parse_args(args=None):
+    """Parse the command line arguments."""
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description=__doc__.strip().splitlines()[0])
+    parser.add_argument("names", nargs="*", help="Run only the benchmarks with these names")
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    parser.add_argument("--baseline", help="Compare the results with the JSON results in this file")
+    parser.add_argument(
+        "--max-regression", type=float, default=DEFAULT_MAX_REGRESSION,
+        help=f"Allowed slowdown compared to the baseline, in percent (default: {DEFAULT_MAX_REGRESSION})",
+    )
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    """Run the benchmarks and return the exit code."""
+    options = parse_args(args)
+    setup_django()
+
+    with benchmark_database():
+        import benchmarks.cases  # pylint: disable=import-outside-toplevel,unused-import
+        results = runner.run(options.names)
+
+    baseline = runner.load(options.baseline) if options.baseline else {}
+    for name, result in results.items():
+        line = f"{name:<55} min: {result['min_us']:10.2f}us  median: {result['median_us']:10.2f}us"
+        if name in baseline:
+            line += f"  baseline: {baseline[name]['min_us']:10.2f}us"
+        print(line)
+
+    if options.output:
+        runner.save(results, options.output)
+
+    regressions = runner.compare(results, baseline, options.max_regression)
+    for name, slowdown in regressions.items():
+        print(f"REGRESSION: {name} is {slowdown:.1f}% slower than the baseline", file=sys.stderr)
+
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
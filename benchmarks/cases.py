@@ -0,0 +1,269 @@
+"""
+Benchmarks of the checkout and callback hot paths.
+
+Django must be set up before importing this module.
+"""
+import subprocess
+import sys
+from decimal import Decimal
+from types import SimpleNamespace
+
+from django.test import RequestFactory
+from django.urls import reverse
+from ecommerce.courses.tests.factories import CourseFactory
+from ecommerce.tests.factories import UserFactory
+from oscar.apps.offer.applicator import Applicator
+from oscar.apps.partner import strategy
+from oscar.test import factories as oscar_factories
+from oscar.test.factories import create_product, create_stockrecord
+
+from benchmarks.runner import benchmark
+from ecommerce_payfort import offer_cache, routes, utils
+from ecommerce_payfort.async_client import AsyncPayFortAPIClient
+from ecommerce_payfort.client import PayFortAPIClient
+from ecommerce_payfort.processors import PayFort
+from ecommerce_payfort.tests.fake_gateway import FakePayFortGateway
+
+BASKET_SIZES = (1, 10, 100, 500)
+OFFER_COUNT = 50
+IMPORT_STATEMENTS = {
+    "ecommerce_payfort.core": "import ecommerce_payfort.core",
+    "ecommerce_payfort.client": "import ecommerce_payfort.client",
+    "ecommerce_payfort.utils": "import ecommerce_payfort.utils",
+    "django.setup,ecommerce_payfort.utils": "import django; django.setup(); import ecommerce_payfort.utils",
+}
+SHA_PHRASE = "secret@res"
+SHA_METHOD = "SHA-256"
+
+
+def get_response_data():
+    """Return a valid and signed response data."""
+    data = {
+        "merchant_reference": "1-2-3",
+        "command": "PURCHASE",
+        "merchant_identifier": "mid123",
+        "access_code": "123123123",
+        "amount": "2000",
+        "currency": utils.VALID_CURRENCY,
+        "language": "en",
+        "customer_email": "learner@example.com",
+        "customer_ip": "1.1.1.1",
+        "customer_name": "Ecommerce User",
+        "response_code": "14000",
+        "response_message": "Success",
+        "status": utils.SUCCESS_STATUS,
+        "eci": "ECOMMERCE",
+        "fort_id": "169996200000000001",
+        "payment_option": "VISA",
+        "card_number": "400555******0001",
+        "expiry_date": "2505",
+        "authorization_code": "123456",
+        "order_description": "1 X course-v1:Org+Course+2024",
+    }
+    data["signature"] = utils.get_signature(SHA_PHRASE, SHA_METHOD, data)
+    return data
+
+
+def create_basket(line_count):
+    """
+    Create a basket with the given number of lines, each one for a seat in a different course.
+
+    @param line_count: The number of lines
+    @return: The ID of the basket
+    """
+    basket = utils.Basket.objects.create(owner=UserFactory())
+    basket.strategy = strategy.Default()
+    partner = None
+    for index in range(line_count):
+        course = CourseFactory(id=f"course-v1:Org+Course{index}+2024", **({"partner": partner} if partner else {}))
+        partner = course.partner
+        product = create_product(title=f"Seat in course {index}", course=course)
+        create_stockrecord(
+            product, price_excl_tax=Decimal("20.00"), num_in_stock=1000, currency=utils.VALID_CURRENCY,
+        )
+        basket.add_product(product)
+
+    return basket.id
+
+
+def load_basket(basket_id):
+    """
+    Load the basket from the database the same way the checkout does.
+
+    @param basket_id: The ID of the basket
+    @return: The basket
+    """
+    basket = utils.Basket.objects.get(id=basket_id)
+    basket.strategy = strategy.Default()
+    return basket
+
+
+@benchmark("utils.get_signature", number=5000)
+def bench_get_signature():
+    """Sign the parameters of a payment request."""
+    data = get_response_data()
+    data.pop("signature")
+    return lambda: utils.get_signature(SHA_PHRASE, SHA_METHOD, data)
+
+
+@benchmark("utils.verify_signature", number=5000)
+def bench_verify_signature():
+    """Verify the signature of a callback."""
+    data = get_response_data()
+    return lambda: utils.verify_signature(SHA_PHRASE, SHA_METHOD, data)
+
+
+@benchmark("utils.verify_response_format", number=5000)
+def bench_verify_response_format():
+    """Verify and parse the format of a callback."""
+    data = get_response_data()
+    return lambda: utils.verify_response_format(data)
+
+
+@benchmark("utils.sanitize_text", number=5000)
+def bench_sanitize_text():
+    """Sanitize an order description with the generic sanitizer."""
+    text = " // ".join(f"1 X course-v1:Org+Course{index}+2024" for index in range(10))
+    return lambda: utils.sanitize_text(
+        text, utils.VALID_PATTERNS["order_description"], max_length=utils.MAX_ORDER_DESCRIPTION_LENGTH,
+    )
+
+
+@benchmark("utils.SANITIZERS.order_description", number=5000)
+def bench_order_description_sanitizer():
+    """Sanitize an order description with the field sanitizer."""
+    text = " // ".join(f"1 X course-v1:Org+Course{index}+2024" for index in range(10))
+    return lambda: utils.SANITIZERS["order_description"](text)
+
+
+@benchmark("django.urls.reverse[handle-internal-error]", number=5000)
+def bench_django_reverse_with_arg():
+    """Reverse the URL of the error page of a transaction with the URL resolver."""
+    return lambda: reverse("payfort:handle-internal-error", args=["ECOMMERCE-169996200000000001"])
+
+
+@benchmark("routes.reverse_with_arg[handle-internal-error]", number=5000)
+def bench_reverse_with_arg():
+    """Build the URL of the error page of a transaction from the cached prefix."""
+    return lambda: routes.reverse_with_arg("payfort:handle-internal-error", "ECOMMERCE-169996200000000001")
+
+
+def create_api_client(merchant_references, client_class=PayFortAPIClient, **kwargs):
+    """
+    Start a fake PayFort gateway knowing the given payments, and return a client of it.
+
+    The gateway runs in a daemon thread until the end of the benchmarks.
+
+    @param merchant_references: The merchant references of the payments
+    @param client_class: The class of the client
+    @param kwargs: The other arguments of the client
+    @return: The client
+    """
+    gateway = FakePayFortGateway().start()
+    for merchant_reference in merchant_references:
+        gateway.add_payment(merchant_reference)
+    return client_class(
+        access_code="123123123",
+        merchant_identifier="mid123",
+        request_sha_phrase=gateway.request_sha_phrase,
+        response_sha_phrase=gateway.response_sha_phrase,
+        sha_method=gateway.sha_method,
+        api_url=gateway.url,
+        **kwargs,
+    )
+
+
+@benchmark("PayFortAPIClient.check_status", number=200)
+def bench_check_status():
+    """Query the status of a payment over the pooled keep-alive connection."""
+    client = create_api_client(["1-2-3"])
+    return lambda: client.check_status("1-2-3")
+
+
+@benchmark("PayFortAPIClient.check_status_batch[payments=50]", number=5)
+def bench_check_status_batch():
+    """Query the status of 50 payments concurrently."""
+    merchant_references = [f"1-2-{index}" for index in range(50)]
+    client = create_api_client(merchant_references)
+    return lambda: client.check_status_batch(merchant_references)
+
+
+@benchmark("AsyncPayFortAPIClient.stream_check_status[payments=50]", number=5)
+def bench_stream_check_status():
+    """Query the status of 50 payments with the asyncio client."""
+    merchant_references = [f"1-2-{index}" for index in range(50)]
+    client = create_api_client(merchant_references, client_class=AsyncPayFortAPIClient, concurrency=20)
+    return lambda: list(client.stream_check_status(merchant_references))
+
+
+def _register_basket_benchmarks(line_count):
+    """Register the benchmarks that depend on the basket size."""
+    number = max(1, 1000 // line_count)
+
+    @benchmark(f"utils.get_order_description[lines={line_count}]", number=number)
+    def bench_get_order_description():
+        """Describe a freshly loaded basket."""
+        basket_id = create_basket(line_count)
+        return lambda: utils.get_order_description(load_basket(basket_id))
+
+    @benchmark(f"PayFort.get_transaction_parameters[lines={line_count}]", number=number)
+    def bench_get_transaction_parameters():
+        """Build the transaction parameters of a freshly loaded basket."""
+        basket_id = create_basket(line_count)
+        site = SimpleNamespace(id=1, siteconfiguration=SimpleNamespace(partner=SimpleNamespace(short_code="edx")))
+        processor = PayFort(site)
+        request = RequestFactory().post("/checkout/")
+        return lambda: processor.get_transaction_parameters(load_basket(basket_id), request=request)
+
+
+def create_offers_basket():
+    """
+    Create a frozen basket of one line, and site offers of which only the last one applies to it.
+
+    @return: The ID of the basket
+    """
+    basket = load_basket(create_basket(1))
+    other_range = oscar_factories.RangeFactory()
+    all_range = oscar_factories.RangeFactory(includes_all_products=True)
+    for index in range(OFFER_COUNT):
+        offer_range = all_range if index == OFFER_COUNT - 1 else other_range
+        oscar_factories.ConditionalOfferFactory(
+            condition=oscar_factories.ConditionFactory(range=offer_range, type="Count", value=1),
+            benefit=oscar_factories.BenefitFactory(range=offer_range, type="Percentage", value=10),
+            offer_type="Site",
+        )
+    Applicator().apply(basket, basket.owner)
+    basket.status = utils.Basket.FROZEN
+    basket.save()
+    offer_cache.record(basket)
+    return basket.id
+
+
+@benchmark(f"Applicator.apply[offers={OFFER_COUNT}]", number=20)
+def bench_apply_offers():
+    """Apply all the site offers to a freshly loaded frozen basket."""
+    basket_id = create_offers_basket()
+    return lambda: Applicator().apply(load_basket(basket_id))
+
+
+@benchmark(f"offer_cache.apply_recorded_offers[offers={OFFER_COUNT}]", number=20)
+def bench_apply_recorded_offers():
+    """Apply the offers recorded when the basket was frozen to a freshly loaded frozen basket."""
+    basket_id = create_offers_basket()
+    return lambda: offer_cache.apply_recorded_offers(Applicator(), load_basket(basket_id))
+
+
+def _register_import_benchmark(name, statement):
+    """Register the benchmark of the given import statement."""
+    @benchmark(f"import[{name}]", number=1, repeat=5)
+    def bench_import():
+        """Run the statement in a fresh interpreter, the way a script or a worker process starts."""
+        command = [sys.executable, "-c", statement]
+        return lambda: subprocess.run(command, check=True)
+
+
+for size in BASKET_SIZES:
+    _register_basket_benchmarks(size)
+
+for import_name, import_statement in IMPORT_STATEMENTS.items():
+    _register_import_benchmark(import_name, import_statement)
@@ -0,0 +1,104 @@
+"""Run the registered benchmarks, store their results and compare them with a baseline."""
+import json
+import platform
+import statistics
+import timeit
+
+BENCHMARKS = {}
+
+
+def benchmark(name, number=1000, repeat=5):
+    """
+    Register a benchmark.
+
+    The decorated function prepares the fixtures and returns the callable to time.
+
+    @param name: The unique name of the benchmark
+    @param number: The number of calls per timing
+    @param repeat: The number of timings
+    """
+    def decorator(setup):
+        if name in BENCHMARKS:
+            raise ValueError(f"Duplicate benchmark name: {name}")
+        BENCHMARKS[name] = {"setup": setup, "number": number, "repeat": repeat}
+        return setup
+    return decorator
+
+
+def run(names=None):
+    """
+    Run the benchmarks and return their results in microseconds per call.
+
+    @param names: The names of the benchmarks to run, all of them if None
+    @return: The results keyed by the benchmark name
+    """
+    results = {}
+    for name, config in BENCHMARKS.items():
+        if names and name not in names:
+            continue
+
+        func = config["setup"]()
+        timings = timeit.Timer(func).repeat(repeat=config["repeat"], number=config["number"])
+        per_call = [timing / config["number"] * 1e6 for timing in timings]
+        results[name] = {
+            "min_us": min(per_call),
+            "median_us": statistics.median(per_call),
+            "number": config["number"],
+            "repeat": config["repeat"],
+        }
+
+    return results
+
+
+def compare(results, baseline, max_regression):
+    """
+    Compare the results with the baseline.
+
+    The fastest timing is compared because it is the least affected by noise from the machine.
+
+    @param results: The results of the current run
+    @param baseline: The results of the baseline run
+    @param max_regression: The allowed slowdown, in percent of the baseline
+    @return: The names of the regressed benchmarks along with their slowdown in percent
+    """
+    regressions = {}
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+
+        slowdown = (result["min_us"] / baseline[name]["min_us"] - 1) * 100
+        if slowdown > max_regression:
+            regressions[name] = slowdown
+
+    return regressions
+
+
+def save(results, path):
+    """
+    Save the results as JSON.
+
+    @param results: The results to save
+    @param path: The path of the JSON file
+    """
+    with open(path, "w", encoding="utf8") as output_file:
+        json.dump(
+            {
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "results": results,
+            },
+            output_file,
+            indent=2,
+            sort_keys=True,
+        )
+
+
+def load(path):
+    """
+    Load the results saved by `save`.
+
+    @param path: The path of the JSON file
+    @return: The results keyed by the benchmark name
+    """
+    with open(path, encoding="utf8") as input_file:
+        return json.load(input_file)["results"]
@@ -0,0 +1,65 @@
+"""
+Compare the precompiled SANITIZERS with the former re.sub path of sanitize_text.
+
+Usage:
+
+    bash ./scripts/tox_install_ecommerce_run_pytest.sh python -m benchmarks.sanitize_text
+"""
+import re
+import timeit
+
+from benchmarks import setup_django
+
+NUMBER = 20000
+
+SAMPLES = {
+    "customer_name": [
+        "Ecommerce User",
+        "Good _\\/-.' Bad!+%^*()[@+123]<> Arabic عربي",
+    ],
+    "order_description": [
+        "1 X course-v1:C1+CC1+2024 // 1 X course-v1:C2+CC2+2024",
+        " // ".join(f"1 X course-v1:Org+Course{index}+2024" for index in range(10)),
+    ],
+}
+
+
+def legacy_sanitize_text(text_to_sanitize, valid_pattern, max_length=None, replacement="_"):
+    """The re.sub based sanitize_text as it was before SANITIZERS."""
+    sanitized = re.sub(valid_pattern, replacement, text_to_sanitize)
+    if max_length is None or max_length <= 0:
+        return sanitized
+
+    if len(sanitized) > max_length and r'\.' in valid_pattern:
+        return sanitized[:max_length - 3] + "..."
+    return sanitized[:max_length]
+
+
+def main():
+    """Run the benchmark and print the results."""
+    setup_django()
+    from ecommerce_payfort import utils  # pylint: disable=import-outside-toplevel
+
+    for field, texts in SAMPLES.items():
+        sanitizer = utils.SANITIZERS[field]
+        for text in texts:
+            assert sanitizer(text) == legacy_sanitize_text(
+                text, utils.VALID_PATTERNS[field], sanitizer.max_length
+            ), f"{field}: results differ for {text!r}"
+
+            legacy = timeit.timeit(
+                lambda: legacy_sanitize_text(  # pylint: disable=cell-var-from-loop
+                    text, utils.VALID_PATTERNS[field], sanitizer.max_length  # pylint: disable=cell-var-from-loop
+                ),
+                number=NUMBER,
+            )
+            current = timeit.timeit(lambda: sanitizer(text), number=NUMBER)  # pylint: disable=cell-var-from-loop
+            print(
+                f"{field:<18} {'ascii' if text.isascii() else 'non-ascii':<10} len={len(text):<4} "
+                f"re.sub: {legacy / NUMBER * 1e6:7.2f}us  sanitizer: {current / NUMBER * 1e6:7.2f}us  "
+                f"speedup: x{legacy / current:.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
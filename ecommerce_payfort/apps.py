@@ -1,5 +1,6 @@
 """PayFort payment processor Django application initialization."""
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class PayFortConfig(AppConfig):
@@ -7,6 +8,7 @@ class PayFortConfig(AppConfig):
     Configuration for the PayFort payment processor Django application.
     """
     name = 'ecommerce_payfort'
+    default_auto_field = 'django.db.models.AutoField'
     plugin_app = {
         'url_config': {
             'ecommerce': {
@@ -14,3 +16,12 @@ class PayFortConfig(AppConfig):
             }
         },
     }
+
+    def ready(self):
+        """Connect the signal receivers, then warm up the hot-path state when the PAYFORT_WARM_UP setting is set."""
+        # pylint: disable=import-outside-toplevel
+        from ecommerce_payfort import signals  # pylint: disable=unused-import
+        from ecommerce_payfort.warmup import WARM_UP_SETTING, warm_up
+
+        if getattr(settings, WARM_UP_SETTING, False):
+            warm_up(close_connections=True)
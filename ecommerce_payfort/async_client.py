@@ -0,0 +1,206 @@
+"""
+Asyncio client of the PayFort API, to check the status of many payments concurrently.
+
+The status checks run in an event loop of their own, in a background thread, and their results are streamed back to
+the calling thread as they finish. This keeps the Django ORM out of the event loop.
+"""
+import asyncio
+import logging
+import queue
+import threading
+
+import aiohttp
+
+from ecommerce_payfort import core
+from ecommerce_payfort.client import BasePayFortAPIClient
+
+logger = logging.getLogger(__name__)
+
+_DONE = object()
+
+
+class RateLimiter:
+    """
+    Interval-based rate limit: consecutive acquisitions are spaced by at least `period / rate` seconds.
+
+    Fractional rates are honored, e.g. a rate of 0.5 allows one acquisition every two seconds. The limiter must be
+    created within the event loop that uses it.
+    """
+    def __init__(self, rate, period=1.0):
+        """
+        Initialize the limiter.
+
+        @param rate: The maximum number of acquisitions per period, may be fractional
+        @param period: The period in seconds
+        """
+        if rate <= 0:
+            raise ValueError(f"The rate must be positive, got {rate}")
+        self.rate = rate
+        self.period = period
+        self.interval = period / rate
+        self._lock = asyncio.Lock()
+        self._next_time = None
+
+    async def acquire(self):
+        """Wait until one interval has passed since the previous acquisition."""
+        async with self._lock:
+            now = asyncio.get_running_loop().time()
+            if self._next_time is not None and self._next_time > now:
+                await asyncio.sleep(self._next_time - now)
+                now = self._next_time
+            self._next_time = now + self.interval
+
+
+class AsyncPayFortAPIClient(BasePayFortAPIClient):
+    """
+    Client of the PayFort API that keeps a number of CHECK_STATUS queries in flight.
+
+    The number of queries in flight is bounded by `concurrency`, and the number of queries sent per second by
+    `rate_limit` to respect the quota of the gateway.
+    """
+    CONCURRENCY = 20
+
+    def __init__(self, *args, concurrency=CONCURRENCY, rate_limit=None, **kwargs):
+        """
+        Initialize the client.
+
+        @param concurrency: The maximum number of queries in flight
+        @param rate_limit: The maximum number of queries sent per second, unlimited if None
+        """
+        super().__init__(*args, **kwargs)
+        self.concurrency = max(1, concurrency)
+        self.rate_limit = rate_limit
+
+    def create_session(self):
+        """Create the session, with as many keep-alive connections as queries in flight."""
+        return aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.concurrency),
+            timeout=aiohttp.ClientTimeout(sock_connect=self.CONNECT_TIMEOUT, sock_read=self.READ_TIMEOUT),
+        )
+
+    async def send(self, session, parameters, rate_limiter=None):
+        """
+        Sign and send the given query, then verify the signature of the response.
+
+        The connection errors and the gateway errors are retried with an exponential backoff.
+
+        @param session: The session
+        @param parameters: The query parameters, without the credentials and the signature
+        @param rate_limiter: The rate limiter of the queries, if any
+        @return: The verified response data
+        """
+        query = self.sign_query(parameters)
+        error = None
+        for attempt in range(self.MAX_RETRIES + 1):
+            if attempt:
+                await asyncio.sleep(self.BACKOFF_FACTOR * (2 ** (attempt - 1)))
+            if rate_limiter is not None:
+                await rate_limiter.acquire()
+
+            try:
+                async with session.post(self.api_url, json=query) as response:
+                    response.raise_for_status()
+                    response_data = await response.json(content_type=None)
+            except aiohttp.ClientResponseError as exc:
+                if exc.status not in self.RETRY_STATUSES:
+                    raise self.get_request_error(query, exc) from exc
+                error = exc
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as exc:
+                error = exc
+            except (aiohttp.ClientError, ValueError) as exc:
+                raise self.get_request_error(query, exc) from exc
+            else:
+                return self.verify_response(response_data)
+
+        raise self.get_request_error(query, error) from error
+
+    async def iter_check_status(self, merchant_references):
+        """
+        Query the status of the payments of the given merchant references, yielding the results as they finish.
+
+        The merchant references are consumed lazily by `concurrency` workers sharing one session.
+
+        @param merchant_references: An iterable of merchant references
+        @return: An async iterator of (merchant reference, verified response data or PayFortException) tuples
+        """
+        merchant_references = iter(merchant_references)
+        results = asyncio.Queue()
+        rate_limiter = RateLimiter(self.rate_limit) if self.rate_limit else None
+
+        async with self.create_session() as session:
+            async def worker():
+                """Check the status of the next merchant reference until there is none left."""
+                try:
+                    for merchant_reference in merchant_references:
+                        try:
+                            result = await self.send(
+                                session,
+                                self.get_check_status_parameters(merchant_reference),
+                                rate_limiter=rate_limiter,
+                            )
+                        except core.PayFortException as exc:
+                            logger.warning(
+                                "PayFort status check failed! merchant_reference: %s. %s", merchant_reference, exc,
+                            )
+                            result = exc
+                        await results.put((merchant_reference, result))
+                finally:
+                    await results.put(_DONE)
+
+            workers = [asyncio.ensure_future(worker()) for _ in range(self.concurrency)]
+            try:
+                running = len(workers)
+                while running:
+                    result = await results.get()
+                    if result is _DONE:
+                        running -= 1
+                    else:
+                        yield result
+                for task in workers:
+                    task.result()
+            finally:
+                for task in workers:
+                    task.cancel()
+                await asyncio.gather(*workers, return_exceptions=True)
+
+    def stream_check_status(self, merchant_references):
+        """
+        Query the status of the payments of the given merchant references, yielding the results as they finish.
+
+        The queries run in an event loop in a background thread, so this generator can be used from synchronous code.
+
+        @param merchant_references: An iterable of merchant references
+        @return: An iterator of (merchant reference, verified response data or PayFortException) tuples
+        """
+        results = queue.Queue()
+        stopped = threading.Event()
+
+        async def produce():
+            """Forward the results to the calling thread until it stops consuming them."""
+            async for result in self.iter_check_status(merchant_references):
+                results.put(result)
+                if stopped.is_set():
+                    break
+
+        def run():
+            """Run the event loop, and forward its failure if any."""
+            try:
+                asyncio.run(produce())
+            except Exception as exc:  # pylint: disable=broad-except
+                results.put(exc)
+            finally:
+                results.put(_DONE)
+
+        thread = threading.Thread(target=run, name="payfort-api-async", daemon=True)
+        thread.start()
+        try:
+            while True:
+                result = results.get()
+                if result is _DONE:
+                    break
+                if isinstance(result, Exception):
+                    raise result
+                yield result
+        finally:
+            stopped.set()
+            thread.join()
@@ -0,0 +1,290 @@
+"""
+Server-to-server client of the PayFort API.
+
+For reference, see https://paymentservices-reference.payfort.com/docs/api/build/index.html#check-status
+and https://paymentservices-reference.payfort.com/docs/api/build/index.html#refund-operation
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from ecommerce_payfort import core
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_API_URL = "https://sbpaymentservices.payfort.com/FortAPI/paymentApi"
+CHECK_STATUS_COMMAND = "CHECK_STATUS"
+CHECK_STATUS_SUCCESS = "12"
+REFUND_COMMAND = "REFUND"
+REFUND_SUCCESS = "06"
+
+
+class BasePayFortAPIClient:
+    """
+    Credentials and query helpers shared by the PayFort API clients.
+
+    The query commands don't change anything, so the clients retry them on connection errors and on the gateway
+    errors. The maintenance commands, like refunds, are only retried when the connection could not be established.
+    """
+    CONNECT_TIMEOUT = 3.05
+    READ_TIMEOUT = 10
+    MAX_RETRIES = 3
+    BACKOFF_FACTOR = 0.5
+    RETRY_STATUSES = (500, 502, 503, 504)
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        access_code,
+        merchant_identifier,
+        request_sha_phrase,
+        response_sha_phrase,
+        sha_method,
+        api_url=DEFAULT_API_URL,
+        language="en",
+    ):
+        """Initialize the client."""
+        self.access_code = access_code
+        self.merchant_identifier = merchant_identifier
+        self.request_sha_phrase = request_sha_phrase
+        self.response_sha_phrase = response_sha_phrase
+        self.sha_method = sha_method
+        self.api_url = api_url
+        self.language = language
+
+    @classmethod
+    def from_processor(cls, processor, **kwargs):
+        """
+        Create a client with the configuration of the given PayFort processor.
+
+        @param processor: The PayFort processor
+        @param kwargs: The other arguments of the client
+        @return: The client
+        """
+        return cls(
+            access_code=processor.access_code,
+            merchant_identifier=processor.merchant_identifier,
+            request_sha_phrase=processor.request_sha_phrase,
+            response_sha_phrase=processor.response_sha_phrase,
+            sha_method=processor.sha_method,
+            api_url=processor.api_url,
+            **kwargs,
+        )
+
+    def sign_query(self, parameters):
+        """
+        Add the credentials and the signature to the given query parameters.
+
+        @param parameters: The query parameters, without the credentials and the signature
+        @return: The signed query
+        """
+        query = {
+            "access_code": self.access_code,
+            "merchant_identifier": self.merchant_identifier,
+            "language": self.language,
+            **parameters,
+        }
+        query["signature"] = core.get_signature(self.request_sha_phrase, self.sha_method, query)
+        return query
+
+    @staticmethod
+    def get_request_error(query, exc):
+        """
+        Return the exception to raise when the given query failed.
+
+        @param query: The query
+        @param exc: The exception raised by the HTTP client
+        @return: The PayFortException
+        """
+        return core.PayFortException(
+            f"PayFort API request failed! query: {query.get('query_command') or query.get('command')}. "
+            f"Exception: {exc.__class__.__name__}: {str(exc)}"
+        )
+
+    def verify_response(self, response_data):
+        """
+        Verify the format and the signature of the given response data.
+
+        @param response_data: The decoded response body
+        @return: The verified response data
+        """
+        if not isinstance(response_data, dict):
+            raise core.PayFortException(f"Bad PayFort API response: {response_data}")
+
+        core.verify_signature(self.response_sha_phrase, self.sha_method, response_data)
+        return response_data
+
+    @staticmethod
+    def get_check_status_parameters(merchant_reference, fort_id=None):
+        """
+        Return the parameters of the query of the status of the given payment.
+
+        @param merchant_reference: The merchant reference
+        @param fort_id: The PayFort ID of the payment, if known
+        @return: The query parameters
+        """
+        parameters = {
+            "query_command": CHECK_STATUS_COMMAND,
+            "merchant_reference": merchant_reference,
+        }
+        if fort_id:
+            parameters["fort_id"] = fort_id
+
+        return parameters
+
+    @staticmethod
+    def get_refund_parameters(  # pylint: disable=too-many-arguments
+        merchant_reference, amount, currency, maintenance_reference, fort_id=None,
+    ):
+        """
+        Return the parameters of the refund of the given payment.
+
+        @param merchant_reference: The merchant reference of the payment
+        @param amount: The amount to refund, in the ISO 4217 format of the currency
+        @param currency: The currency
+        @param maintenance_reference: The unique reference of the refund, used as its idempotency key
+        @param fort_id: The PayFort ID of the payment, if known
+        @return: The refund parameters
+        """
+        parameters = {
+            "command": REFUND_COMMAND,
+            "merchant_reference": merchant_reference,
+            "maintenance_reference": maintenance_reference,
+            "amount": amount,
+            "currency": currency,
+        }
+        if fort_id:
+            parameters["fort_id"] = fort_id
+
+        return parameters
+
+
+class PayFortAPIClient(BasePayFortAPIClient):
+    """
+    Client of the PayFort API, built on a pooled keep-alive session.
+
+    The sessions are safe to share between threads, like the ones of the batch mode. The queries and the maintenance
+    commands use separate sessions, since their retry policies differ.
+    """
+    POOL_SIZE = 10
+
+    def __init__(self, *args, **kwargs):
+        """Initialize the client and its sessions."""
+        super().__init__(*args, **kwargs)
+        self.timeout = (self.CONNECT_TIMEOUT, self.READ_TIMEOUT)
+        self.session = self.create_session(Retry(
+            total=self.MAX_RETRIES,
+            backoff_factor=self.BACKOFF_FACTOR,
+            status_forcelist=self.RETRY_STATUSES,
+            allowed_methods=frozenset({"POST"}),
+            raise_on_status=False,
+        ))
+        self.maintenance_session = self.create_session(Retry(
+            total=self.MAX_RETRIES,
+            read=0,
+            other=0,
+            backoff_factor=self.BACKOFF_FACTOR,
+            allowed_methods=frozenset({"POST"}),
+            raise_on_status=False,
+        ))
+
+    def create_session(self, retry):
+        """
+        Create a session, with a pool of keep-alive connections.
+
+        @param retry: The retry policy
+        @return: The session
+        """
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.POOL_SIZE, max_retries=retry)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def close(self):
+        """Close the pooled connections."""
+        self.session.close()
+        self.maintenance_session.close()
+
+    def __enter__(self):
+        """Use the client as a context manager that closes its connections."""
+        return self
+
+    def __exit__(self, *args):
+        """Close the pooled connections."""
+        self.close()
+
+    def send(self, parameters, session=None):
+        """
+        Sign and send the given query, then verify the signature of the response.
+
+        @param parameters: The query parameters, without the credentials and the signature
+        @param session: The session to send the query with, the session of the queries when not given
+        @return: The verified response data
+        """
+        query = self.sign_query(parameters)
+        try:
+            response = (session or self.session).post(self.api_url, json=query, timeout=self.timeout)
+            response.raise_for_status()
+            response_data = response.json()
+        except (requests.RequestException, ValueError) as exc:
+            raise self.get_request_error(query, exc) from exc
+
+        return self.verify_response(response_data)
+
+    def check_status(self, merchant_reference, fort_id=None):
+        """
+        Query the status of the payment of the given merchant reference.
+
+        @param merchant_reference: The merchant reference
+        @param fort_id: The PayFort ID of the payment, if known
+        @return: The verified response data. Its transaction_status is the status of the payment
+        """
+        return self.send(self.get_check_status_parameters(merchant_reference, fort_id))
+
+    def refund(  # pylint: disable=too-many-arguments
+        self, merchant_reference, amount, currency, maintenance_reference, fort_id=None,
+    ):
+        """
+        Refund the given amount of the payment of the given merchant reference.
+
+        The refund is not retried once sent, since its outcome is then unknown. Send it again with the same
+        maintenance reference to resume it.
+
+        @param merchant_reference: The merchant reference of the payment
+        @param amount: The amount to refund, in the ISO 4217 format of the currency
+        @param currency: The currency
+        @param maintenance_reference: The unique reference of the refund, used as its idempotency key
+        @param fort_id: The PayFort ID of the payment, if known
+        @return: The verified response data. Its status is REFUND_SUCCESS when the refund succeeded
+        """
+        return self.send(
+            self.get_refund_parameters(merchant_reference, amount, currency, maintenance_reference, fort_id),
+            session=self.maintenance_session,
+        )
+
+    def check_status_batch(self, merchant_references, max_workers=POOL_SIZE):
+        """
+        Query the status of the payments of the given merchant references concurrently.
+
+        @param merchant_references: The merchant references
+        @param max_workers: Maximum number of concurrent queries, bounded by the size of the connection pool
+        @return: A dictionary keyed by merchant reference, of either the verified response data or the exception
+        """
+        merchant_references = list(merchant_references)
+        if not merchant_references:
+            return {}
+
+        def check_status(merchant_reference):
+            """Return the response data, or the exception raised by the query."""
+            try:
+                return self.check_status(merchant_reference)
+            except core.PayFortException as exc:
+                logger.warning("PayFort status check failed! merchant_reference: %s. %s", merchant_reference, exc)
+                return exc
+
+        max_workers = max(1, min(max_workers, self.POOL_SIZE, len(merchant_references)))
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="payfort-api") as executor:
+            return dict(zip(merchant_references, executor.map(check_status, merchant_references)))
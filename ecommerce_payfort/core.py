@@ -0,0 +1,446 @@
+"""
+Signing, verification, sanitizing and response parsing for the PayFort payment gateway.
+
+This module doesn't depend on Django, so that scripts, workers and the API clients can sign and verify PayFort
+messages without loading the ecommerce application. Keep it that way: the helpers that need the Oscar models belong
+in utils.py.
+"""
+from __future__ import annotations
+
+import functools
+import hashlib
+import hmac
+import re
+from collections.abc import Mapping
+from typing import Any
+
+try:
+    from oscar.apps.payment.exceptions import GatewayError
+except ImportError:  # Oscar is not installed, e.g. in an offline verification tool
+    GatewayError = Exception
+
+MANDATORY_RESPONSE_FIELDS = [
+    "merchant_reference",
+    "command",
+    "merchant_identifier",
+    "amount",
+    "currency",
+    "response_code",
+    "signature",
+    "status",
+]
+AMOUNT_PATTERN = re.compile(r"0|[1-9][0-9]*")
+MAX_CUSTOMER_NAME_LENGTH = 50
+MAX_ORDER_DESCRIPTION_LENGTH = 150
+MERCHANT_REFERENCE_PATTERN = re.compile(r"(\d+)-(\d+)-(\d+)")
+SIGNER_CACHE_SIZE = 32
+SUCCESS_STATUS = "14"
+SUPPORTED_SHA_METHODS = {
+    "SHA-256": hashlib.sha256,
+    "SHA-512": hashlib.sha512,
+}
+VALID_CURRENCY = "SAR"
+VALID_PATTERNS = {
+    "order_description": r"[^A-Za-z0-9 '/\._\-#:$]",
+    "customer_name": r"[^A-Za-z _\\/\-\.']",
+}
+
+
+class PayFortException(GatewayError):
+    """PayFort exception."""
+
+
+class PayFortBadSignatureException(PayFortException):
+    """PayFort bad signature exception."""
+
+
+class PayFortResponse:
+    """
+    Read-only record of a PayFort response that passed the format verification.
+
+    It keeps a reference to the raw response data, along with the values parsed out of it.
+    """
+    __slots__ = (
+        "data",
+        "merchant_reference",
+        "site_id",
+        "owner_id",
+        "basket_id",
+        "amount",
+        "currency",
+        "status",
+        "response_code",
+        "eci",
+        "fort_id",
+        "card_number",
+        "payment_option",
+        "transaction_id",
+        "success",
+    )
+
+    def __init__(
+            self, data: Mapping, site_id: int, owner_id: int, basket_id: int, amount: int
+    ):  # pylint: disable=too-many-arguments
+        """
+        Initialize the record.
+
+        @param data: The raw response data
+        @param site_id: The site ID parsed from the merchant reference
+        @param owner_id: The basket owner ID parsed from the merchant reference
+        @param basket_id: The basket ID parsed from the merchant reference
+        @param amount: The parsed amount
+        """
+        values = {
+            "data": data,
+            "merchant_reference": data.get("merchant_reference"),
+            "site_id": site_id,
+            "owner_id": owner_id,
+            "basket_id": basket_id,
+            "amount": amount,
+            "currency": data.get("currency"),
+            "status": data.get("status"),
+            "response_code": data.get("response_code"),
+            "eci": data.get("eci"),
+            "fort_id": data.get("fort_id"),
+            "card_number": data.get("card_number"),
+            "payment_option": data.get("payment_option"),
+            "transaction_id": f"{data.get('eci') or 'none'}-{data.get('fort_id') or 'none'}",
+            "success": data.get("status") == SUCCESS_STATUS,
+        }
+        for name, value in values.items():
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        """Prevent altering the record."""
+        raise AttributeError(f"{self.__class__.__name__} is read-only")
+
+    def __delattr__(self, name):
+        """Prevent altering the record."""
+        raise AttributeError(f"{self.__class__.__name__} is read-only")
+
+    def __repr__(self):
+        """Return the representation of the record."""
+        return f"<{self.__class__.__name__} {self.merchant_reference} {self.transaction_id} status={self.status}>"
+
+
+@functools.lru_cache(maxsize=None)
+def _compile_pattern(pattern: str) -> re.Pattern:
+    """Return the compiled version of the given pattern."""
+    return re.compile(pattern)
+
+
+def sanitize_text(
+        text_to_sanitize: str, valid_pattern: str, max_length: int | None = None, replacement: str = "_"
+) -> str:
+    """
+    Sanitize the text by replacing invalid characters with the replacement character.
+
+    The truncated text ends with an ellipsis only when the pattern allows dots. Use SANITIZERS for the fields
+    sent to PayFort, they declare their truncation policy explicitly.
+
+    @param text_to_sanitize: The text to sanitize
+    @param valid_pattern: The valid pattern to match the text against
+    @param max_length: The maximum length of the sanitized text
+    @param replacement: The replacement character for invalid characters
+    @return: The sanitized text
+    """
+    if (valid_pattern or "") == "":
+        return ""
+
+    sanitized = _compile_pattern(valid_pattern).sub(replacement, text_to_sanitize)
+    if max_length is None or max_length <= 0:
+        return sanitized
+
+    if len(sanitized) > max_length and r'\.' in valid_pattern:
+        return sanitized[:max_length - 3] + "..."
+    return sanitized[:max_length]
+
+
+class TextSanitizer:
+    """
+    Precompiled sanitizer for a text field sent to PayFort.
+
+    The pattern must match the single invalid characters. ASCII text is sanitized with a byte translate table
+    built from the pattern, any other text goes through the compiled pattern.
+    """
+    def __init__(
+            self, invalid_pattern: str, max_length: int | None = None, ellipsis: bool = False, replacement: str = "_"
+    ):
+        """
+        Initialize the sanitizer.
+
+        @param invalid_pattern: The pattern matching the invalid characters
+        @param max_length: The maximum length of the sanitized text, None for no limit
+        @param ellipsis: Whether to end the truncated text with an ellipsis
+        @param replacement: The replacement character for invalid characters
+        """
+        self.pattern = re.compile(invalid_pattern)
+        self.max_length = max_length
+        self.ellipsis = ellipsis
+        self.replacement = replacement
+        self._ascii_table = None
+        if len(replacement) == 1 and replacement.isascii():
+            self._ascii_table = bytes(
+                ord(replacement) if self.pattern.fullmatch(chr(code)) else code for code in range(256)
+            )
+
+    def __call__(self, text: str) -> str:
+        """
+        Return the sanitized text.
+
+        @param text: The text to sanitize
+        @return: The sanitized text
+        """
+        if self._ascii_table is not None and text.isascii():
+            sanitized = text.encode("ascii").translate(self._ascii_table).decode("ascii")
+        else:
+            sanitized = self.pattern.sub(self.replacement, text)
+
+        if self.max_length is None or len(sanitized) <= self.max_length:
+            return sanitized
+
+        if self.ellipsis:
+            return sanitized[:self.max_length - 3] + "..."
+        return sanitized[:self.max_length]
+
+
+SANITIZERS = {
+    "customer_name": TextSanitizer(
+        VALID_PATTERNS["customer_name"], max_length=MAX_CUSTOMER_NAME_LENGTH, ellipsis=True,
+    ),
+    "order_description": TextSanitizer(
+        VALID_PATTERNS["order_description"], max_length=MAX_ORDER_DESCRIPTION_LENGTH, ellipsis=True,
+    ),
+}
+
+
+def verify_param(param: Any, param_name: str, required_type: Any):
+    """
+    Verify a parameter type
+
+    @param param: The parameter to verify
+    @param param_name: The name of the parameter to be used in the exception message
+    @param required_type: The required type of the parameter
+    """
+    if param is None or not isinstance(param, required_type):
+        raise PayFortException(
+            f"verify_param failed: {param_name} is required and must be "
+            f"({required_type.__name__}), but got ({type(param).__name__})"
+        )
+
+
+class Signer:
+    """
+    Signing engine for PayFort requests and responses.
+
+    The hash object is seeded with the SHA phrase once; every signature then starts from a copy of that state.
+    """
+    def __init__(self, sha_phrase: str, sha_method: str):
+        """
+        Initialize the signer.
+
+        @param sha_phrase: The SHA phrase
+        @param sha_method: The SHA method
+        """
+        verify_param(sha_phrase, "sha_phrase", str)
+        verify_param(sha_method, "sha_method", str)
+
+        sha_method_fnc = SUPPORTED_SHA_METHODS.get(sha_method)
+        if sha_method_fnc is None:
+            raise PayFortException(f"Unsupported SHA method: {sha_method}")
+
+        self.sha_method = sha_method
+        self._sha_phrase = sha_phrase.encode()
+        self._seeded_hash = sha_method_fnc(self._sha_phrase)
+
+    def _digest(self, parameters: Mapping, skip_key: str | None = None) -> str:
+        """
+        Return the hex digest of the given parameters, skipping the given key if any.
+
+        @param parameters: The parameters to hash
+        @param skip_key: The key to leave out of the hash
+        @return: The hex digest
+        """
+        hash_object = self._seeded_hash.copy()
+        for key in sorted(parameters, key=str.lower):
+            if key != skip_key:
+                hash_object.update(f"{key}={parameters[key]}".encode())
+        hash_object.update(self._sha_phrase)
+
+        return hash_object.hexdigest()
+
+    def sign(self, parameters: dict) -> str:
+        """
+        Return the signature for the given parameters.
+
+        @param parameters: The parameters to sign
+        @return: The calculated signature
+        """
+        verify_param(parameters, "transaction_parameters", dict)
+
+        return self._digest(parameters)
+
+    def verify(self, data: Mapping):
+        """
+        Verify the signature of the given data without copying it.
+
+        @param data: The signed data, a dict or a read-only mapping such as request.POST
+        """
+        verify_param(data, "response_data", Mapping)
+
+        signature = data.get("signature")
+        if signature is None:
+            raise PayFortBadSignatureException("Signature not found!")
+
+        expected_signature = self._digest(data, skip_key="signature")
+        if not hmac.compare_digest(str(signature).encode(), expected_signature.encode()):
+            raise PayFortBadSignatureException(
+                f"Response signature mismatch. merchant_reference: {data.get('merchant_reference', 'none')}"
+            )
+
+
+@functools.lru_cache(maxsize=SIGNER_CACHE_SIZE)
+def get_signer(sha_phrase: str, sha_method: str) -> Signer:
+    """
+    Return the shared signer for the given SHA phrase and method.
+
+    @param sha_phrase: The SHA phrase
+    @param sha_method: The SHA method
+    @return: The signer
+    """
+    return Signer(sha_phrase, sha_method)
+
+
+def get_signature(sha_phrase: str, sha_method: str, transaction_parameters: dict) -> str:
+    """
+    Return the signature for the given transaction parameters.
+
+    @param sha_phrase: The SHA phrase
+    @param sha_method: The SHA method
+    @param transaction_parameters: The transaction parameters
+    @return: The calculated signature
+    """
+    verify_param(sha_phrase, "sha_phrase", str)
+    verify_param(sha_method, "sha_method", str)
+
+    return get_signer(sha_phrase, sha_method).sign(transaction_parameters)
+
+
+def get_transaction_id(response_data: dict) -> str:
+    """
+    Return the transaction ID from the response data.
+
+    @param response_data: The response data
+    @return: The transaction ID
+    """
+    verify_param(response_data, "response_data", dict)
+
+    return f"{response_data.get('eci') or 'none'}-{response_data.get('fort_id') or 'none'}"
+
+
+def format_merchant_reference(site_id: int, owner_id: int | None, basket_id: int) -> str:
+    """
+    Return the merchant reference of the given IDs.
+
+    @param site_id: The site ID
+    @param owner_id: The owner ID
+    @param basket_id: The basket ID
+    @return: The merchant reference, formatted as <site_id>-<owner_id>-<basket_id>
+    """
+    return f"{site_id}-{owner_id}-{basket_id}"
+
+
+def parse_merchant_reference(merchant_reference: str) -> tuple[int, int, int] | None:
+    """
+    Parse the site ID, the owner ID and the basket ID encoded in the given merchant reference.
+
+    @param merchant_reference: The merchant reference, formatted as <site_id>-<owner_id>-<basket_id>
+    @return: The (site ID, owner ID, basket ID) tuple, or None if the merchant reference is malformed
+    """
+    match = MERCHANT_REFERENCE_PATTERN.fullmatch(merchant_reference or "")
+    if match is None:
+        return None
+
+    site_id, owner_id, basket_id = match.groups()
+    return int(site_id), int(owner_id), int(basket_id)
+
+
+def verify_response_format(response_data: Mapping) -> PayFortResponse:
+    """
+    Verify the format of the response from PayFort and parse it in a single pass.
+
+    @param response_data: The response data
+    @return: The parsed response
+    """
+    for field in MANDATORY_RESPONSE_FIELDS:
+        if field not in response_data:
+            raise PayFortException(f"Missing field in response: {field}")
+        if not isinstance(response_data[field], str):
+            raise PayFortException((
+                f"Invalid field type in response: {field}. "
+                f"Should be <str>, but got <{type(response_data[field]).__name__}>"
+            ))
+
+    if AMOUNT_PATTERN.fullmatch(response_data["amount"]) is None:
+        raise PayFortException(
+            f"Invalid amount in response (not a positive integer): {response_data['amount']}"
+        )
+
+    if response_data["currency"] != VALID_CURRENCY:
+        raise PayFortException(f"Invalid currency in response: {response_data['currency']}")
+
+    if response_data["command"] != "PURCHASE":
+        raise PayFortException(f"Invalid command in response: {response_data['command']}")
+
+    merchant_reference = parse_merchant_reference(response_data["merchant_reference"])
+    if merchant_reference is None:
+        raise PayFortException(
+            f"Invalid merchant_reference in response: {response_data['merchant_reference']}"
+        )
+
+    if (
+            (response_data.get("eci") is None or response_data.get("fort_id") is None) and
+            response_data['status'] == SUCCESS_STATUS
+    ):
+        raise PayFortException(
+            f"Unexpected successful payment that lacks eci or fort_id: {response_data['merchant_reference']}"
+        )
+
+    site_id, owner_id, basket_id = merchant_reference
+    return PayFortResponse(
+        response_data,
+        site_id=site_id,
+        owner_id=owner_id,
+        basket_id=basket_id,
+        amount=int(response_data["amount"]),
+    )
+
+
+def verify_signature(sha_phrase: str, sha_method: str, data: Mapping):
+    """
+    Verify the data signature.
+
+    @param sha_phrase: The SHA phrase
+    @param sha_method: The SHA method
+    @param data: The response data, a dict or a read-only mapping such as request.POST
+    """
+    verify_param(data, "response_data", Mapping)
+
+    get_signer(sha_phrase, sha_method).verify(data)
+
+
+def get_recorded_response_data(response):
+    """
+    Return the PayFort response data of the given recorded processor response.
+
+    The views and the refunds record the response data wrapped as {"view": ..., "response": ...} and
+    {"command": ..., "response": ...}.
+
+    @param response: The response stored in the payment processor response
+    @return: The response data, or an empty dictionary if the recorded response is not a dictionary
+    """
+    if not isinstance(response, dict):
+        return {}
+
+    response_data = response.get("response", response)
+    return response_data if isinstance(response_data, dict) else {}
@@ -0,0 +1,88 @@
+"""
+Cache of the PayFort callbacks that were already processed, so their retries are acknowledged right away.
+
+A callback is identified by its (fort_id, status, signature) triple, and is only looked up after its signature is
+verified. The cache is built on the Django cache, so it's shared by all workers and nodes when the backend is shared,
+and each entry expires after its TTL.
+"""
+import threading
+
+from django.core.cache import cache
+
+from ecommerce_payfort import instrumentation
+
+KEY_PREFIX = "payfort_seen"
+TTL = 24 * 60 * 60
+
+
+class DuplicateResponse(Exception):
+    """Raised when a verified response was already processed."""
+
+
+class DuplicateStats:
+    """Thread-safe counter of the duplicate callbacks acknowledged by the current process."""
+    def __init__(self):
+        """Initialize the counter."""
+        self._lock = threading.Lock()
+        self.duplicates = 0
+
+    def record(self):
+        """Count a duplicate callback."""
+        with self._lock:
+            self.duplicates += 1
+
+    def as_dict(self):
+        """Return the counter as a dictionary."""
+        with self._lock:
+            return {"duplicates": self.duplicates}
+
+    def reset(self):
+        """Reset the counter."""
+        with self._lock:
+            self.duplicates = 0
+
+
+duplicate_stats = DuplicateStats()
+
+
+def get_key(response_data):
+    """
+    Return the cache key of the given response.
+
+    @param response_data: The verified response data from PayFort
+    @return: The cache key, or None if the response misses the fort_id, the status or the signature
+    """
+    fort_id = response_data.get("fort_id")
+    status = response_data.get("status")
+    signature = response_data.get("signature")
+    if not (fort_id and status and signature):
+        return None
+
+    return f"{KEY_PREFIX}:{fort_id}:{status}:{signature}"
+
+
+def is_seen(response_data):
+    """
+    Check whether the given response was already processed, and count it when it was.
+
+    @param response_data: The verified response data from PayFort
+    @return: True if the response was already processed, False otherwise
+    """
+    key = get_key(response_data)
+    if key is None or not cache.get(key):
+        return False
+
+    duplicate_stats.record()
+    instrumentation.increment("callback.duplicate")
+    return True
+
+
+def mark_seen(response_data):
+    """
+    Remember that the given response was processed.
+
+    @param response_data: The verified response data from PayFort
+    """
+    key = get_key(response_data)
+    if key is not None:
+        cache.set(key, True, TTL)
@@ -0,0 +1,266 @@
+"""
+Stage-level timing instrumentation of the PayFort views and processor.
+
+Each instrumented stage reports its duration and the number of database queries it ran to the sink configured in the
+PAYFORT_INSTRUMENTATION_SINK setting. The default sink drops everything, and the stages then skip the measurement.
+The logging and in-memory sinks aggregate the measurements of each stage into a duration histogram and a query count
+histogram.
+"""
+import bisect
+import contextlib
+import functools
+import logging
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import connection
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SINK = "ecommerce_payfort.instrumentation.NoOpSink"
+SINK_SETTING = "PAYFORT_INSTRUMENTATION_SINK"
+
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+
+class Histogram:
+    """
+    Bucketed counts of the observed values.
+
+    Each bucket counts the values up to its bound and above the bound of the previous bucket. The last bucket counts
+    the values above the largest bound.
+    """
+    def __init__(self, bounds):
+        """
+        Initialize the histogram.
+
+        @param bounds: The ascending upper bounds of the buckets
+        """
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        """
+        Count the given value in its bucket.
+
+        @param value: The observed value
+        """
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def as_dict(self):
+        """Return the number and the sum of the values, and the bucket counts keyed by bound, the last one by +Inf."""
+        buckets = {str(bound): count for bound, count in zip(self.bounds, self.counts)}
+        buckets["+Inf"] = self.counts[-1]
+        return {"count": self.count, "sum": self.sum, "buckets": buckets}
+
+
+class NoOpSink:
+    """Sink that drops all the measurements. This is the default sink."""
+    def observe(self, stage_name, duration, queries):
+        """
+        Record the measurement of a stage.
+
+        @param stage_name: The stage name
+        @param duration: The duration of the stage in seconds
+        @param queries: The number of database queries run by the stage
+        """
+
+    def increment(self, counter_name, value=1):
+        """
+        Increment a counter.
+
+        @param counter_name: The counter name
+        @param value: The increment
+        """
+
+
+class HistogramSink(NoOpSink):
+    """Base class of the sinks that aggregate the measurements of each stage into histograms."""
+    duration_buckets = DURATION_BUCKETS
+    query_buckets = QUERY_BUCKETS
+
+    def __init__(self):
+        """Initialize the sink."""
+        self._lock = threading.Lock()
+        self._histograms = {}
+
+    def _add_to_histograms(self, stage_name, duration, queries):
+        """
+        Add the measurement of a stage to its histograms. The caller must hold the lock.
+
+        @return: The duration histogram and the query count histogram of the stage
+        """
+        histograms = self._histograms.get(stage_name)
+        if histograms is None:
+            histograms = (Histogram(self.duration_buckets), Histogram(self.query_buckets))
+            self._histograms[stage_name] = histograms
+
+        histograms[0].observe(duration)
+        histograms[1].observe(queries)
+        return histograms
+
+    def observe(self, stage_name, duration, queries):
+        """Add the measurement of a stage to its histograms."""
+        with self._lock:
+            self._add_to_histograms(stage_name, duration, queries)
+
+    def histograms(self, stage_name):
+        """
+        Return the histograms of the given stage.
+
+        @param stage_name: The stage name
+        @return: The duration histogram, in seconds, and the query count histogram as dictionaries, or None
+        """
+        with self._lock:
+            histograms = self._histograms.get(stage_name)
+            if histograms is None:
+                return None
+
+            return {"duration": histograms[0].as_dict(), "queries": histograms[1].as_dict()}
+
+
+class LoggingSink(HistogramSink):
+    """
+    Sink that logs the histograms of each stage once every log_interval measurements of the stage.
+
+    The histograms of a stage start over once logged. Call flush() to log the histograms not logged yet.
+    """
+    log_interval = 100
+
+    def observe(self, stage_name, duration, queries):
+        """Add the measurement of a stage to its histograms, and log them when the interval is reached."""
+        with self._lock:
+            duration_histogram, _ = self._add_to_histograms(stage_name, duration, queries)
+            if duration_histogram.count < self.log_interval:
+                return
+            histograms = self._histograms.pop(stage_name)
+
+        self._log_histograms(stage_name, histograms)
+
+    def flush(self):
+        """Log the histograms of all the stages, and start them over."""
+        with self._lock:
+            all_histograms, self._histograms = self._histograms, {}
+
+        for stage_name, histograms in all_histograms.items():
+            self._log_histograms(stage_name, histograms)
+
+    @staticmethod
+    def _log_histograms(stage_name, histograms):
+        """Log the duration and the query count histograms of a stage."""
+        logger.info(
+            "PayFort stage %s histograms. Duration (s): %s. Queries: %s",
+            stage_name, histograms[0].as_dict(), histograms[1].as_dict(),
+        )
+
+    def increment(self, counter_name, value=1):
+        """Log the counter increment."""
+        logger.info("PayFort counter %s incremented by %d", counter_name, value)
+
+
+class InMemorySink(HistogramSink):
+    """Sink that keeps all the measurements in memory, along with their histograms. Meant for tests and benchmarks."""
+    def __init__(self):
+        """Initialize the sink."""
+        super().__init__()
+        self.observations = defaultdict(list)
+        self.counters = defaultdict(int)
+
+    def observe(self, stage_name, duration, queries):
+        """Keep the measurement of a stage, and add it to its histograms."""
+        with self._lock:
+            self._add_to_histograms(stage_name, duration, queries)
+            self.observations[stage_name].append((duration, queries))
+
+    def increment(self, counter_name, value=1):
+        """Increment the counter."""
+        with self._lock:
+            self.counters[counter_name] += value
+
+    def durations(self, stage_name):
+        """
+        Return the durations observed for the given stage.
+
+        @param stage_name: The stage name
+        @return: The list of durations in seconds
+        """
+        with self._lock:
+            return [duration for duration, _ in self.observations.get(stage_name, [])]
+
+    def queries(self, stage_name):
+        """
+        Return the numbers of queries observed for the given stage.
+
+        @param stage_name: The stage name
+        @return: The list of query counts
+        """
+        with self._lock:
+            return [queries for _, queries in self.observations.get(stage_name, [])]
+
+    def clear(self):
+        """Drop all the measurements."""
+        with self._lock:
+            self._histograms.clear()
+            self.observations.clear()
+            self.counters.clear()
+
+
+class QueryCounter:
+    """Database execute wrapper that counts the queries."""
+    def __init__(self):
+        """Initialize the counter."""
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):  # pylint: disable=too-many-arguments
+        """Count the query, then run it."""
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+@functools.lru_cache(maxsize=None)
+def get_sink():
+    """
+    Return the sink configured in the PAYFORT_INSTRUMENTATION_SINK setting.
+
+    @return: The sink instance
+    """
+    return import_string(getattr(settings, SINK_SETTING, DEFAULT_SINK))()
+
+
+@contextlib.contextmanager
+def stage(stage_name):
+    """
+    Measure the duration and the database queries of the enclosed block, and report them to the sink.
+
+    @param stage_name: The stage name
+    """
+    sink = get_sink()
+    if type(sink) is NoOpSink:  # pylint: disable=unidiomatic-typecheck
+        yield
+        return
+
+    query_counter = QueryCounter()
+    start = time.perf_counter()
+    try:
+        with connection.execute_wrapper(query_counter):
+            yield
+    finally:
+        sink.observe(stage_name, time.perf_counter() - start, query_counter.count)
+
+
+def increment(counter_name, value=1):
+    """
+    Increment a counter of the sink.
+
+    @param counter_name: The counter name
+    @param value: The increment
+    """
+    get_sink().increment(counter_name, value)
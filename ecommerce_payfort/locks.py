@@ -0,0 +1,123 @@
+"""
+Per-payment locks that keep the PayFort callbacks of the same payment from placing the order concurrently.
+
+The locks are built on the Django cache, so a shared backend serializes the callbacks landing on different workers
+and nodes. A lock expires after its timeout, so a crashed holder never blocks the payment for good. The timeout
+must be longer than the slowest order placement, otherwise a second callback may place the order concurrently.
+"""
+import contextlib
+import logging
+import threading
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+
+from ecommerce_payfort import instrumentation
+
+logger = logging.getLogger(__name__)
+
+LOCK_KEY_PREFIX = "payfort_lock"
+LOCK_TIMEOUT_SETTING = "PAYFORT_PAYMENT_LOCK_TIMEOUT"
+DEFAULT_LOCK_TIMEOUT = 600
+
+
+class LockStats:
+    """Thread-safe counters of the lock acquisitions of the current process."""
+    def __init__(self):
+        """Initialize the counters."""
+        self._lock = threading.Lock()
+        self.acquired = 0
+        self.contended = 0
+
+    def record(self, acquired):
+        """
+        Count a lock attempt.
+
+        @param acquired: Whether the lock was acquired
+        """
+        with self._lock:
+            if acquired:
+                self.acquired += 1
+            else:
+                self.contended += 1
+
+    def as_dict(self):
+        """Return the counters as a dictionary."""
+        with self._lock:
+            return {"acquired": self.acquired, "contended": self.contended}
+
+    def reset(self):
+        """Reset the counters."""
+        with self._lock:
+            self.acquired = 0
+            self.contended = 0
+
+
+lock_stats = LockStats()
+
+
+def get_lock_timeout():
+    """Return the number of seconds after which a payment lock expires."""
+    return getattr(settings, LOCK_TIMEOUT_SETTING, DEFAULT_LOCK_TIMEOUT)
+
+
+def get_lock_key(merchant_reference):
+    """
+    Return the cache key of the lock of the given merchant reference.
+
+    @param merchant_reference: The merchant reference
+    @return: The cache key
+    """
+    return f"{LOCK_KEY_PREFIX}:{merchant_reference}"
+
+
+def acquire_lock(merchant_reference, timeout=None):
+    """
+    Try to acquire the lock of the given merchant reference without waiting.
+
+    @param merchant_reference: The merchant reference
+    @param timeout: Number of seconds after which the lock expires, defaults to the lock timeout setting
+    @return: The token of the acquired lock, or None if the lock is held by someone else
+    """
+    if timeout is None:
+        timeout = get_lock_timeout()
+
+    token = uuid.uuid4().hex
+    acquired = cache.add(get_lock_key(merchant_reference), token, timeout)
+    lock_stats.record(acquired)
+    instrumentation.increment("lock.acquired" if acquired else "lock.contended")
+    if not acquired:
+        logger.info("PayFort lock contention on merchant_reference: %s", merchant_reference)
+        return None
+
+    return token
+
+
+def release_lock(merchant_reference, token):
+    """
+    Release the lock of the given merchant reference, unless it has expired and has been acquired by someone else.
+
+    @param merchant_reference: The merchant reference
+    @param token: The token returned by acquire_lock
+    """
+    key = get_lock_key(merchant_reference)
+    if cache.get(key) == token:
+        cache.delete(key)
+
+
+@contextlib.contextmanager
+def payment_lock(merchant_reference, timeout=None):
+    """
+    Hold the lock of the given merchant reference, if available, for the duration of the block.
+
+    @param merchant_reference: The merchant reference
+    @param timeout: Number of seconds after which the lock expires, defaults to the lock timeout setting
+    @return: A context manager yielding True if the lock was acquired, False otherwise
+    """
+    token = acquire_lock(merchant_reference, timeout)
+    try:
+        yield token is not None
+    finally:
+        if token is not None:
+            release_lock(merchant_reference, token)
@@ -0,0 +1,67 @@
+"""Backfill the PayFortTransaction table from the existing PayFort processor responses."""
+from django.core.management.base import BaseCommand
+from oscar.core.loading import get_model
+
+from ecommerce_payfort.models import PayFortTransaction
+from ecommerce_payfort.processors import PayFort
+from ecommerce_payfort.utils import get_recorded_response_data
+
+PaymentProcessorResponse = get_model("payment", "PaymentProcessorResponse")
+
+
+class Command(BaseCommand):
+    """Backfill the PayFortTransaction table from the existing PayFort processor responses."""
+    help = "Backfill the PayFortTransaction table from the existing PayFort processor responses."
+
+    def add_arguments(self, parser):
+        """Add the command arguments."""
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=1000,
+            help="Number of processor responses read and written at once.",
+        )
+        parser.add_argument(
+            "--start-id",
+            type=int,
+            default=0,
+            help="Only backfill the processor responses with an ID greater than this one, to resume a backfill.",
+        )
+
+    def handle(self, *args, **options):
+        """Stream the processor responses in chunks, and bulk create their missing transactions."""
+        chunk_size = options["chunk_size"]
+        responses = PaymentProcessorResponse.objects.filter(
+            processor_name=PayFort.NAME,
+            id__gt=options["start_id"],
+        ).order_by("id").values_list("id", "response", "basket_id", "created")
+
+        created = 0
+        last_id = options["start_id"]
+        chunk = []
+        for response_id, response, basket_id, response_created in responses.iterator(chunk_size=chunk_size):
+            chunk.append(PayFortTransaction.build(
+                response_id,
+                get_recorded_response_data(response),
+                basket_id=basket_id,
+                created=response_created,
+            ))
+            last_id = response_id
+            if len(chunk) >= chunk_size:
+                created += self._write_chunk(chunk, last_id)
+                chunk = []
+
+        if chunk:
+            created += self._write_chunk(chunk, last_id)
+
+        self.stdout.write(f"Backfilled {created} PayFort transactions. Last processor response ID: {last_id}")
+
+    def _write_chunk(self, chunk, last_id):
+        """Create the transactions of the chunk that don't exist yet, and report the progress."""
+        existing_ids = set(PayFortTransaction.objects.filter(
+            processor_response_id__in=[transaction.processor_response_id for transaction in chunk],
+        ).values_list("processor_response_id", flat=True))
+        missing = [transaction for transaction in chunk if transaction.processor_response_id not in existing_ids]
+        PayFortTransaction.objects.bulk_create(missing, batch_size=len(chunk))
+        self.stdout.write(f"Processed processor responses up to ID {last_id}: {len(missing)} transactions created")
+        return len(missing)
@@ -0,0 +1,127 @@
+"""Check the status of PayFort payments with the CHECK_STATUS query, and record the results."""
+import collections
+import json
+import time
+
+from django.contrib.sites.models import Site
+from django.core.management.base import BaseCommand, CommandError
+
+from ecommerce_payfort.async_client import AsyncPayFortAPIClient
+from ecommerce_payfort.models import PayFortStatusCheck
+from ecommerce_payfort.processors import PayFort
+
+
+class Command(BaseCommand):
+    """Check the status of PayFort payments with the CHECK_STATUS query, and record the results."""
+    help = (
+        "Check the status of the PayFort payments of the given merchant references with concurrent CHECK_STATUS "
+        "queries, and record the results as PayFortStatusCheck rows. Prints a JSON summary."
+    )
+
+    def add_arguments(self, parser):
+        """Add the command arguments."""
+        parser.add_argument(
+            "merchant_references",
+            nargs="*",
+            help="The merchant references of the payments.",
+        )
+        parser.add_argument(
+            "--file",
+            default=None,
+            help="Read the merchant references from this file, one per line.",
+        )
+        parser.add_argument(
+            "--site-id",
+            type=int,
+            required=True,
+            help="ID of the site whose PayFort configuration is used to query the API.",
+        )
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            default=AsyncPayFortAPIClient.CONCURRENCY,
+            help="Maximum number of queries in flight.",
+        )
+        parser.add_argument(
+            "--rate-limit",
+            type=float,
+            default=None,
+            help=(
+                "Maximum number of queries sent per second, to respect the quota of the gateway. "
+                "May be fractional, e.g. 0.5 for one query every two seconds."
+            ),
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=500,
+            help="Number of results written to the database at once.",
+        )
+
+    @staticmethod
+    def read_merchant_references(merchant_references, path=None):
+        """
+        Return the merchant references given as arguments, followed by the ones of the file, without duplicates.
+
+        @param merchant_references: The merchant references given as arguments
+        @param path: The path of the file of merchant references, if any
+        @return: The list of merchant references
+        """
+        merchant_references = list(merchant_references)
+        if path:
+            with open(path, encoding="utf-8") as references_file:
+                merchant_references.extend(line.strip() for line in references_file)
+
+        return list(dict.fromkeys(reference for reference in merchant_references if reference))
+
+    def handle(self, *args, **options):
+        """Stream the results of the queries, and bulk create their status checks."""
+        merchant_references = self.read_merchant_references(options["merchant_references"], options["file"])
+        if not merchant_references:
+            raise CommandError("No merchant references to check.")
+
+        if options["rate_limit"] is not None and options["rate_limit"] <= 0:
+            raise CommandError(f"The rate limit must be positive: {options['rate_limit']}")
+
+        try:
+            site = Site.objects.get(id=options["site_id"])
+        except Site.DoesNotExist as exc:
+            raise CommandError(f"Site not found: {options['site_id']}") from exc
+
+        client = AsyncPayFortAPIClient.from_processor(
+            PayFort(site),
+            concurrency=options["concurrency"],
+            rate_limit=options["rate_limit"],
+        )
+
+        start = time.monotonic()
+        transaction_statuses = collections.Counter()
+        failed = 0
+        chunk = []
+        for merchant_reference, result in client.stream_check_status(merchant_references):
+            status_check = PayFortStatusCheck.build(merchant_reference, result)
+            if status_check.error:
+                failed += 1
+            else:
+                transaction_statuses[status_check.transaction_status] += 1
+            chunk.append(status_check)
+            if len(chunk) >= options["batch_size"]:
+                self._write_chunk(chunk)
+                chunk = []
+
+        if chunk:
+            self._write_chunk(chunk)
+
+        duration = time.monotonic() - start
+        self.stdout.write(json.dumps({
+            "checked": len(merchant_references),
+            "failed": failed,
+            "transaction_statuses": dict(transaction_statuses),
+            "duration": round(duration, 3),
+            "queries_per_second": round(len(merchant_references) / duration, 1) if duration else None,
+        }, indent=2))
+
+    def _write_chunk(self, chunk):
+        """Create the status checks of the chunk, and report the progress."""
+        PayFortStatusCheck.objects.bulk_create(chunk, batch_size=len(chunk))
+        self.stderr.write(f"Recorded {len(chunk)} status checks")
@@ -0,0 +1,210 @@
+"""Place the orders of the baskets left frozen after a successful PayFort payment."""
+import argparse
+import itertools
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from oscar.core.loading import get_model
+
+from ecommerce_payfort import orders
+from ecommerce_payfort.models import PayFortTransaction
+from ecommerce_payfort.utils import SUCCESS_STATUS, get_recorded_response_data, parse_merchant_reference
+
+Basket = get_model("basket", "Basket")
+PaymentProcessorResponse = get_model("payment", "PaymentProcessorResponse")
+
+
+def parse_since(value):
+    """
+    Parse the --since argument. A date stands for its midnight, and a naive value is in the current time zone.
+
+    @param value: The ISO 8601 date, or date and time
+    @return: The timezone-aware date and time
+    """
+    try:
+        since = parse_datetime(value)
+        if since is None:
+            since_date = parse_date(value)
+            if since_date is not None:
+                since = datetime.combine(since_date, datetime.min.time())
+    except ValueError:
+        since = None
+
+    if since is None:
+        raise argparse.ArgumentTypeError(f"Invalid ISO 8601 date or date and time: {value}")
+
+    if timezone.is_naive(since):
+        since = timezone.make_aware(since)
+
+    return since
+
+
+class Command(BaseCommand):
+    """Place the orders of the baskets left frozen after a successful PayFort payment."""
+    help = (
+        "Place the orders of the baskets left frozen after a successful PayFort payment, using the latest "
+        "successful response recorded for each basket. Prints a JSON summary."
+    )
+
+    def add_arguments(self, parser):
+        """Add the command arguments."""
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=500,
+            help="Number of baskets read and processed at once.",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=4,
+            help="Number of worker threads placing the orders. Use 1 to place them in the main thread.",
+        )
+        parser.add_argument(
+            "--since",
+            type=parse_since,
+            default=None,
+            help="Only consider the successful payments recorded since this ISO 8601 date, or date and time.",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="List the baskets that would be reconciled without placing their orders.",
+        )
+
+    @staticmethod
+    def get_candidates(since=None):
+        """
+        Return the frozen baskets that have a successful PayFort payment.
+
+        @param since: Only consider the payments recorded since this date and time
+        @return: A queryset of basket IDs ordered by basket ID
+        """
+        transactions = PayFortTransaction.objects.filter(status=SUCCESS_STATUS, basket_id__isnull=False)
+        if since is not None:
+            transactions = transactions.filter(created__gte=since)
+
+        return Basket.objects.filter(
+            status=Basket.FROZEN,
+            id__in=transactions.values("basket_id"),
+        ).order_by("id").values_list("id", flat=True)
+
+    @staticmethod
+    def get_latest_responses(basket_ids):
+        """
+        Return the latest successful response data of each of the given baskets, in two queries.
+
+        @param basket_ids: The basket IDs
+        @return: A dictionary of response data keyed by basket ID
+        """
+        latest_response_ids = dict(PayFortTransaction.objects.filter(
+            status=SUCCESS_STATUS,
+            basket_id__in=basket_ids,
+        ).order_by("basket_id", "created", "id").values_list("basket_id", "processor_response_id"))
+
+        responses = dict(PaymentProcessorResponse.objects.filter(
+            id__in=latest_response_ids.values(),
+        ).values_list("id", "response"))
+
+        return {
+            basket_id: get_recorded_response_data(responses.get(response_id))
+            for basket_id, response_id in latest_response_ids.items()
+        }
+
+    @staticmethod
+    def place_order(site_id, basket_id, response_data):
+        """
+        Place the order of the basket once. The basket is locked, and skipped if already submitted.
+
+        @param site_id: The site ID
+        @param basket_id: The basket ID
+        @param response_data: The successful response data from PayFort
+        @return: The job status
+        """
+        return orders.EagerOrderQueue().execute(site_id, basket_id, response_data)
+
+    def place_order_in_worker(self, site_id, basket_id, response_data):
+        """Place the order of the basket, then close the database connections of the worker thread."""
+        try:
+            return self.place_order(site_id, basket_id, response_data)
+        finally:
+            connections.close_all()
+
+    def handle(self, *args, **options):
+        """Stream the candidate baskets in chunks, and place their orders in a pool of worker threads."""
+        start = time.monotonic()
+        summary = {
+            "dry_run": options["dry_run"],
+            "candidates": 0,
+            "missing_response": 0,
+            "bad_reference": 0,
+            orders.JOB_SUCCEEDED: 0,
+            orders.JOB_SKIPPED: 0,
+            orders.JOB_FAILED: 0,
+            "failures": [],
+            "basket_ids": [],
+        }
+
+        executor = None
+        if options["workers"] > 1 and not options["dry_run"]:
+            executor = ThreadPoolExecutor(max_workers=options["workers"], thread_name_prefix="payfort-reconcile")
+
+        candidates = self.get_candidates(options["since"]).iterator(chunk_size=options["chunk_size"])
+        try:
+            while True:
+                chunk = list(itertools.islice(candidates, options["chunk_size"]))
+                if not chunk:
+                    break
+                self.process_chunk(chunk, summary, executor)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+        summary["duration"] = round(time.monotonic() - start, 3)
+        self.stdout.write(json.dumps(summary, indent=2))
+
+    def process_chunk(self, chunk, summary, executor):
+        """
+        Reconcile a chunk of basket IDs, and update the summary.
+
+        The order is placed for the site of the merchant reference, as the feedback view does, since the basket may
+        have no site.
+        """
+        responses = self.get_latest_responses(chunk)
+        jobs = []
+        for basket_id in chunk:
+            summary["candidates"] += 1
+            response_data = responses.get(basket_id)
+            if not response_data:
+                summary["missing_response"] += 1
+                continue
+
+            basket_reference = parse_merchant_reference(response_data.get("merchant_reference"))
+            if basket_reference is None or basket_reference[2] != basket_id:
+                summary["bad_reference"] += 1
+                continue
+            site_id = basket_reference[0]
+
+            summary["basket_ids"].append(basket_id)
+            if summary["dry_run"]:
+                continue
+
+            if executor is None:
+                jobs.append((basket_id, self.place_order(site_id, basket_id, response_data)))
+            else:
+                jobs.append((basket_id, executor.submit(self.place_order_in_worker, site_id, basket_id, response_data)))
+
+        for basket_id, result in jobs:
+            status = result if executor is None else result.result()
+            summary[status] += 1
+            if status == orders.JOB_FAILED:
+                summary["failures"].append({
+                    "basket_id": basket_id,
+                    "error": (orders.get_job_state(basket_id) or {}).get("error"),
+                })
@@ -0,0 +1,92 @@
+"""Refund orders paid with PayFort in bulk, with a resumable refund job."""
+import json
+
+from django.contrib.sites.models import Site
+from django.core.management.base import BaseCommand, CommandError
+from oscar.core.loading import get_model
+
+from ecommerce_payfort.processors import PayFort
+from ecommerce_payfort.refunds import RefundJob
+
+Order = get_model("order", "Order")
+
+
+class Command(BaseCommand):
+    """Refund orders paid with PayFort in bulk, with a resumable refund job."""
+    help = (
+        "Refund the full amount of the given orders paid with PayFort, in a pool of worker threads. The progress is "
+        "recorded per job ID: run the command again with the same job ID to resume it. Prints a JSON summary."
+    )
+
+    def add_arguments(self, parser):
+        """Add the command arguments."""
+        parser.add_argument(
+            "order_numbers",
+            nargs="*",
+            help="The numbers of the orders to refund.",
+        )
+        parser.add_argument(
+            "--file",
+            default=None,
+            help="Read the numbers of the orders to refund from this file, one per line.",
+        )
+        parser.add_argument(
+            "--course-id",
+            default=None,
+            help="Refund the orders of this course run, e.g. when it's cancelled.",
+        )
+        parser.add_argument(
+            "--job-id",
+            required=True,
+            help="ID of the refund job. Each order is refunded once, the ones refunded by another job are skipped.",
+        )
+        parser.add_argument(
+            "--site-id",
+            type=int,
+            required=True,
+            help="ID of the site whose orders are refunded, with its PayFort configuration.",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=4,
+            help="Number of worker threads issuing the refunds. Use 1 to issue them in the main thread.",
+        )
+
+    @staticmethod
+    def get_orders(site, order_numbers, course_id=None):
+        """
+        Return the orders of the given site paid with PayFort that match the given order numbers or course run.
+
+        The refunds are signed with the PayFort configuration of the site, and their merchant references are built
+        from its ID, so the orders of other sites are left out.
+
+        @param site: The site
+        @param order_numbers: The order numbers
+        @param course_id: The course run ID
+        @return: The queryset of orders
+        """
+        orders = Order.objects.filter(site=site, sources__source_type__name=PayFort.NAME)
+        if order_numbers:
+            orders = orders.filter(number__in=order_numbers)
+        if course_id:
+            orders = orders.filter(lines__product__course_id=course_id)
+        return orders.distinct()
+
+    def handle(self, *args, **options):
+        """Run the refund job, and print its summary."""
+        order_numbers = list(options["order_numbers"])
+        if options["file"]:
+            with open(options["file"], encoding="utf-8") as numbers_file:
+                order_numbers.extend(line.strip() for line in numbers_file if line.strip())
+        if not order_numbers and not options["course_id"]:
+            raise CommandError("No orders to refund. Give order numbers, --file or --course-id.")
+
+        try:
+            site = Site.objects.get(id=options["site_id"])
+        except Site.DoesNotExist as exc:
+            raise CommandError(f"Site not found: {options['site_id']}") from exc
+
+        job = RefundJob(options["job_id"], PayFort(site), max_workers=options["workers"])
+        summary = job.run(self.get_orders(site, order_numbers, options["course_id"]))
+        self.stdout.write(json.dumps(summary, indent=2))
@@ -0,0 +1,31 @@
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PayFortTransaction',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('processor_response_id', models.PositiveIntegerField(unique=True)),
+                ('merchant_reference', models.CharField(db_index=True, max_length=64)),
+                ('basket_id', models.PositiveIntegerField(db_index=True, null=True)),
+                ('fort_id', models.CharField(db_index=True, max_length=64)),
+                ('eci', models.CharField(max_length=32)),
+                ('status', models.CharField(db_index=True, max_length=8)),
+                ('response_code', models.CharField(db_index=True, max_length=16)),
+                ('amount', models.PositiveIntegerField(null=True)),
+                ('created', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+            ],
+            options={
+                'get_latest_by': 'created',
+            },
+        ),
+    ]
@@ -0,0 +1,30 @@
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ecommerce_payfort', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PayFortStatusCheck',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('merchant_reference', models.CharField(db_index=True, max_length=64)),
+                ('basket_id', models.PositiveIntegerField(db_index=True, null=True)),
+                ('fort_id', models.CharField(max_length=64)),
+                ('status', models.CharField(max_length=8)),
+                ('response_code', models.CharField(max_length=16)),
+                ('transaction_status', models.CharField(db_index=True, max_length=8)),
+                ('amount', models.PositiveIntegerField(null=True)),
+                ('error', models.TextField(blank=True)),
+                ('checked', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+            ],
+            options={
+                'get_latest_by': 'checked',
+            },
+        ),
+    ]
@@ -0,0 +1,201 @@
+"""Models of the PayFort payment processor."""
+from django.db import models
+from django.utils import timezone
+
+# The largest value a PositiveIntegerField holds on every database backend
+MAX_POSITIVE_INTEGER = 2147483647
+
+
+def _get_text(response_data, key, max_length):
+    """Return the text value of the given key, truncated to the given length."""
+    return str(response_data.get(key) or "")[:max_length]
+
+
+def _get_int(value):
+    """Return the value as a non-negative integer that fits a PositiveIntegerField, or None if it's not one."""
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        return None
+    return value if 0 <= value <= MAX_POSITIVE_INTEGER else None
+
+
+def _get_basket_id(merchant_reference):
+    """Return the basket ID read from the given merchant reference, or None if it has none."""
+    return _get_int(merchant_reference.split("-")[-1])
+
+
+class PayFortTransaction(models.Model):
+    """
+    Normalized copy of the PayFort responses recorded as payment processor responses.
+
+    The fields are indexed so that the payments can be looked up without scanning the JSON of the processor responses.
+    The IDs of the basket and of the processor response are kept as plain integers to keep the migrations of this app
+    independent of the migrations of ecommerce.
+    """
+    processor_response_id = models.PositiveIntegerField(unique=True)
+    merchant_reference = models.CharField(max_length=64, db_index=True)
+    basket_id = models.PositiveIntegerField(null=True, db_index=True)
+    fort_id = models.CharField(max_length=64, db_index=True)
+    eci = models.CharField(max_length=32)
+    status = models.CharField(max_length=8, db_index=True)
+    response_code = models.CharField(max_length=16, db_index=True)
+    amount = models.PositiveIntegerField(null=True)
+    created = models.DateTimeField(default=timezone.now, db_index=True)
+
+    class Meta:
+        app_label = "ecommerce_payfort"
+        get_latest_by = "created"
+
+    def __str__(self):
+        """Return the string representation of the transaction."""
+        return f"{self.merchant_reference} ({self.fort_id}): {self.status}"
+
+    @classmethod
+    def build(cls, processor_response_id, response_data, basket_id=None, created=None):
+        """
+        Build an unsaved transaction from the given response data.
+
+        The response data is read leniently, since responses with a bad format are recorded too. The values that
+        don't fit their column are left out, so that saving the transaction never rolls back the recorded payment
+        processor response.
+
+        @param processor_response_id: The ID of the recorded payment processor response
+        @param response_data: The response data from PayFort
+        @param basket_id: The basket ID, read from the merchant reference when not given
+        @param created: The creation time, now when not given
+        @return: The unsaved transaction
+        """
+        merchant_reference = _get_text(response_data, "merchant_reference", 64)
+        if basket_id is None:
+            basket_id = _get_basket_id(merchant_reference)
+
+        return cls(
+            processor_response_id=processor_response_id,
+            merchant_reference=merchant_reference,
+            basket_id=basket_id,
+            fort_id=_get_text(response_data, "fort_id", 64),
+            eci=_get_text(response_data, "eci", 32),
+            status=_get_text(response_data, "status", 8),
+            response_code=_get_text(response_data, "response_code", 16),
+            amount=_get_int(response_data.get("amount")),
+            created=created or timezone.now(),
+        )
+
+    @classmethod
+    def record(cls, processor_response, response_data):
+        """
+        Save the transaction of the given recorded payment processor response.
+
+        @param processor_response: The recorded payment processor response
+        @param response_data: The response data from PayFort
+        @return: The saved transaction
+        """
+        transaction = cls.build(
+            processor_response.id,
+            response_data,
+            basket_id=processor_response.basket_id,
+            created=processor_response.created,
+        )
+        transaction.save()
+        return transaction
+
+
+class PayFortStatusCheck(models.Model):
+    """
+    Result of a CHECK_STATUS query of a payment, sent by a reconciliation run.
+
+    A failed query is recorded with its error and without a status.
+    """
+    merchant_reference = models.CharField(max_length=64, db_index=True)
+    basket_id = models.PositiveIntegerField(null=True, db_index=True)
+    fort_id = models.CharField(max_length=64)
+    status = models.CharField(max_length=8)
+    response_code = models.CharField(max_length=16)
+    transaction_status = models.CharField(max_length=8, db_index=True)
+    amount = models.PositiveIntegerField(null=True)
+    error = models.TextField(blank=True)
+    checked = models.DateTimeField(default=timezone.now, db_index=True)
+
+    class Meta:
+        app_label = "ecommerce_payfort"
+        get_latest_by = "checked"
+
+    def __str__(self):
+        """Return the string representation of the status check."""
+        return f"{self.merchant_reference}: {self.transaction_status or self.error}"
+
+    @classmethod
+    def build(cls, merchant_reference, result, checked=None):
+        """
+        Build an unsaved status check from the result of the query.
+
+        @param merchant_reference: The merchant reference of the payment
+        @param result: The response data from PayFort, or the exception raised by the query
+        @param checked: The time of the check, now when not given
+        @return: The unsaved status check
+        """
+        merchant_reference = str(merchant_reference)[:64]
+        status_check = cls(
+            merchant_reference=merchant_reference,
+            basket_id=_get_basket_id(merchant_reference),
+            checked=checked or timezone.now(),
+        )
+        if isinstance(result, Exception):
+            status_check.error = str(result)
+            return status_check
+
+        status_check.fort_id = _get_text(result, "fort_id", 64)
+        status_check.status = _get_text(result, "status", 8)
+        status_check.response_code = _get_text(result, "response_code", 16)
+        status_check.transaction_status = _get_text(result, "transaction_status", 8)
+        status_check.amount = _get_int(result.get("amount"))
+        return status_check
+
+
+class PayFortRefund(models.Model):
+    """
+    Progress of the refund of an order by a bulk refund job.
+
+    The refund is created as pending before it's sent, and keeps its idempotency key across the runs of the job, so a
+    job that was interrupted can be resumed without refunding an order twice.
+    """
+    PENDING = "pending"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+    STATUS_CHOICES = (
+        (PENDING, "Pending"),
+        (SUCCEEDED, "Succeeded"),
+        (FAILED, "Failed"),
+    )
+
+    job_id = models.CharField(max_length=64, db_index=True)
+    order_number = models.CharField(max_length=128)
+    idempotency_key = models.CharField(max_length=200, unique=True)
+    amount = models.DecimalField(max_digits=12, decimal_places=2)
+    currency = models.CharField(max_length=12)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=PENDING, db_index=True)
+    transaction_id = models.CharField(max_length=255, blank=True)
+    error = models.TextField(blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+    created = models.DateTimeField(default=timezone.now)
+    modified = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        app_label = "ecommerce_payfort"
+        unique_together = (("job_id", "order_number"),)
+
+    def __str__(self):
+        """Return the string representation of the refund."""
+        return f"{self.job_id}: {self.order_number} ({self.status})"
+
+    @staticmethod
+    def get_idempotency_key(job_id, order_number):
+        """
+        Return the idempotency key of the refund of the given order by the given job.
+
+        @param job_id: The ID of the refund job
+        @param order_number: The order number
+        @return: The idempotency key, sent as the maintenance reference of the refund
+        """
+        return f"{job_id}-{order_number}"
@@ -0,0 +1,100 @@
+"""Notifiers that wake up the status requests waiting for a basket to be submitted."""
+import functools
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.module_loading import import_string
+
+DEFAULT_NOTIFIER = "ecommerce_payfort.notifiers.CacheNotifier"
+NOTIFIER_SETTING = "PAYFORT_STATUS_NOTIFIER"
+
+
+class BaseNotifier:
+    """Base class of the notifiers."""
+    def notify(self, basket_id):
+        """
+        Signal that the given basket has been submitted.
+
+        @param basket_id: The basket ID
+        """
+        raise NotImplementedError
+
+    def wait(self, basket_id, timeout):
+        """
+        Wait until the given basket is signaled as submitted, or until the timeout is reached.
+
+        @param basket_id: The basket ID
+        @param timeout: Maximum number of seconds to wait
+        @return: True if the basket was signaled as submitted, False otherwise
+        """
+        raise NotImplementedError
+
+
+class CacheNotifier(BaseNotifier):
+    """
+    Notifier built on the Django cache, so it works across workers and nodes when the cache is shared.
+
+    The waiting request checks a single cache key instead of the database, and the browser holds one connection
+    instead of sending a new request on every attempt.
+    """
+    KEY_PREFIX = "payfort_submitted"
+    POLL_INTERVAL = 0.25
+    TTL = 300
+
+    def key(self, basket_id):
+        """Return the cache key of the given basket."""
+        return f"{self.KEY_PREFIX}:{basket_id}"
+
+    def notify(self, basket_id):
+        """Signal that the given basket has been submitted."""
+        cache.set(self.key(basket_id), True, self.TTL)
+
+    def wait(self, basket_id, timeout):
+        """Wait until the given basket is signaled as submitted, or until the timeout is reached."""
+        key = self.key(basket_id)
+        deadline = time.monotonic() + timeout
+        while True:
+            if cache.get(key):
+                return True
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+
+            time.sleep(min(self.POLL_INTERVAL, remaining))
+
+
+class InProcessNotifier(BaseNotifier):
+    """Notifier that only works within a single process. Meant for tests and single-process development servers."""
+    def __init__(self):
+        """Initialize the notifier."""
+        self._condition = threading.Condition()
+        self._submitted = set()
+
+    def notify(self, basket_id):
+        """Signal that the given basket has been submitted."""
+        with self._condition:
+            self._submitted.add(basket_id)
+            self._condition.notify_all()
+
+    def wait(self, basket_id, timeout):
+        """Wait until the given basket is signaled as submitted, or until the timeout is reached."""
+        with self._condition:
+            return self._condition.wait_for(lambda: basket_id in self._submitted, timeout)
+
+    def clear(self):
+        """Forget all the signaled baskets."""
+        with self._condition:
+            self._submitted.clear()
+
+
+@functools.lru_cache(maxsize=None)
+def get_notifier():
+    """
+    Return the notifier configured in the PAYFORT_STATUS_NOTIFIER setting.
+
+    @return: The notifier instance
+    """
+    return import_string(getattr(settings, NOTIFIER_SETTING, DEFAULT_NOTIFIER))()
@@ -0,0 +1,182 @@
+"""
+Cache of the offers applied to the frozen baskets, keyed by basket ID and offers version.
+
+The price of a frozen basket can't change, but every PayFort callback used to apply the offers again, evaluating all
+the site offers and vouchers. Instead, the offers applied when the basket is frozen are recorded, and the callbacks
+apply only those offers again. The recorded total is checked afterwards: when it differs, the offers are applied in
+full as before.
+
+The offers version changes whenever an offer, its condition, benefit or range, or a voucher is created, changed or
+deleted, which drops all the recorded offers at once. Oscar saves the offers and vouchers applied to every order to
+update their usage counters: those saves keep the version. The cache is built on the Django cache framework, so a
+shared backend lets all workers and nodes reuse the recorded offers.
+"""
+import logging
+import uuid
+
+from django.core.cache import cache
+
+from ecommerce_payfort import utils
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = "payfort_offers"
+VERSION_KEY = "payfort_offers_version"
+TTL = 24 * 60 * 60
+USAGE_FIELDS = {
+    "offer.ConditionalOffer": frozenset(("num_applications", "total_discount", "num_orders")),
+    "voucher.Voucher": frozenset(("num_basket_additions", "num_orders", "total_discount")),
+}
+DEFINITION_ATTRIBUTE = "_payfort_offers_definition"
+
+
+def get_offers_version():
+    """
+    Return the current offers version.
+
+    @return: The offers version
+    """
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        cache.add(VERSION_KEY, uuid.uuid4().hex, None)
+        version = cache.get(VERSION_KEY)
+    return version
+
+
+def bump_offers_version():
+    """Change the offers version, which drops all the recorded offers."""
+    cache.set(VERSION_KEY, uuid.uuid4().hex, None)
+
+
+def get_definition(instance):
+    """
+    Return the loaded values of the fields of the given offer or voucher, except its usage counters.
+
+    @param instance: The offer or the voucher
+    @return: The field values keyed by attribute name
+    """
+    usage_fields = USAGE_FIELDS.get(instance._meta.label, frozenset())
+    return {
+        field.attname: instance.__dict__[field.attname]
+        for field in instance._meta.concrete_fields
+        if field.attname in instance.__dict__
+        and field.attname not in usage_fields
+        and not getattr(field, "auto_now", False)
+    }
+
+
+def remember_definition(instance):
+    """
+    Remember the definition of the given offer or voucher, to tell its later saves apart.
+
+    @param instance: The offer or the voucher, as loaded or saved
+    """
+    instance.__dict__[DEFINITION_ATTRIBUTE] = get_definition(instance)
+
+
+def is_definition_changed(instance, update_fields=None):
+    """
+    Return True if the saved offer or voucher changed more than its usage counters, then remember its definition.
+
+    @param instance: The saved offer or voucher
+    @param update_fields: The fields given to save(), if any
+    @return: True if the definition changed, or may have changed
+    """
+    usage_fields = USAGE_FIELDS.get(instance._meta.label, frozenset())
+    if update_fields and set(update_fields) <= usage_fields:
+        return False
+
+    previous = instance.__dict__.get(DEFINITION_ATTRIBUTE)
+    remember_definition(instance)
+    if not previous:
+        return True
+
+    current = instance.__dict__[DEFINITION_ATTRIBUTE]
+    return any(current.get(attname) != value for attname, value in previous.items())
+
+
+def get_key(basket_id):
+    """
+    Return the cache key of the offers applied to the given basket, in the current offers version.
+
+    @param basket_id: The basket ID
+    @return: The cache key
+    """
+    return f"{KEY_PREFIX}:{get_offers_version()}:{basket_id}"
+
+
+def record(basket):
+    """
+    Record the offers applied to the given basket, along with its total, if the basket is frozen.
+
+    @param basket: The basket, with its offers applied
+    """
+    if basket.status != utils.Basket.FROZEN:
+        return
+
+    applied_offers = []
+    for application in basket.offer_applications:
+        offer, voucher = application["offer"], application["voucher"]
+        if offer.pk is None:
+            return
+        applied_offers.append((offer.pk, voucher.pk if voucher is not None else None))
+
+    cache.set(get_key(basket.id), {"offers": applied_offers, "total_incl_tax": basket.total_incl_tax}, TTL)
+
+
+def load_offers(basket, applied_offers):
+    """
+    Load the recorded offers, along with their vouchers.
+
+    @param basket: The basket
+    @param applied_offers: The recorded (offer ID, voucher ID) pairs
+    @return: The offers in the order they were applied, or None if one of them or its voucher no longer exists
+    """
+    offer_model = utils.get_oscar_model("offer", "ConditionalOffer")
+    offers = offer_model.objects.select_related("condition", "benefit").in_bulk(
+        [offer_id for offer_id, _ in applied_offers]
+    )
+    vouchers = {}
+    if any(voucher_id is not None for _, voucher_id in applied_offers):
+        vouchers = {voucher.pk: voucher for voucher in basket.vouchers.all()}
+
+    result = []
+    for offer_id, voucher_id in applied_offers:
+        offer = offers.get(offer_id)
+        if offer is None or (voucher_id is not None and voucher_id not in vouchers):
+            return None
+        if voucher_id is not None:
+            offer.set_voucher(vouchers[voucher_id])
+        result.append(offer)
+    return result
+
+
+def apply_recorded_offers(applicator, basket):
+    """
+    Apply the offers recorded for the given frozen basket, and check that they give the recorded total.
+
+    @param applicator: The offer applicator
+    @param basket: The basket, with its strategy set
+    @return: True if the recorded offers were applied, False if the offers must be applied in full
+    """
+    if basket.status != utils.Basket.FROZEN:
+        return False
+
+    entry = cache.get(get_key(basket.id))
+    if entry is None:
+        return False
+
+    offers = load_offers(basket, entry["offers"])
+    if offers is None:
+        return False
+
+    applicator.apply_offers(basket, offers)
+    if basket.total_incl_tax != entry["total_incl_tax"]:
+        logger.warning(
+            "The recorded offers of the basket [%s] give the total %s instead of %s. Applying all the offers.",
+            basket.id, basket.total_incl_tax, entry["total_incl_tax"],
+        )
+        basket.reset_offer_applications()
+        return False
+
+    return True
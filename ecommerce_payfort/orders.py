@@ -0,0 +1,306 @@
+"""
+Order placement of the PayFort payments, and the pluggable queues that run it out of the request.
+
+When the PAYFORT_ORDER_QUEUE setting is set, the feedback view records the verified response, enqueues a job to place
+the order of the basket, then replies to PayFort straight away. The job is idempotent: a basket that is already
+submitted is skipped, so the job can be retried and enqueued again by PayFort retries.
+"""
+import functools
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.contrib.sites.models import Site
+from django.core.cache import cache
+from django.db import connections
+from django.db.transaction import atomic
+from django.http import HttpRequest
+from django.utils.module_loading import import_string
+from ecommerce.extensions.checkout.mixins import EdxOrderPlacementMixin
+from ecommerce.extensions.checkout.utils import get_receipt_page_url
+from oscar.apps.partner import strategy
+
+from ecommerce_payfort import instrumentation, offer_cache, status_cache, utils
+from ecommerce_payfort.locks import payment_lock
+from ecommerce_payfort.notifiers import get_notifier
+from ecommerce_payfort.processors import get_processor
+
+logger = logging.getLogger(__name__)
+
+
+ORDER_QUEUE_SETTING = "PAYFORT_ORDER_QUEUE"
+
+JOB_STATE_KEY_PREFIX = "payfort_order_job"
+JOB_STATE_TTL = 24 * 60 * 60
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_RETRYING = "retrying"
+JOB_SUCCEEDED = "succeeded"
+JOB_SKIPPED = "skipped"
+JOB_FAILED = "failed"
+
+
+def get_applicator():
+    """Return an offer applicator, with the Applicator class loaded on first use."""
+    return utils.get_oscar_class("offer.applicator", "Applicator")()
+
+
+def prepare_basket(basket, request):
+    """
+    Set the strategy of the basket and apply its offers, ready for the order placement.
+
+    A frozen basket reuses the offers recorded when it was frozen, as long as they give the same total. Otherwise, all
+    the offers are applied, and recorded for the next callbacks.
+
+    @param basket: The basket
+    @param request: The request, used to apply the offers
+    @return: The basket
+    """
+    basket.strategy = strategy.Default()
+    applicator = get_applicator()
+    if offer_cache.apply_recorded_offers(applicator, basket):
+        instrumentation.increment("offers.recorded")
+    else:
+        instrumentation.increment("offers.applied")
+        applicator.apply(basket, basket.owner, request)
+        offer_cache.record(basket)
+    return basket
+
+
+def announce_order(request, basket, merchant_reference, order):
+    """
+    Cache the receipt URL of the placed order, then wake up the status requests waiting for it.
+
+    @param request: The request
+    @param basket: The submitted basket
+    @param merchant_reference: The merchant reference of the payment
+    @param order: The placed order
+    """
+    status_cache.set_receipt_url(
+        merchant_reference,
+        get_receipt_page_url(
+            request=request,
+            site_configuration=basket.site.siteconfiguration,
+            order_number=order.number,
+        ),
+    )
+    get_notifier().notify(basket.id)
+
+
+def build_request(site, user):
+    """
+    Build the request used to place an order outside the request/response cycle.
+
+    @param site: The site of the basket
+    @param user: The owner of the basket
+    @return: The request
+    """
+    request = HttpRequest()
+    request.method = "POST"
+    request.META["HTTP_HOST"] = site.domain
+    request.site = site
+    request.user = user
+    return request
+
+
+class OrderPlacer(EdxOrderPlacementMixin):
+    """Place the order of a basket which payment was verified by the feedback view."""
+    def __init__(self, site):
+        """Initialize the order placer."""
+        self.site = site
+        self.payment_processor = get_processor(site)
+
+    def place(self, basket_id, response_data):
+        """
+        Place the order of the given basket, unless the basket is already submitted.
+
+        The basket is loaded by the full merchant reference of the response, the same way as the callback views do.
+
+        @param basket_id: The basket ID
+        @param response_data: The verified response data from PayFort
+        @return: The order, or None if the basket is already submitted or being placed by another callback
+        """
+        merchant_reference = response_data.get("merchant_reference")
+        basket_reference = utils.parse_merchant_reference(merchant_reference)
+        if basket_reference is None or basket_reference[2] != basket_id:
+            raise utils.PayFortException(
+                f"The merchant reference doesn't match the basket [{basket_id}]: {merchant_reference}"
+            )
+
+        with payment_lock(merchant_reference) as acquired:
+            if not acquired:
+                return None
+
+            basket = utils.load_callback_basket(*basket_reference)
+            if basket is None:
+                raise utils.PayFortException(f"Basket not found! merchant_reference: {merchant_reference}")
+            if basket.status == utils.Basket.SUBMITTED:
+                return None
+
+            request = build_request(self.site, basket.owner)
+            prepare_basket(basket, request)
+            with atomic():
+                self.handle_payment(response_data, basket)
+                order = self.create_order(request, basket)
+
+        announce_order(request, basket, merchant_reference, order)
+        return order
+
+
+def get_job_state_key(basket_id):
+    """
+    Return the cache key of the job state of the given basket.
+
+    @param basket_id: The basket ID
+    @return: The cache key
+    """
+    return f"{JOB_STATE_KEY_PREFIX}:{basket_id}"
+
+
+def get_job_state(basket_id):
+    """
+    Return the state of the order placement job of the given basket.
+
+    @param basket_id: The basket ID
+    @return: A dictionary with the status, the number of attempts and the last error; or None if there is no job
+    """
+    return cache.get(get_job_state_key(basket_id))
+
+
+def set_job_state(basket_id, status, attempts=0, error=None):
+    """
+    Store the state of the order placement job of the given basket.
+
+    @param basket_id: The basket ID
+    @param status: The job status
+    @param attempts: The number of attempts made so far
+    @param error: The error of the last failed attempt
+    """
+    cache.set(
+        get_job_state_key(basket_id),
+        {"status": status, "attempts": attempts, "error": error},
+        JOB_STATE_TTL,
+    )
+
+
+class BaseOrderQueue:
+    """Base class of the order placement queues."""
+    max_attempts = 3
+    retry_delay = 5
+
+    def enqueue(self, site_id, basket_id, response_data):
+        """
+        Enqueue the order placement of the given basket.
+
+        @param site_id: The site ID
+        @param basket_id: The basket ID
+        @param response_data: The verified response data from PayFort
+        """
+        raise NotImplementedError
+
+    def execute(self, site_id, basket_id, response_data):
+        """
+        Run the order placement job of the given basket, retrying it on failures.
+
+        @param site_id: The site ID
+        @param basket_id: The basket ID
+        @param response_data: The verified response data from PayFort
+        @return: The final job status
+        """
+        error = None
+        for attempt in range(1, self.max_attempts + 1):
+            set_job_state(basket_id, JOB_RUNNING, attempt - 1, error)
+            try:
+                order = OrderPlacer(Site.objects.get(id=site_id)).place(basket_id, response_data)
+            except Exception as exc:  # pylint:disable=broad-except
+                error = f"{exc.__class__.__name__}: {str(exc)}"
+                logger.exception(
+                    "Order placement job for basket [%d] failed! Attempt %d of %d. Exception: %s",
+                    basket_id,
+                    attempt,
+                    self.max_attempts,
+                    error,
+                )
+                if attempt < self.max_attempts:
+                    set_job_state(basket_id, JOB_RETRYING, attempt, error)
+                    time.sleep(self.retry_delay * attempt)
+                continue
+
+            status = JOB_SKIPPED if order is None else JOB_SUCCEEDED
+            set_job_state(basket_id, status, attempt)
+            return status
+
+        set_job_state(basket_id, JOB_FAILED, self.max_attempts, error)
+        return JOB_FAILED
+
+
+class EagerOrderQueue(BaseOrderQueue):
+    """Run the order placement job right away in the current thread, without retries. Meant for tests."""
+    max_attempts = 1
+
+    def enqueue(self, site_id, basket_id, response_data):
+        """Run the order placement job of the given basket."""
+        set_job_state(basket_id, JOB_QUEUED)
+        self.execute(site_id, basket_id, response_data)
+
+
+class ThreadPoolOrderQueue(BaseOrderQueue):
+    """
+    Run the order placement jobs in a pool of worker threads of the current process.
+
+    A basket that already has a job in the pool is not enqueued again. The jobs are not persisted: the jobs still queued
+    or running when the process exits, e.g. when the application server recycles or restarts its workers, are lost
+    although PayFort was already acknowledged. Their baskets are left frozen, and their orders must be placed by running
+    the payfort_reconcile_frozen_baskets management command. Use it only along with a scheduled run of that command.
+    """
+    max_workers = 4
+
+    def __init__(self):
+        """Initialize the queue."""
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="payfort-orders")
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def enqueue(self, site_id, basket_id, response_data):
+        """Submit the order placement job of the given basket to the pool."""
+        with self._lock:
+            if basket_id in self._pending:
+                return
+            self._pending.add(basket_id)
+
+        set_job_state(basket_id, JOB_QUEUED)
+        self._executor.submit(self._run, site_id, basket_id, response_data)
+
+    def _run(self, site_id, basket_id, response_data):
+        """Run the job, then release the basket and the database connections of the worker thread."""
+        try:
+            return self.execute(site_id, basket_id, response_data)
+        finally:
+            with self._lock:
+                self._pending.discard(basket_id)
+            connections.close_all()
+
+    def shutdown(self, wait=True):
+        """
+        Stop the worker threads.
+
+        @param wait: Wait for the pending jobs to finish
+        """
+        self._executor.shutdown(wait=wait)
+
+
+@functools.lru_cache(maxsize=None)
+def get_order_queue():
+    """
+    Return the order queue configured in the PAYFORT_ORDER_QUEUE setting.
+
+    @return: The order queue instance, or None to place the orders within the feedback request
+    """
+    queue_class = getattr(settings, ORDER_QUEUE_SETTING, None)
+    if not queue_class:
+        return None
+
+    return import_string(queue_class)()
@@ -1,16 +1,26 @@
 """PayFort payment processor."""
 import logging
-from urllib.parse import urljoin
+import threading
+import uuid
+from collections import OrderedDict
+from decimal import Decimal
+from functools import cached_property
 
+from django.db.transaction import atomic
 from django.middleware.csrf import get_token
-from django.urls import reverse
 from django.utils.translation import ugettext_lazy as _
 from ecommerce.extensions.payment.processors import BasePaymentProcessor, HandledProcessorResponse
+from oscar.apps.payment.exceptions import GatewayError
 
-from ecommerce_payfort import utils
+from ecommerce_payfort import instrumentation, offer_cache, routes, utils
+from ecommerce_payfort.client import DEFAULT_API_URL, REFUND_COMMAND, REFUND_SUCCESS, PayFortAPIClient
+from ecommerce_payfort.models import PayFortTransaction
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_GATEWAY_URL = "https://sbcheckout.payfort.com/FortAPI/paymentPage"
+PROCESSOR_CACHE_SIZE = 128
+
 
 class PayFort(BasePaymentProcessor):
     """
@@ -33,58 +43,201 @@ class PayFort(BasePaymentProcessor):
         self.response_sha_phrase = self.configuration.get("response_sha_phrase")
         self.sha_method = self.configuration.get("sha_method")
         self.ecommerce_url_root = self.configuration.get("ecommerce_url_root")
+        self.api_url = self.configuration.get("api_url", DEFAULT_API_URL)
+        self.gateway_url = self.configuration.get("gateway_url", DEFAULT_GATEWAY_URL)
+        self.direct_submit = bool(self.configuration.get("direct_submit", False))
+
+    @property
+    def return_url(self):
+        """Return the absolute URL PayFort redirects the customer to after processing the payment."""
+        return routes.absolute_url(self.ecommerce_url_root, "payfort:response")
+
+    @property
+    def payment_page_url(self):
+        """Return the URL of the page that submits the payment form to PayFort."""
+        return routes.reverse("payfort:form")
+
+    @cached_property
+    def request_signer(self):
+        """Return the signer used for the requests sent to PayFort."""
+        return utils.get_signer(self.request_sha_phrase, self.sha_method)
+
+    @cached_property
+    def response_signer(self):
+        """Return the signer used for the responses received from PayFort."""
+        return utils.get_signer(self.response_sha_phrase, self.sha_method)
+
+    @cached_property
+    def api_client(self):
+        """Return the client of the PayFort API. Its pooled connections are reused along with the processor."""
+        return PayFortAPIClient.from_processor(self)
 
     def get_transaction_parameters(self, basket, request=None, use_client_side_checkout=False, **kwargs):
-        """Return the transaction parameters needed for this processor."""
-        transaction_parameters = {
-            "command": "PURCHASE",
-            "access_code": self.access_code,
-            "merchant_identifier": self.merchant_identifier,
-            "language": utils.get_language(request),
-            "merchant_reference": utils.get_merchant_reference(self.site.id, basket),
-            "amount": utils.get_amount(basket),
-            "currency": utils.get_currency(basket),
-            "customer_email": utils.get_customer_email(basket),
-            "customer_ip": utils.get_ip_address(request),
-            "order_description": utils.get_order_description(basket),
-            "customer_name": utils.get_customer_name(basket),
-            "return_url": urljoin(
-                self.ecommerce_url_root,
-                reverse("payfort:response")
-            ),
-        }
-
-        signature = utils.get_signature(
-            self.request_sha_phrase,
-            self.sha_method,
-            transaction_parameters,
-        )
-        transaction_parameters.update({
-            "signature": signature,
-            "payment_page_url": reverse("payfort:form"),
-            "csrfmiddlewaretoken": get_token(request),
-        })
+        """
+        Return the transaction parameters needed for this processor.
+
+        With direct_submit, the payment_page_url is the PayFort payment page, so the checkout submits the signed
+        parameters to PayFort straight away. Otherwise, it's the page that submits them to PayFort.
+        """
+        with instrumentation.stage("processor.get_transaction_parameters"):
+            with instrumentation.stage("processor.basket_snapshot"):
+                snapshot = utils.BasketPaymentSnapshot(basket)
+            offer_cache.record(basket)
+            transaction_parameters = {
+                "command": "PURCHASE",
+                "access_code": self.access_code,
+                "merchant_identifier": self.merchant_identifier,
+                "language": utils.get_language(request),
+                "merchant_reference": utils.get_merchant_reference(self.site.id, basket),
+                "amount": snapshot.amount,
+                "currency": snapshot.currency,
+                "customer_email": snapshot.customer_email,
+                "customer_ip": utils.get_ip_address(request),
+                "order_description": snapshot.order_description,
+                "customer_name": snapshot.customer_name,
+                "return_url": self.return_url,
+            }
+
+            with instrumentation.stage("processor.sign"):
+                signature = self.request_signer.sign(transaction_parameters)
+            transaction_parameters["signature"] = signature
+            if self.direct_submit:
+                transaction_parameters["payment_page_url"] = self.gateway_url
+            else:
+                transaction_parameters.update({
+                    "payment_page_url": self.payment_page_url,
+                    "csrfmiddlewaretoken": get_token(request),
+                })
 
         return transaction_parameters
 
     def handle_processor_response(self, response, basket=None):
-        """Handle the payment processor response and record the relevant details."""
-        currency = response["currency"]
-        total = int(response["amount"]) / 100
-        transaction_id = utils.get_transaction_id(response)
-        card_number = response.get("card_number")
-        card_type = response.get("payment_option")
+        """
+        Handle the payment processor response and record the relevant details.
+
+        The response is either the PayFortResponse parsed by the view, or the raw response data.
+        """
+        if not isinstance(response, utils.PayFortResponse):
+            response = utils.verify_response_format(response)
 
         return HandledProcessorResponse(
-            transaction_id=transaction_id,
-            total=total,
-            currency=currency,
-            card_number=card_number,
-            card_type=card_type
+            transaction_id=response.transaction_id,
+            total=response.amount / 100,
+            currency=response.currency,
+            card_number=response.card_number,
+            card_type=response.payment_option,
         )
 
     def issue_credit(
-            self, order_number, basket, reference_number, amount, currency
+            self, order_number, basket, reference_number, amount, currency, maintenance_reference=None
     ):  # pylint: disable=too-many-arguments
-        """Not available."""
-        raise NotImplementedError("PayFort processor cannot issue credits or refunds from Open edX ecommerce.")
+        """
+        Refund the given amount of the payment of the order with the PayFort REFUND command.
+
+        The response is recorded as a payment processor response, whether the refund succeeded or not.
+
+        @param order_number: The order number
+        @param basket: The basket of the order
+        @param reference_number: The transaction ID of the payment, as returned by handle_processor_response
+        @param amount: The amount to refund
+        @param currency: The currency
+        @param maintenance_reference: The idempotency key of the refund. A new one is used when not given
+        @return: The transaction ID of the refund
+        """
+        maintenance_reference = maintenance_reference or uuid.uuid4().hex
+        fort_id = reference_number.rsplit("-", 1)[-1]
+        try:
+            response_data = self.api_client.refund(
+                merchant_reference=utils.get_merchant_reference(self.site.id, basket),
+                amount=int(round(Decimal(amount) * 100, 0)),
+                currency=currency,
+                maintenance_reference=maintenance_reference,
+                fort_id=fort_id if fort_id != "none" else None,
+            )
+        except utils.PayFortException as exc:
+            message = f"PayFort refund failed! order_number: {order_number}. {str(exc)}"
+            logger.exception(message)
+            raise GatewayError(message) from exc
+
+        transaction_id = f"{REFUND_COMMAND}-{maintenance_reference}"
+        with atomic():
+            processor_response = self.record_processor_response(
+                {"command": REFUND_COMMAND, "response": response_data},
+                transaction_id=transaction_id,
+                basket=basket,
+            )
+            PayFortTransaction.record(processor_response, response_data)
+
+        if response_data.get("status") != REFUND_SUCCESS:
+            message = (
+                f"PayFort refund declined! order_number: {order_number}. "
+                f"response_code: {response_data.get('response_code')}. "
+                f"response_message: {response_data.get('response_message')}"
+            )
+            logger.error(message)
+            raise GatewayError(message)
+
+        return transaction_id
+
+
+class ProcessorCache:
+    """
+    Thread-safe and size-bounded cache of PayFort processors keyed by site.
+
+    A cached processor is reused for as long as its site keeps the same partner. The cache is cleared when a site,
+    a site configuration, a partner or the payment processors configuration changes.
+    """
+    def __init__(self, maxsize=PROCESSOR_CACHE_SIZE):
+        """Initialize the cache."""
+        self.maxsize = maxsize
+        self._processors = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0
+
+    def get(self, site):
+        """
+        Return the processor of the given site, and create it if it's not cached.
+
+        @param site: The site
+        @return: The PayFort processor
+        """
+        partner_short_code = site.siteconfiguration.partner.short_code
+        with self._lock:
+            entry = self._processors.get(site.id)
+            if entry is not None and entry[0] == partner_short_code:
+                self._processors.move_to_end(site.id)
+                return entry[1]
+            generation = self._generation
+
+        processor = PayFort(site)
+        with self._lock:
+            if generation == self._generation:
+                self._processors[site.id] = (partner_short_code, processor)
+                self._processors.move_to_end(site.id)
+                while len(self._processors) > self.maxsize:
+                    self._processors.popitem(last=False)
+
+        return processor
+
+    def clear(self):
+        """Clear the cache."""
+        with self._lock:
+            self._processors.clear()
+            self._generation += 1
+
+    def __len__(self):
+        """Return the number of cached processors."""
+        return len(self._processors)
+
+
+processor_cache = ProcessorCache()
+
+
+def get_processor(site):
+    """
+    Return the cached PayFort processor of the given site.
+
+    @param site: The site
+    @return: The PayFort processor
+    """
+    return processor_cache.get(site)
@@ -0,0 +1,194 @@
+"""
+Bulk refunds of the orders paid with PayFort.
+
+A refund job refunds each order of a queryset once, in a pool of worker threads. Its progress is persisted as one
+PayFortRefund per order, created as pending before the refund is sent. An interrupted job is resumed by running it
+again with the same job ID: the succeeded refunds are skipped, and the others are sent again with the same idempotency
+key. The orders already refunded by another job are skipped as well.
+"""
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import connections
+
+from ecommerce_payfort.models import PayFortRefund
+from ecommerce_payfort.processors import PayFort
+
+logger = logging.getLogger(__name__)
+
+
+class RefundJob:
+    """Refund the orders of a queryset with bounded concurrency."""
+    chunk_size = 100
+
+    def __init__(self, job_id, processor, max_workers=4):
+        """
+        Initialize the job.
+
+        @param job_id: The ID of the job, to resume it
+        @param processor: The PayFort processor issuing the refunds
+        @param max_workers: The number of worker threads. The refunds are issued in the current thread when 1
+        """
+        self.job_id = job_id
+        self.processor = processor
+        self.max_workers = max(1, max_workers)
+
+    def iter_chunks(self, orders):
+        """
+        Return the orders in chunks ordered by ID, with their basket and their payment sources.
+
+        @param orders: The queryset of orders
+        @return: An iterator of lists of orders
+        """
+        orders = orders.order_by("id").select_related("basket").prefetch_related("sources__source_type")
+        last_id = 0
+        while True:
+            chunk = list(orders.filter(id__gt=last_id)[:self.chunk_size])
+            if not chunk:
+                return
+            yield chunk
+            last_id = chunk[-1].id
+
+    def get_refunded_by_other_jobs(self, orders):
+        """
+        Return the numbers of the given orders that another job has already refunded.
+
+        @param orders: The orders
+        @return: The set of order numbers
+        """
+        return set(
+            PayFortRefund.objects.filter(
+                order_number__in=[order.number for order in orders], status=PayFortRefund.SUCCEEDED,
+            ).exclude(job_id=self.job_id).values_list("order_number", flat=True)
+        )
+
+    def get_refunds(self, orders):
+        """
+        Return the refunds of the given orders by this job, creating the missing ones as pending.
+
+        @param orders: The orders
+        @return: The refunds keyed by order number
+        """
+        order_numbers = [order.number for order in orders]
+        refunds = PayFortRefund.objects.filter(job_id=self.job_id, order_number__in=order_numbers)
+        existing = set(refunds.values_list("order_number", flat=True))
+        PayFortRefund.objects.bulk_create([
+            PayFortRefund(
+                job_id=self.job_id,
+                order_number=order.number,
+                idempotency_key=PayFortRefund.get_idempotency_key(self.job_id, order.number),
+                amount=order.total_incl_tax,
+                currency=order.currency,
+            )
+            for order in orders if order.number not in existing
+        ])
+        return {refund.order_number: refund for refund in refunds.all()}
+
+    @staticmethod
+    def get_payment_reference(order):
+        """
+        Return the transaction ID of the PayFort payment of the given order.
+
+        @param order: The order, with its prefetched payment sources
+        @return: The transaction ID, or None if the order was not paid with PayFort
+        """
+        for source in order.sources.all():
+            if source.source_type.name == PayFort.NAME:
+                return source.reference
+        return None
+
+    def refund(self, refund, order):
+        """
+        Issue the refund of the given order, and save its outcome.
+
+        @param refund: The refund
+        @param order: The order
+        @return: The status of the refund
+        """
+        try:
+            reference_number = self.get_payment_reference(order)
+            if reference_number is None:
+                raise ValueError("The order was not paid with PayFort")
+            refund.transaction_id = self.processor.issue_credit(
+                order.number,
+                order.basket,
+                reference_number,
+                refund.amount,
+                refund.currency,
+                maintenance_reference=refund.idempotency_key,
+            )
+        except Exception as exc:  # pylint:disable=broad-except
+            logger.exception("Refund of order [%s] by job [%s] failed!", order.number, self.job_id)
+            refund.status = PayFortRefund.FAILED
+            refund.error = f"{exc.__class__.__name__}: {str(exc)}"
+        else:
+            refund.status = PayFortRefund.SUCCEEDED
+            refund.error = ""
+
+        refund.attempts += 1
+        refund.save(update_fields=["status", "transaction_id", "error", "attempts", "modified"])
+        return refund.status
+
+    def refund_in_worker(self, refund, order):
+        """Issue the refund of the given order, then close the database connections of the worker thread."""
+        try:
+            return self.refund(refund, order)
+        finally:
+            connections.close_all()
+
+    def run(self, orders):
+        """
+        Refund the given orders, skipping the ones already refunded by this job or another one.
+
+        @param orders: The queryset of orders
+        @return: The summary of the run
+        """
+        start = time.monotonic()
+        summary = {
+            "job_id": self.job_id,
+            "orders": 0,
+            "already_refunded": 0,
+            PayFortRefund.SUCCEEDED: 0,
+            PayFortRefund.FAILED: 0,
+            "failures": [],
+        }
+
+        executor = None
+        if self.max_workers > 1:
+            # Create the pooled API client before the workers share it
+            self.processor.api_client  # pylint: disable=pointless-statement
+            executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="payfort-refunds")
+
+        try:
+            for chunk in self.iter_chunks(orders):
+                self.process_chunk(chunk, summary, executor)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+        summary["duration"] = round(time.monotonic() - start, 3)
+        return summary
+
+    def process_chunk(self, chunk, summary, executor):
+        """Refund a chunk of orders, and update the summary."""
+        refunded_by_other_jobs = self.get_refunded_by_other_jobs(chunk)
+        refunds = self.get_refunds([order for order in chunk if order.number not in refunded_by_other_jobs])
+        jobs = []
+        for order in chunk:
+            summary["orders"] += 1
+            refund = refunds.get(order.number)
+            if refund is None or refund.status == PayFortRefund.SUCCEEDED:
+                summary["already_refunded"] += 1
+                continue
+
+            if executor is None:
+                jobs.append((refund, self.refund(refund, order)))
+            else:
+                jobs.append((refund, executor.submit(self.refund_in_worker, refund, order)))
+
+        for refund, result in jobs:
+            status = result if executor is None else result.result()
+            summary[status] += 1
+            if status == PayFortRefund.FAILED:
+                summary["failures"].append({"order_number": refund.order_number, "error": refund.error})
@@ -0,0 +1,92 @@
+"""
+Cached URL resolution of the PayFort routes.
+
+The URLs are cached per URL resolver, so the cache follows the URLconf of the request and is dropped along with the
+resolver when the URLconfs are reloaded (see django.urls.clear_url_caches). Within a resolver, the URLs are keyed by
+script prefix and language, which are the other inputs of reverse().
+
+The routes that take an argument are reversed once with a placeholder, then built from the URL prefix and suffix
+around it.
+"""
+import threading
+import weakref
+from urllib.parse import quote, urljoin
+
+from django.urls import NoReverseMatch, get_resolver, get_script_prefix, get_urlconf
+from django.urls import reverse as django_reverse
+from django.utils.translation import get_language
+
+ARG_PLACEHOLDER = "__payfort_arg__"
+# Characters kept as is by reverse() when it quotes the arguments
+ARG_SAFE_CHARACTERS = "/~:@!$&'()*+,;="
+
+_url_caches = weakref.WeakKeyDictionary()
+_url_caches_lock = threading.Lock()
+
+
+def get_url_cache():
+    """
+    Return the URL cache of the current URL resolver.
+
+    @return: The dictionary of cached URLs
+    """
+    resolver = get_resolver(get_urlconf())
+    with _url_caches_lock:
+        url_cache = _url_caches.get(resolver)
+        if url_cache is None:
+            url_cache = _url_caches[resolver] = {}
+    return url_cache
+
+
+def reverse(route_name):
+    """
+    Return the URL of the given route, which takes no arguments.
+
+    @param route_name: The name of the route, e.g. "payfort:status"
+    @return: The URL path
+    """
+    url_cache = get_url_cache()
+    key = ("path", get_script_prefix(), get_language(), route_name)
+    url = url_cache.get(key)
+    if url is None:
+        url = url_cache[key] = django_reverse(route_name)
+    return url
+
+
+def reverse_with_arg(route_name, arg):
+    """
+    Return the URL of the given route, which takes a single argument matching any non-empty text.
+
+    @param route_name: The name of the route, e.g. "payfort:handle-internal-error"
+    @param arg: The argument
+    @return: The URL path
+    """
+    arg = str(arg)
+    if not arg:
+        raise NoReverseMatch(f"Reverse for '{route_name}' with an empty argument not found.")
+
+    url_cache = get_url_cache()
+    key = ("arg", get_script_prefix(), get_language(), route_name)
+    parts = url_cache.get(key)
+    if parts is None:
+        parts = url_cache[key] = django_reverse(route_name, args=[ARG_PLACEHOLDER]).split(ARG_PLACEHOLDER)
+
+    if len(parts) != 2:
+        return django_reverse(route_name, args=[arg])
+    return f"{parts[0]}{quote(arg, safe=ARG_SAFE_CHARACTERS)}{parts[1]}"
+
+
+def absolute_url(url_root, route_name):
+    """
+    Return the absolute URL of the given route, which takes no arguments.
+
+    @param url_root: The root URL of the site, e.g. "https://ecommerce.example.com"
+    @param route_name: The name of the route
+    @return: The absolute URL
+    """
+    url_cache = get_url_cache()
+    key = ("absolute", get_script_prefix(), get_language(), route_name, url_root)
+    url = url_cache.get(key)
+    if url is None:
+        url = url_cache[key] = urljoin(url_root, reverse(route_name))
+    return url
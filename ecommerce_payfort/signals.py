@@ -0,0 +1,85 @@
+"""Signal receivers of the PayFort payment processor."""
+from django.core.signals import setting_changed
+from django.db.models.signals import post_delete, post_init, post_save
+from django.dispatch import receiver
+
+from ecommerce_payfort import instrumentation, offer_cache, status_cache
+from ecommerce_payfort.notifiers import NOTIFIER_SETTING, get_notifier
+from ecommerce_payfort.orders import ORDER_QUEUE_SETTING, get_order_queue
+from ecommerce_payfort.processors import processor_cache
+
+
+@receiver(post_save, sender="sites.Site")
+@receiver(post_delete, sender="sites.Site")
+@receiver(post_save, sender="core.SiteConfiguration")
+@receiver(post_delete, sender="core.SiteConfiguration")
+@receiver(post_save, sender="partner.Partner")
+@receiver(post_delete, sender="partner.Partner")
+def clear_processor_cache(**kwargs):  # pylint: disable=unused-argument
+    """Clear the cached processors when a site or a partner changes."""
+    processor_cache.clear()
+
+
+@receiver(post_delete, sender="order.Order")
+def evict_status_cache(instance, **kwargs):  # pylint: disable=unused-argument
+    """Evict the cached receipt URL of the basket of a deleted order."""
+    if instance.basket_id:
+        status_cache.evict(f"{instance.site_id}-{instance.user_id}-{instance.basket_id}")
+
+
+@receiver(post_init, sender="offer.ConditionalOffer")
+@receiver(post_init, sender="voucher.Voucher")
+def remember_offer_definition(instance, **kwargs):  # pylint: disable=unused-argument
+    """Remember the definition of a loaded offer or voucher, to tell the saves of its usage counters apart."""
+    offer_cache.remember_definition(instance)
+
+
+@receiver(post_save, sender="offer.ConditionalOffer")
+@receiver(post_save, sender="voucher.Voucher")
+def bump_offers_version_on_change(instance, created, update_fields, **kwargs):  # pylint: disable=unused-argument
+    """Drop the recorded offers when an offer or a voucher is created or changed, but not when its usage is recorded."""
+    if offer_cache.is_definition_changed(instance, update_fields) or created:
+        offer_cache.bump_offers_version()
+
+
+@receiver(post_delete, sender="offer.ConditionalOffer")
+@receiver(post_save, sender="offer.Condition")
+@receiver(post_delete, sender="offer.Condition")
+@receiver(post_save, sender="offer.Benefit")
+@receiver(post_delete, sender="offer.Benefit")
+@receiver(post_save, sender="offer.Range")
+@receiver(post_delete, sender="offer.Range")
+@receiver(post_save, sender="offer.RangeProduct")
+@receiver(post_delete, sender="offer.RangeProduct")
+@receiver(post_delete, sender="voucher.Voucher")
+def bump_offers_version(**kwargs):  # pylint: disable=unused-argument
+    """Drop the offers recorded for the frozen baskets when an offer or a voucher changes."""
+    offer_cache.bump_offers_version()
+
+
+@receiver(setting_changed)
+def clear_processor_cache_on_setting_changed(setting, **kwargs):  # pylint: disable=unused-argument
+    """Clear the cached processors when the payment processors configuration changes."""
+    if setting == "PAYMENT_PROCESSOR_CONFIG":
+        processor_cache.clear()
+
+
+@receiver(setting_changed)
+def clear_notifier_on_setting_changed(setting, **kwargs):  # pylint: disable=unused-argument
+    """Drop the current notifier when the notifier setting changes."""
+    if setting == NOTIFIER_SETTING:
+        get_notifier.cache_clear()
+
+
+@receiver(setting_changed)
+def clear_order_queue_on_setting_changed(setting, **kwargs):  # pylint: disable=unused-argument
+    """Drop the current order queue when the order queue setting changes."""
+    if setting == ORDER_QUEUE_SETTING:
+        get_order_queue.cache_clear()
+
+
+@receiver(setting_changed)
+def reset_instrumentation_sink(setting, **kwargs):  # pylint: disable=unused-argument
+    """Drop the current instrumentation sink when the sink setting changes."""
+    if setting == instrumentation.SINK_SETTING:
+        instrumentation.get_sink.cache_clear()
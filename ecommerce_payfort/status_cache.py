@@ -0,0 +1,52 @@
+"""
+Cache of the receipt URLs of the submitted baskets, keyed by merchant reference.
+
+The cache is built on the Django cache framework, so a shared backend lets all workers and nodes answer the status
+requests without reading the database. Only submitted baskets are cached, since their receipt URL never changes.
+"""
+from django.core.cache import cache
+
+KEY_PREFIX = "payfort_status"
+TTL = 600
+
+
+def get_key(merchant_reference):
+    """
+    Return the cache key of the given merchant reference.
+
+    @param merchant_reference: The merchant reference
+    @return: The cache key
+    """
+    return f"{KEY_PREFIX}:{merchant_reference}"
+
+
+def get_receipt_url(merchant_reference):
+    """
+    Return the cached receipt URL of the given merchant reference.
+
+    @param merchant_reference: The merchant reference
+    @return: The receipt URL, or None if it's not cached
+    """
+    if not merchant_reference:
+        return None
+
+    return cache.get(get_key(merchant_reference))
+
+
+def set_receipt_url(merchant_reference, receipt_url):
+    """
+    Cache the receipt URL of the given merchant reference.
+
+    @param merchant_reference: The merchant reference
+    @param receipt_url: The receipt URL
+    """
+    cache.set(get_key(merchant_reference), receipt_url, TTL)
+
+
+def evict(merchant_reference):
+    """
+    Remove the cached receipt URL of the given merchant reference.
+
+    @param merchant_reference: The merchant reference
+    """
+    cache.delete(get_key(merchant_reference))
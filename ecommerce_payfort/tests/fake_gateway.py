@@ -0,0 +1,192 @@
+"""
+Local fake of the PayFort API, used to test and benchmark the API client offline.
+
+The server validates the signature of the queries like PayFort does, and answers the CHECK_STATUS queries and the
+REFUND commands of the payments registered with add_payment, signing its responses. The refunds are idempotent per
+maintenance reference, and can't exceed the amount of the payment. The latency of the real gateway can be injected to
+measure how the clients scale with concurrency.
+"""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from ecommerce_payfort import utils
+
+REQUEST_SHA_PHRASE = "secret@req"
+RESPONSE_SHA_PHRASE = "secret@res"
+SHA_METHOD = "SHA-256"
+
+
+class _Server(ThreadingHTTPServer):
+    """Threading HTTP server accepting bursts of concurrent connections."""
+    daemon_threads = True
+    request_queue_size = 128
+
+    def handle_error(self, request, client_address):
+        """Ignore the connections reset by the clients, e.g. when a client stops reading early."""
+
+
+class FakePayFortGateway:
+    """Fake PayFort API served from a background thread on a free local port."""
+    def __init__(self, request_sha_phrase=REQUEST_SHA_PHRASE, response_sha_phrase=RESPONSE_SHA_PHRASE,
+                 sha_method=SHA_METHOD, latency=0):
+        """Initialize the gateway. The latency is the delay in seconds before answering each query."""
+        self.request_sha_phrase = request_sha_phrase
+        self.response_sha_phrase = response_sha_phrase
+        self.sha_method = sha_method
+        self.latency = latency
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.payments = {}
+        self.refunds = {}
+        self.requests = []
+        self.client_addresses = set()
+        self.fail_next = []
+        self._lock = threading.Lock()
+        self._server = _Server(("127.0.0.1", 0), self._make_handler())
+        self._thread = None
+
+    @property
+    def url(self):
+        """Return the URL of the API."""
+        host, port = self._server.server_address
+        return f"http://{host}:{port}/FortAPI/paymentApi"
+
+    def start(self):
+        """Start serving in a background thread."""
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop serving."""
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        """Start serving."""
+        return self.start()
+
+    def __exit__(self, *args):
+        """Stop serving."""
+        self.stop()
+
+    def add_payment(self, merchant_reference, transaction_status="14", fort_id="169996200000000001", amount="2000"):
+        """Register a payment answered by the CHECK_STATUS queries, and refunded by the REFUND commands."""
+        self.payments[merchant_reference] = {
+            "transaction_status": transaction_status,
+            "fort_id": fort_id,
+            "amount": amount,
+            "refunded_amount": "0",
+            "currency": utils.VALID_CURRENCY,
+        }
+
+    def sign(self, data):
+        """Sign the given response data."""
+        data["signature"] = utils.get_signature(self.response_sha_phrase, self.sha_method, data)
+        return data
+
+    def respond(self, query):
+        """Return the response data of the given query."""
+        base = {
+            key: query.get(key)
+            for key in ("command", "query_command", "access_code", "merchant_identifier", "language")
+            if key in query
+        }
+        base["merchant_reference"] = query.get("merchant_reference")
+
+        try:
+            utils.verify_signature(self.request_sha_phrase, self.sha_method, query)
+        except utils.PayFortBadSignatureException:
+            return self.sign({
+                **base, "status": "00", "response_code": "00008", "response_message": "Signature mismatch",
+            })
+
+        if query.get("command") == "REFUND":
+            with self._lock:
+                return self.refund(query, base)
+
+        if query.get("query_command") != "CHECK_STATUS":
+            return self.sign({**base, "status": "00", "response_code": "00001", "response_message": "Invalid command"})
+
+        payment = self.payments.get(query.get("merchant_reference"))
+        if payment is None:
+            return self.sign({**base, "status": "13", "response_code": "13000", "response_message": "Not found"})
+
+        return self.sign({
+            **base,
+            **payment,
+            "status": "12",
+            "response_code": "12000",
+            "response_message": "Success",
+        })
+
+    def refund(self, query, base):
+        """Return the response data of the given signed refund, and refund the payment once."""
+        maintenance_reference = query.get("maintenance_reference")
+        if maintenance_reference in self.refunds:
+            return self.refunds[maintenance_reference]
+
+        payment = self.payments.get(query.get("merchant_reference"))
+        if payment is None:
+            return self.sign({**base, "status": "07", "response_code": "00017", "response_message": "Not found"})
+
+        base.update({key: query.get(key) for key in ("maintenance_reference", "amount", "currency")})
+        refunded_amount = int(payment["refunded_amount"]) + int(query.get("amount") or 0)
+        if refunded_amount > int(payment["amount"]):
+            return self.sign({
+                **base, "status": "07", "response_code": "00029", "response_message": "Amount exceeded",
+            })
+
+        payment["refunded_amount"] = str(refunded_amount)
+        self.refunds[maintenance_reference] = self.sign({
+            **base,
+            "fort_id": payment["fort_id"],
+            "status": "06",
+            "response_code": "06000",
+            "response_message": "Success",
+        })
+        return self.refunds[maintenance_reference]
+
+    def _make_handler(self):
+        """Return the request handler class bound to this gateway."""
+        gateway = self
+
+        class Handler(BaseHTTPRequestHandler):
+            """Request handler of the fake gateway."""
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):  # pylint: disable=invalid-name
+                """Answer a query."""
+                query = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                with gateway._lock:  # pylint: disable=protected-access
+                    gateway.requests.append(query)
+                    gateway.client_addresses.add(self.client_address)
+                    gateway.in_flight += 1
+                    gateway.max_in_flight = max(gateway.max_in_flight, gateway.in_flight)
+                    status_code = gateway.fail_next.pop(0) if gateway.fail_next else None
+
+                time.sleep(gateway.latency)
+                with gateway._lock:  # pylint: disable=protected-access
+                    gateway.in_flight -= 1
+
+                if status_code is not None:
+                    self._send(status_code, b"")
+                    return
+
+                self._send(200, json.dumps(gateway.respond(query)).encode())
+
+            def _send(self, status_code, body):
+                """Send the response, keeping the connection alive."""
+                self.send_response(status_code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):  # pylint: disable=arguments-differ
+                """Keep the test output quiet."""
+
+        return Handler
@@ -0,0 +1,201 @@
+"""Tests for async_client.py"""
+import asyncio
+import time
+from unittest.mock import Mock, patch
+
+import pytest
+
+from ecommerce_payfort import utils
+from ecommerce_payfort.async_client import AsyncPayFortAPIClient, RateLimiter
+from ecommerce_payfort.tests.fake_gateway import FakePayFortGateway
+
+
+@pytest.fixture
+def gateway():
+    """Start the fake gateway, with the status of ten payments."""
+    with FakePayFortGateway() as fake_gateway:
+        for index in range(10):
+            fake_gateway.add_payment(f"1-2-{index}", fort_id=str(index))
+        yield fake_gateway
+
+
+def get_client(gateway, **kwargs):  # pylint: disable=redefined-outer-name
+    """Return an async client of the given fake gateway."""
+    return AsyncPayFortAPIClient(
+        access_code="123123123",
+        merchant_identifier="mid123",
+        request_sha_phrase=gateway.request_sha_phrase,
+        response_sha_phrase=gateway.response_sha_phrase,
+        sha_method=gateway.sha_method,
+        api_url=gateway.url,
+        **kwargs,
+    )
+
+
+@pytest.fixture(autouse=True)
+def no_backoff():
+    """Retry without delay."""
+    with patch.object(AsyncPayFortAPIClient, "BACKOFF_FACTOR", 0):
+        yield
+
+
+def test_from_processor():
+    """Verify that the client is configured from the processor and the given limits."""
+    processor = Mock(
+        access_code="ac", merchant_identifier="mi", request_sha_phrase="req", response_sha_phrase="res",
+        sha_method="SHA-256", api_url="https://example.com/api",
+    )
+    client = AsyncPayFortAPIClient.from_processor(processor, concurrency=5, rate_limit=50)
+    assert (client.access_code, client.api_url) == ("ac", "https://example.com/api")
+    assert (client.concurrency, client.rate_limit) == (5, 50)
+    assert AsyncPayFortAPIClient.from_processor(processor, concurrency=0).concurrency == 1
+
+
+def test_stream_check_status(gateway):  # pylint: disable=redefined-outer-name
+    """Verify that the status of every payment is streamed back, with the failures as exceptions."""
+    references = [f"1-2-{index}" for index in range(12)]
+    results = dict(get_client(gateway, concurrency=4).stream_check_status(iter(references)))
+    assert sorted(results) == sorted(references)
+    assert all(results[f"1-2-{index}"]["fort_id"] == str(index) for index in range(10))
+    assert results["1-2-10"]["status"] == "13"
+    assert {query["query_command"] for query in gateway.requests} == {"CHECK_STATUS"}
+    assert len(gateway.client_addresses) <= 4
+
+
+def test_stream_check_status_bad_signature(gateway):  # pylint: disable=redefined-outer-name
+    """Verify that a response with a bad signature is returned as an exception."""
+    client = get_client(gateway)
+    client.response_sha_phrase = "wrong"
+    with patch("ecommerce_payfort.async_client.logger.warning") as mock_warning:
+        results = dict(client.stream_check_status(["1-2-3"]))
+    assert isinstance(results["1-2-3"], utils.PayFortBadSignatureException)
+    assert mock_warning.call_args[0][1] == "1-2-3"
+
+
+def test_stream_check_status_retried(gateway):  # pylint: disable=redefined-outer-name
+    """Verify that the gateway errors are retried, and reported once the retries are exhausted."""
+    gateway.fail_next = [503, 502]
+    assert dict(get_client(gateway).stream_check_status(["1-2-3"]))["1-2-3"]["fort_id"] == "3"
+    assert len(gateway.requests) == 3
+
+    gateway.fail_next = [503] * (AsyncPayFortAPIClient.MAX_RETRIES + 1)
+    result = dict(get_client(gateway).stream_check_status(["1-2-3"]))["1-2-3"]
+    assert isinstance(result, utils.PayFortException)
+    assert "PayFort API request failed! query: CHECK_STATUS. Exception: ClientResponseError" in str(result)
+
+
+def test_stream_check_status_client_error(gateway):  # pylint: disable=redefined-outer-name
+    """Verify that the client errors are not retried."""
+    gateway.fail_next = [400]
+    result = dict(get_client(gateway).stream_check_status(["1-2-3"]))["1-2-3"]
+    assert isinstance(result, utils.PayFortException)
+    assert len(gateway.requests) == 1
+
+
+def test_stream_check_status_bad_body(gateway):  # pylint: disable=redefined-outer-name
+    """Verify that a body which is not a JSON object is reported."""
+    with patch.object(gateway, "respond", return_value=[1, 2]):
+        result = dict(get_client(gateway).stream_check_status(["1-2-3"]))["1-2-3"]
+    assert "Bad PayFort API response: [1, 2]" in str(result)
+
+    with patch("aiohttp.ClientResponse.json", side_effect=ValueError("bad json")):
+        result = dict(get_client(gateway).stream_check_status(["1-2-3"]))["1-2-3"]
+    assert "Exception: ValueError: bad json" in str(result)
+
+
+def test_stream_check_status_connection_error():
+    """Verify that the connection errors are retried, then reported."""
+    client = AsyncPayFortAPIClient("ac", "mi", "req", "res", "SHA-256", api_url="http://127.0.0.1:9/FortAPI/paymentApi")
+    result = dict(client.stream_check_status(["1-2-3"]))["1-2-3"]
+    assert "ClientConnectorError" in str(result)
+
+
+def test_stream_check_status_unexpected_error(gateway):  # pylint: disable=redefined-outer-name
+    """Verify that an unexpected error is raised in the calling thread."""
+    with patch.object(AsyncPayFortAPIClient, "get_check_status_parameters", side_effect=KeyError("bug")):
+        with pytest.raises(KeyError):
+            list(get_client(gateway).stream_check_status(["1-2-3"]))
+
+
+def test_stream_check_status_stopped_early(gateway):  # pylint: disable=redefined-outer-name
+    """Verify that the queries stop when the results are no longer consumed."""
+    references = [f"1-2-{index}" for index in range(10)]
+    stream = get_client(gateway, concurrency=1).stream_check_status(references)
+    next(stream)
+    stream.close()
+    assert len(gateway.requests) < len(references)
+
+
+def test_concurrency_limit(gateway):  # pylint: disable=redefined-outer-name
+    """Verify that no more than `concurrency` queries are in flight."""
+    gateway.latency = 0.02
+    list(get_client(gateway, concurrency=3).stream_check_status([f"1-2-{index}" for index in range(10)]))
+    assert gateway.max_in_flight == 3
+
+
+def test_throughput_scales_with_concurrency(gateway):  # pylint: disable=redefined-outer-name
+    """Verify that the queries overlap the latency of the gateway."""
+    gateway.latency = 0.05
+    references = [f"1-2-{index}" for index in range(10)]
+    durations = {}
+    for concurrency in (1, 10):
+        start = time.monotonic()
+        list(get_client(gateway, concurrency=concurrency).stream_check_status(references))
+        durations[concurrency] = time.monotonic() - start
+
+    assert durations[1] >= 0.5
+    assert durations[10] * 3 < durations[1]
+
+
+def test_rate_limit(gateway):  # pylint: disable=redefined-outer-name
+    """Verify that the rate limit spreads the queries over time."""
+    start = time.monotonic()
+    list(get_client(gateway, concurrency=10, rate_limit=20).stream_check_status([f"1-2-{i}" for i in range(10)]))
+    assert time.monotonic() - start < 1
+
+    start = time.monotonic()
+    list(get_client(gateway, concurrency=10, rate_limit=4).stream_check_status([f"1-2-{i}" for i in range(10)]))
+    assert time.monotonic() - start >= 2
+
+
+def acquire_times(limiter_args, count):
+    """Acquire the given number of times from a new limiter, and return when each acquisition was made."""
+    async def acquire_all():
+        """Acquire from the limiter created within the event loop."""
+        limiter = RateLimiter(*limiter_args)
+        start = time.monotonic()
+        times = []
+        for _ in range(count):
+            await limiter.acquire()
+            times.append(time.monotonic() - start)
+        return times
+
+    return asyncio.run(acquire_all())
+
+
+def test_rate_limiter():
+    """Verify that the acquisitions are spaced by one interval, the first one being immediate."""
+    times = acquire_times((3, 0.3), 4)
+    assert times[0] < 0.05
+    assert all(later - earlier >= 0.09 for earlier, later in zip(times, times[1:]))
+    assert times[-1] >= 0.29
+
+
+@pytest.mark.parametrize("rate, count, min_elapsed", [(2.5, 4, 1.2), (0.5, 2, 2.0)])
+def test_rate_limiter_fractional_rate(rate, count, min_elapsed):
+    """Verify that a fractional rate is honored instead of being rounded."""
+    times = acquire_times((rate,), count)
+    assert times[-1] >= min_elapsed - 0.01
+
+
+def test_rate_limit_fractional(gateway):  # pylint: disable=redefined-outer-name
+    """Verify that the client honors a fractional rate limit."""
+    start = time.monotonic()
+    list(get_client(gateway, concurrency=4, rate_limit=2.5).stream_check_status([f"1-2-{i}" for i in range(4)]))
+    assert time.monotonic() - start >= 1.19
+
+
+def test_rate_limiter_bad_rate():
+    """Verify that the rate must be positive."""
+    with pytest.raises(ValueError):
+        RateLimiter(0)
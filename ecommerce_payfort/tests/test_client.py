@@ -0,0 +1,220 @@
+"""Tests for client.py"""
+import json
+from unittest.mock import Mock, patch
+
+import pytest
+
+from ecommerce_payfort import utils
+from ecommerce_payfort.client import DEFAULT_API_URL, PayFortAPIClient
+from ecommerce_payfort.tests.fake_gateway import FakePayFortGateway
+
+
+@pytest.fixture
+def gateway():
+    """Start the fake gateway."""
+    with FakePayFortGateway() as fake_gateway:
+        yield fake_gateway
+
+
+@pytest.fixture
+def client(gateway):  # pylint: disable=redefined-outer-name
+    """Return a client of the fake gateway, without the retry delays."""
+    with patch.object(PayFortAPIClient, "BACKOFF_FACTOR", 0):
+        api_client = PayFortAPIClient(
+            access_code="123123123",
+            merchant_identifier="mid123",
+            request_sha_phrase=gateway.request_sha_phrase,
+            response_sha_phrase=gateway.response_sha_phrase,
+            sha_method=gateway.sha_method,
+            api_url=gateway.url,
+        )
+    with api_client:
+        yield api_client
+
+
+def test_from_processor():
+    """Verify that the client is configured from the processor."""
+    processor = Mock(
+        access_code="ac", merchant_identifier="mi", request_sha_phrase="req", response_sha_phrase="res",
+        sha_method="SHA-512", api_url="https://example.com/api",
+    )
+    client = PayFortAPIClient.from_processor(processor)  # pylint: disable=redefined-outer-name
+    assert (client.access_code, client.merchant_identifier) == ("ac", "mi")
+    assert (client.request_sha_phrase, client.response_sha_phrase, client.sha_method) == ("req", "res", "SHA-512")
+    assert client.api_url == "https://example.com/api"
+    assert client.timeout == (PayFortAPIClient.CONNECT_TIMEOUT, PayFortAPIClient.READ_TIMEOUT)
+
+
+def test_default_api_url():
+    """Verify that the sandbox is used by default."""
+    client = PayFortAPIClient("ac", "mi", "req", "res", "SHA-256")  # pylint: disable=redefined-outer-name
+    assert client.api_url == DEFAULT_API_URL
+
+
+def test_check_status(gateway, client):  # pylint: disable=redefined-outer-name
+    """Verify that the signed query is accepted, and that the verified response is returned."""
+    gateway.add_payment("1-2-3", transaction_status="14", fort_id="999")
+    response_data = client.check_status("1-2-3")
+    assert response_data["status"] == "12"
+    assert response_data["transaction_status"] == "14"
+    assert response_data["fort_id"] == "999"
+    query = gateway.requests[0]
+    assert query["query_command"] == "CHECK_STATUS"
+    assert query["access_code"] == "123123123"
+    assert query["signature"] == utils.get_signature(
+        gateway.request_sha_phrase, gateway.sha_method, {k: v for k, v in query.items() if k != "signature"},
+    )
+    assert "fort_id" not in query
+
+
+def test_check_status_fort_id(gateway, client):  # pylint: disable=redefined-outer-name
+    """Verify that the fort_id is sent when known."""
+    gateway.add_payment("1-2-3")
+    client.check_status("1-2-3", fort_id="999")
+    assert gateway.requests[0]["fort_id"] == "999"
+
+
+def test_check_status_not_found(client):  # pylint: disable=redefined-outer-name
+    """Verify that the response of an unknown payment is returned as is."""
+    assert client.check_status("1-2-404")["status"] == "13"
+
+
+def test_check_status_bad_request_signature(gateway, client):  # pylint: disable=redefined-outer-name
+    """Verify that the gateway rejects a query signed with the wrong phrase."""
+    client.request_sha_phrase = "wrong"
+    gateway.add_payment("1-2-3")
+    assert client.check_status("1-2-3")["response_code"] == "00008"
+
+
+def test_send_unsupported_command(client):  # pylint: disable=redefined-outer-name
+    """Verify that the gateway rejects the commands it doesn't support."""
+    assert client.send({"query_command": "UNKNOWN"})["response_code"] == "00001"
+
+
+def test_check_status_bad_response_signature(gateway, client):  # pylint: disable=redefined-outer-name
+    """Verify that a response with a bad signature is rejected."""
+    client.response_sha_phrase = "wrong"
+    gateway.add_payment("1-2-3")
+    with pytest.raises(utils.PayFortBadSignatureException):
+        client.check_status("1-2-3")
+
+
+def test_check_status_retried(gateway, client):  # pylint: disable=redefined-outer-name
+    """Verify that the gateway errors are retried."""
+    gateway.add_payment("1-2-3")
+    gateway.fail_next = [503, 502]
+    assert client.check_status("1-2-3")["status"] == "12"
+    assert len(gateway.requests) == 3
+
+
+def test_check_status_retries_exhausted(gateway, client):  # pylint: disable=redefined-outer-name
+    """Verify that a PayFortException is raised once the retries are exhausted."""
+    gateway.fail_next = [503] * (PayFortAPIClient.MAX_RETRIES + 1)
+    with pytest.raises(utils.PayFortException) as exc_info:
+        client.check_status("1-2-3")
+    assert "PayFort API request failed! query: CHECK_STATUS. Exception: HTTPError" in str(exc_info.value)
+
+
+def test_check_status_client_error_not_retried(gateway, client):  # pylint: disable=redefined-outer-name
+    """Verify that the client errors are not retried."""
+    gateway.fail_next = [400]
+    with pytest.raises(utils.PayFortException):
+        client.check_status("1-2-3")
+    assert len(gateway.requests) == 1
+
+
+@pytest.mark.parametrize("body", ["not json", "[1, 2]"])
+def test_check_status_bad_body(client, body):  # pylint: disable=redefined-outer-name
+    """Verify that a body which is not a JSON object is rejected."""
+    response = Mock(json=Mock(side_effect=lambda: json.loads(body)))
+    with patch.object(client.session, "post", return_value=response):
+        with pytest.raises(utils.PayFortException):
+            client.check_status("1-2-3")
+
+
+def test_connection_error():
+    """Verify that a connection error is raised as a PayFortException."""
+    with patch.object(PayFortAPIClient, "MAX_RETRIES", 0):
+        client = PayFortAPIClient(  # pylint: disable=redefined-outer-name
+            "ac", "mi", "req", "res", "SHA-256", api_url="http://127.0.0.1:9/FortAPI/paymentApi",
+        )
+    with pytest.raises(utils.PayFortException) as exc_info:
+        client.check_status("1-2-3")
+    assert "ConnectionError" in str(exc_info.value)
+
+
+def test_keep_alive(gateway, client):  # pylint: disable=redefined-outer-name
+    """Verify that the sequential queries reuse the same pooled connection."""
+    gateway.add_payment("1-2-3")
+    for _ in range(5):
+        client.check_status("1-2-3")
+    assert len(gateway.requests) == 5
+    assert len(gateway.client_addresses) == 1
+
+
+def test_check_status_batch(gateway, client):  # pylint: disable=redefined-outer-name
+    """Verify that the batch mode queries all the payments, and returns the failures as exceptions."""
+    references = [f"1-2-{index}" for index in range(30)]
+    for reference in references[:-1]:
+        gateway.add_payment(reference, fort_id=reference)
+    gateway.add_payment(references[-1])
+    sign = gateway.sign
+
+    def sign_badly_last(data):
+        """Sign the response of the last reference with a wrong signature."""
+        data = sign(data)
+        if data["merchant_reference"] == references[-1]:
+            data["signature"] = "bad"
+        return data
+
+    with patch.object(gateway, "sign", side_effect=sign_badly_last):
+        results = client.check_status_batch(references, max_workers=4)
+    assert list(results) == references
+    assert all(results[reference]["fort_id"] == reference for reference in references[:-1])
+    assert isinstance(results[references[-1]], utils.PayFortBadSignatureException)
+    assert len(gateway.client_addresses) <= 4
+
+
+def test_refund(gateway, client):  # pylint: disable=redefined-outer-name
+    """Verify that the refund is signed, sent with its maintenance reference, and verified."""
+    gateway.add_payment("1-2-3", fort_id="999")
+    response_data = client.refund("1-2-3", 1500, "SAR", "job-1-order-1", fort_id="999")
+    assert (response_data["status"], response_data["response_code"]) == ("06", "06000")
+    assert response_data["maintenance_reference"] == "job-1-order-1"
+    query = gateway.requests[0]
+    assert (query["command"], query["amount"], query["currency"], query["fort_id"]) == ("REFUND", 1500, "SAR", "999")
+    assert gateway.payments["1-2-3"]["refunded_amount"] == "1500"
+
+
+def test_refund_idempotent(gateway, client):  # pylint: disable=redefined-outer-name
+    """Verify that a refund sent again with the same maintenance reference is refunded once by the gateway."""
+    gateway.add_payment("1-2-3")
+    first = client.refund("1-2-3", 1500, "SAR", "job-1-order-1")
+    assert client.refund("1-2-3", 1500, "SAR", "job-1-order-1") == first
+    assert client.refund("1-2-3", 1500, "SAR", "job-2-order-1")["status"] == "07"
+    assert client.refund("1-2-404", 1500, "SAR", "job-2-order-2")["status"] == "07"
+    assert gateway.payments["1-2-3"]["refunded_amount"] == "1500"
+
+
+def test_refund_not_retried(gateway, client):  # pylint: disable=redefined-outer-name
+    """Verify that a refund that reached the gateway is not sent again."""
+    gateway.add_payment("1-2-3")
+    gateway.fail_next = [503]
+    with pytest.raises(utils.PayFortException) as exc_info:
+        client.refund("1-2-3", 1500, "SAR", "job-1-order-1")
+    assert "PayFort API request failed! query: REFUND" in str(exc_info.value)
+    assert len(gateway.requests) == 1
+
+
+def test_close(client):  # pylint: disable=redefined-outer-name
+    """Verify that closing the client closes both sessions."""
+    with patch.object(client.session, "close") as mock_close:
+        with patch.object(client.maintenance_session, "close") as mock_maintenance_close:
+            client.close()
+    mock_close.assert_called_once_with()
+    mock_maintenance_close.assert_called_once_with()
+
+
+def test_check_status_batch_empty(client):  # pylint: disable=redefined-outer-name
+    """Verify that an empty batch sends no query."""
+    assert client.check_status_batch([]) == {}
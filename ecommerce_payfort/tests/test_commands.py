@@ -0,0 +1,375 @@
+""" Tests for the management commands of the PayFort payment processor. """
+import json
+from datetime import datetime, timedelta
+from io import StringIO
+from tempfile import NamedTemporaryFile
+from unittest.mock import patch
+
+from django.conf import settings
+from django.core.management import CommandError, call_command
+from django.utils import timezone
+from ecommerce.courses.tests.factories import CourseFactory
+from ecommerce.tests.factories import SiteConfigurationFactory
+from ecommerce.tests.testcases import TestCase
+from oscar.core.loading import get_model
+from oscar.test import factories
+
+from ecommerce_payfort import orders, utils
+from ecommerce_payfort.management.commands.payfort_reconcile_frozen_baskets import Command, parse_since
+from ecommerce_payfort.models import PayFortStatusCheck, PayFortTransaction
+from ecommerce_payfort.tests.fake_gateway import FakePayFortGateway
+
+PaymentProcessorResponse = get_model("payment", "PaymentProcessorResponse")
+Source = get_model("payment", "Source")
+SourceType = get_model("payment", "SourceType")
+
+
+class BackfillTransactionsTests(TestCase):  # pylint: disable=too-many-ancestors
+    """ Tests for the payfort_backfill_transactions command. """
+    def setUp(self):
+        """ Set up the test. """
+        super().setUp()
+        self.basket = utils.Basket.objects.create(site=self.site)
+        self.responses = [
+            PaymentProcessorResponse.objects.create(
+                processor_name="payfort",
+                transaction_id=f"ECOMMERCE-{index}",
+                basket=self.basket,
+                response={
+                    "view": "PayFortFeedbackView",
+                    "response": {
+                        "merchant_reference": f"1-2-{self.basket.id}",
+                        "fort_id": str(index),
+                        "status": "14",
+                        "amount": "2000",
+                    },
+                },
+            )
+            for index in range(5)
+        ]
+        PaymentProcessorResponse.objects.create(processor_name="other", transaction_id="other", response={})
+
+    def _call(self, *args):
+        """ Call the command and return its output. """
+        out = StringIO()
+        call_command("payfort_backfill_transactions", *args, stdout=out)
+        return out.getvalue()
+
+    def test_backfill(self):
+        """ Verify that the command backfills the PayFort responses in chunks. """
+        output = self._call("--chunk-size", "2")
+        self.assertEqual(
+            sorted(PayFortTransaction.objects.values_list("processor_response_id", flat=True)),
+            [response.id for response in self.responses],
+        )
+        transaction = PayFortTransaction.objects.get(fort_id="3")
+        self.assertEqual(transaction.basket_id, self.basket.id)
+        self.assertEqual(transaction.amount, 2000)
+        self.assertEqual(transaction.created, self.responses[3].created)
+        self.assertEqual(output.count("transactions created"), 3)
+        self.assertIn(
+            f"Backfilled 5 PayFort transactions. Last processor response ID: {self.responses[-1].id}", output,
+        )
+
+    def test_backfill_idempotent(self):
+        """ Verify that the existing transactions are not created again. """
+        PayFortTransaction.build(self.responses[0].id, {}).save()
+        self._call()
+        output = self._call()
+        self.assertEqual(PayFortTransaction.objects.count(), 5)
+        self.assertIn("Backfilled 0 PayFort transactions", output)
+
+    def test_backfill_start_id(self):
+        """ Verify that the backfill can be resumed after a given processor response. """
+        output = self._call("--start-id", str(self.responses[2].id))
+        self.assertEqual(PayFortTransaction.objects.count(), 2)
+        self.assertIn("Backfilled 2 PayFort transactions", output)
+
+    def test_backfill_nothing(self):
+        """ Verify that the command reports the start ID when there is nothing to backfill. """
+        start_id = self.responses[-1].id + 100
+        output = self._call("--start-id", str(start_id))
+        self.assertIn(f"Backfilled 0 PayFort transactions. Last processor response ID: {start_id}", output)
+
+
+class ReconcileFrozenBasketsTests(TestCase):  # pylint: disable=too-many-ancestors
+    """ Tests for the payfort_reconcile_frozen_baskets command. """
+    def setUp(self):
+        """ Set up the test. """
+        super().setUp()
+        self.frozen = [self._create_basket(utils.Basket.FROZEN, "14") for _ in range(3)]
+        self.submitted = self._create_basket(utils.Basket.SUBMITTED, "14")
+        self.failed_payment = self._create_basket(utils.Basket.FROZEN, "13")
+        self.latest_response = self._create_response(self.frozen[0], "14", fort_id="latest")
+
+        patcher = patch("ecommerce_payfort.orders.EagerOrderQueue.execute", return_value=orders.JOB_SUCCEEDED)
+        self.mock_execute = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _create_response(self, basket, status, fort_id="123"):
+        """ Record a PayFort response of the given basket. """
+        response_data = {"merchant_reference": f"{self.site.id}-2-{basket.id}", "fort_id": fort_id, "status": status}
+        response = PaymentProcessorResponse.objects.create(
+            processor_name="payfort",
+            transaction_id=f"ECOMMERCE-{fort_id}",
+            basket=basket,
+            response={"view": "PayFortFeedbackView", "response": response_data},
+        )
+        PayFortTransaction.record(response, response_data)
+        return response
+
+    def _create_basket(self, status, payment_status):
+        """ Create a basket with a recorded PayFort response. """
+        basket = utils.Basket.objects.create(site=self.site, status=status)
+        self._create_response(basket, payment_status)
+        return basket
+
+    def _call(self, *args):
+        """ Call the command and return its JSON summary. """
+        out = StringIO()
+        call_command("payfort_reconcile_frozen_baskets", *args, stdout=out)
+        return json.loads(out.getvalue())
+
+    def test_get_candidates(self):
+        """ Verify that the candidates are the frozen baskets with a successful payment. """
+        self.assertEqual(
+            list(Command.get_candidates()),
+            [basket.id for basket in self.frozen],
+        )
+
+    def test_get_candidates_since(self):
+        """ Verify that the candidates can be limited to the recent payments. """
+        PayFortTransaction.objects.filter(basket_id=self.frozen[1].id).update(
+            created=timezone.now() - timedelta(days=10),
+        )
+        since = timezone.now() - timedelta(days=1)
+        self.assertEqual(
+            list(Command.get_candidates(since)),
+            [self.frozen[0].id, self.frozen[2].id],
+        )
+
+    def test_reconcile_since(self):
+        """ Verify that --since accepts a date or a date and time, and limits the candidates to the recent payments. """
+        PayFortTransaction.objects.filter(basket_id=self.frozen[1].id).update(
+            created=timezone.now() - timedelta(days=10),
+        )
+        since = (timezone.now() - timedelta(days=1)).date()
+        for value in (since.isoformat(), f"{since.isoformat()}T00:00:00", f"{since.isoformat()} 00:00:00+00:00"):
+            summary = self._call("--dry-run", "--since", value)
+            self.assertEqual(summary["basket_ids"], [self.frozen[0].id, self.frozen[2].id])
+
+    def test_reconcile_since_date(self):
+        """ Verify that a date-only --since stands for the midnight of that date in the current time zone. """
+        since = parse_since("2024-01-01")
+        self.assertTrue(timezone.is_aware(since))
+        self.assertEqual(timezone.make_naive(since), datetime(2024, 1, 1))
+
+    def test_reconcile_since_malformed(self):
+        """ Verify that a malformed --since is refused, instead of reconciling the whole history. """
+        for value in ("yesterday", "2024-13-01", "2024-01-01T25:00:00", ""):
+            with self.assertRaises(CommandError):
+                self._call("--since", value)
+        self.mock_execute.assert_not_called()
+
+    def test_get_latest_responses(self):
+        """ Verify that the latest successful response of each basket is used. """
+        with self.assertNumQueries(2):
+            responses = Command.get_latest_responses([basket.id for basket in self.frozen])
+        self.assertEqual(responses[self.frozen[0].id]["fort_id"], "latest")
+        self.assertEqual(responses[self.frozen[1].id]["fort_id"], "123")
+        self.assertEqual(len(responses), 3)
+
+    def test_dry_run(self):
+        """ Verify that the dry run lists the baskets without placing their orders. """
+        summary = self._call("--dry-run")
+        self.mock_execute.assert_not_called()
+        self.assertTrue(summary["dry_run"])
+        self.assertEqual(summary["candidates"], 3)
+        self.assertEqual(summary["basket_ids"], [basket.id for basket in self.frozen])
+        self.assertEqual(summary[orders.JOB_SUCCEEDED], 0)
+
+    def test_reconcile(self):
+        """ Verify that the orders are placed with the latest successful response, and summarized. """
+        def execute(site_id, basket_id, response_data):  # pylint: disable=unused-argument
+            """ Fail the second basket, and skip the third one. """
+            if basket_id == self.frozen[1].id:
+                orders.set_job_state(basket_id, orders.JOB_FAILED, 1, "ValueError: failure")
+                return orders.JOB_FAILED
+            if basket_id == self.frozen[2].id:
+                return orders.JOB_SKIPPED
+            return orders.JOB_SUCCEEDED
+
+        self.mock_execute.side_effect = execute
+        summary = self._call("--workers", "1", "--chunk-size", "2")
+        self.assertEqual(self.mock_execute.call_count, 3)
+        self.assertEqual(self.mock_execute.call_args_list[0][0][:2], (self.site.id, self.frozen[0].id))
+        self.assertEqual(self.mock_execute.call_args_list[0][0][2]["fort_id"], "latest")
+        self.assertFalse(summary["dry_run"])
+        self.assertEqual(summary["candidates"], 3)
+        self.assertEqual(summary[orders.JOB_SUCCEEDED], 1)
+        self.assertEqual(summary[orders.JOB_SKIPPED], 1)
+        self.assertEqual(summary[orders.JOB_FAILED], 1)
+        self.assertEqual(summary["failures"], [{"basket_id": self.frozen[1].id, "error": "ValueError: failure"}])
+        self.assertIn("duration", summary)
+
+    def test_reconcile_missing_response(self):
+        """ Verify that a basket which successful response cannot be read is counted, and not placed. """
+        PaymentProcessorResponse.objects.filter(basket=self.frozen[2]).update(response={})
+        summary = self._call("--workers", "1")
+        self.assertEqual(summary["missing_response"], 1)
+        self.assertEqual(self.mock_execute.call_count, 2)
+
+    def test_reconcile_basket_without_site(self):
+        """ Verify that the order of a basket without a site is placed for the site of its merchant reference. """
+        utils.Basket.objects.filter(id=self.frozen[0].id).update(site=None)
+        summary = self._call("--workers", "1")
+        self.assertEqual(summary[orders.JOB_SUCCEEDED], 3)
+        self.assertEqual(self.mock_execute.call_args_list[0][0][:2], (self.site.id, self.frozen[0].id))
+
+    def test_reconcile_bad_reference(self):
+        """ Verify that a basket which response has a malformed or mismatched merchant reference is not placed. """
+        for basket, merchant_reference in ((self.frozen[1], "bad reference"), (self.frozen[2], f"{self.site.id}-2-0")):
+            transaction = PayFortTransaction.objects.get(basket_id=basket.id, status="14")
+            PaymentProcessorResponse.objects.filter(id=transaction.processor_response_id).update(response={
+                "view": "PayFortFeedbackView",
+                "response": {"merchant_reference": merchant_reference, "fort_id": "123", "status": "14"},
+            })
+        summary = self._call("--workers", "1")
+        self.assertEqual(summary["bad_reference"], 2)
+        self.assertEqual(self.mock_execute.call_count, 1)
+
+    def test_reconcile_worker_pool(self):
+        """ Verify that the orders are placed in the worker threads, which close their database connections. """
+        with patch("ecommerce_payfort.management.commands.payfort_reconcile_frozen_baskets.connections") as mock_conn:
+            summary = self._call("--workers", "3")
+        self.assertEqual(summary[orders.JOB_SUCCEEDED], 3)
+        self.assertEqual(mock_conn.close_all.call_count, 3)
+        self.assertEqual(
+            sorted(call[0][1] for call in self.mock_execute.call_args_list),
+            [basket.id for basket in self.frozen],
+        )
+
+
+class CheckStatusTests(TestCase):  # pylint: disable=too-many-ancestors
+    """ Tests for the payfort_check_status command. """
+    def setUp(self):
+        """ Set up the test, with a fake gateway configured as the PayFort API. """
+        super().setUp()
+        self.gateway = FakePayFortGateway().start()
+        self.addCleanup(self.gateway.stop)
+        for index in range(5):
+            self.gateway.add_payment(f"1-2-{index}", fort_id=str(index))
+
+        patcher = patch.dict(settings.PAYMENT_PROCESSOR_CONFIG["edx"]["payfort"], {"api_url": self.gateway.url})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _call(self, *args):
+        """ Call the command and return its JSON summary. """
+        out = StringIO()
+        call_command("payfort_check_status", "--site-id", str(self.site.id), *args, stdout=out, stderr=StringIO())
+        return json.loads(out.getvalue())
+
+    def test_check_status(self):
+        """ Verify that the results are recorded in batches, and summarized. """
+        with NamedTemporaryFile("w", suffix=".txt") as references_file:
+            references_file.write("1-2-3\n\n1-2-4\n1-2-404\n")
+            references_file.flush()
+            summary = self._call("1-2-0", "1-2-3", "--file", references_file.name, "--batch-size", "2")
+
+        self.assertEqual(summary["checked"], 4)
+        self.assertEqual(summary["failed"], 0)
+        self.assertEqual(summary["transaction_statuses"], {"14": 3, "": 1})
+        self.assertEqual(
+            sorted(PayFortStatusCheck.objects.values_list("merchant_reference", "fort_id", "status")),
+            [("1-2-0", "0", "12"), ("1-2-3", "3", "12"), ("1-2-4", "4", "12"), ("1-2-404", "", "13")],
+        )
+
+    def test_check_status_failed(self):
+        """ Verify that the failed queries are recorded with their error. """
+        self.gateway.fail_next = [400]
+        summary = self._call("1-2-0", "--concurrency", "1", "--rate-limit", "100")
+        self.assertEqual(summary["failed"], 1)
+        self.assertIn("PayFort API request failed!", PayFortStatusCheck.objects.get().error)
+
+    def test_no_merchant_references(self):
+        """ Verify that the command requires merchant references. """
+        with self.assertRaises(CommandError):
+            self._call()
+
+    def test_bad_rate_limit(self):
+        """ Verify that the command requires a positive rate limit. """
+        with self.assertRaises(CommandError):
+            self._call("1-2-0", "--rate-limit", "0")
+
+    def test_site_not_found(self):
+        """ Verify that the command requires an existing site. """
+        with self.assertRaises(CommandError):
+            call_command("payfort_check_status", "1-2-0", "--site-id", "9999", stdout=StringIO())
+
+
+class RefundOrdersTests(TestCase):  # pylint: disable=too-many-ancestors
+    """ Tests for the payfort_refund_orders command. """
+    def setUp(self):
+        """ Set up the test, with an order paid with PayFort, and another one. """
+        super().setUp()
+        self.order = self._create_order("payfort", "course-v1:Org+Course+Run")
+        self.other_order = self._create_order("other", "course-v1:Org+Course+Run")
+        patcher = patch("ecommerce_payfort.refunds.RefundJob.run", return_value={"job_id": "job-1"})
+        self.mock_run = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _create_order(self, source_type_name, course_id):
+        """ Create an order of a seat in the given course run, paid with the given payment source. """
+        course = CourseFactory(id=course_id, partner=self.partner)
+        basket = factories.create_basket(empty=True)
+        basket.add_product(course.create_or_update_seat("verified", False, 20))
+        order = factories.create_order(basket=basket)
+        order.site = self.site
+        order.save()
+        Source.objects.create(
+            order=order,
+            source_type=SourceType.objects.get_or_create(name=source_type_name)[0],
+            reference="ECOMMERCE-123",
+            amount_allocated=order.total_incl_tax,
+        )
+        return order
+
+    def _call(self, *args):
+        """ Call the command and return its JSON summary. """
+        out = StringIO()
+        call_command("payfort_refund_orders", "--job-id", "job-1", "--site-id", str(self.site.id), *args, stdout=out)
+        return json.loads(out.getvalue())
+
+    def test_refund_orders(self):
+        """ Verify that the job refunds the given orders paid with PayFort. """
+        with NamedTemporaryFile("w", suffix=".txt") as numbers_file:
+            numbers_file.write(f"{self.other_order.number}\n\n")
+            numbers_file.flush()
+            summary = self._call(self.order.number, "--file", numbers_file.name, "--workers", "2")
+        self.assertEqual(summary, {"job_id": "job-1"})
+        self.assertEqual(list(self.mock_run.call_args[0][0]), [self.order])
+
+    def test_refund_course_orders(self):
+        """ Verify that the job refunds the orders of the given course run. """
+        self._create_order("payfort", "course-v1:Org+Other+Run")
+        self._call("--course-id", "course-v1:Org+Course+Run")
+        self.assertEqual(list(self.mock_run.call_args[0][0]), [self.order])
+
+    def test_refund_site_orders(self):
+        """ Verify that the job leaves out the orders of other sites. """
+        other_site_order = self._create_order("payfort", "course-v1:Org+Other+Run")
+        other_site_order.site = SiteConfigurationFactory(partner=self.partner).site
+        other_site_order.save()
+        self._call(self.order.number, other_site_order.number)
+        self.assertEqual(list(self.mock_run.call_args[0][0]), [self.order])
+
+    def test_no_orders(self):
+        """ Verify that the command requires orders. """
+        with self.assertRaises(CommandError):
+            self._call()
+
+    def test_site_not_found(self):
+        """ Verify that the command requires an existing site. """
+        with self.assertRaises(CommandError):
+            call_command("payfort_refund_orders", "EDX-1", "--job-id", "job-1", "--site-id", "9999", stdout=StringIO())
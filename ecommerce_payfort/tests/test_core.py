@@ -0,0 +1,36 @@
+"""Tests for core.py"""
+import importlib.util
+import subprocess
+import sys
+from unittest.mock import patch
+
+from ecommerce_payfort import core, utils
+
+
+def test_import_without_django():
+    """Verify that the core module and the API client are imported without Django nor the Oscar models."""
+    script = (
+        "import sys\n"
+        "import ecommerce_payfort.client, ecommerce_payfort.core\n"
+        "print(sorted(name for name in sys.modules if name.split('.')[0] in ('django', 'ecommerce')))\n"
+    )
+    result = subprocess.run([sys.executable, "-c", script], capture_output=True, check=True, text=True)
+    assert result.stdout.strip() == "[]"
+
+
+def test_gateway_error_without_oscar():
+    """Verify that the PayFort exceptions derive from Exception when Oscar is not installed."""
+    spec = importlib.util.spec_from_file_location("payfort_core_without_oscar", core.__file__)
+    module = importlib.util.module_from_spec(spec)
+    with patch.dict(sys.modules, {"oscar.apps.payment.exceptions": None}):
+        spec.loader.exec_module(module)
+
+    assert module.GatewayError is Exception
+    assert module.PayFortException.__bases__ == (Exception,)
+
+
+def test_utils_reexports():
+    """Verify that utils re-exports the core helpers, so that both modules share the same exceptions and signers."""
+    assert utils.PayFortException is core.PayFortException
+    assert utils.verify_signature is core.verify_signature
+    assert utils.get_signer is core.get_signer
@@ -0,0 +1,68 @@
+"""Tests for duplicates.py"""
+from unittest.mock import patch
+
+import pytest
+from django.core.cache import cache
+
+from ecommerce_payfort import duplicates
+
+
+@pytest.fixture(autouse=True)
+def clear_state():
+    """Clear the cache and the duplicate counter around each test."""
+    cache.clear()
+    duplicates.duplicate_stats.reset()
+    yield
+    cache.clear()
+    duplicates.duplicate_stats.reset()
+
+
+@pytest.fixture
+def response_data():
+    """Return a verified response."""
+    return {"fort_id": "169996200000000001", "status": "14", "signature": "the-signature", "amount": "100"}
+
+
+def test_get_key(response_data):  # pylint: disable=redefined-outer-name
+    """Verify that the key is made of the fort_id, the status and the signature."""
+    assert duplicates.get_key(response_data) == "payfort_seen:169996200000000001:14:the-signature"
+
+
+@pytest.mark.parametrize("missing_key", ["fort_id", "status", "signature"])
+def test_get_key_missing_field(response_data, missing_key):  # pylint: disable=redefined-outer-name
+    """Verify that no key is built when a field is missing."""
+    response_data[missing_key] = ""
+    assert duplicates.get_key(response_data) is None
+    duplicates.mark_seen(response_data)
+    assert duplicates.is_seen(response_data) is False
+
+
+def test_mark_seen(response_data):  # pylint: disable=redefined-outer-name
+    """Verify that a response is seen once marked, and that the duplicates are counted."""
+    assert duplicates.is_seen(response_data) is False
+    duplicates.mark_seen(response_data)
+    assert duplicates.is_seen(response_data) is True
+    assert duplicates.is_seen(response_data) is True
+    assert duplicates.duplicate_stats.as_dict() == {"duplicates": 2}
+
+
+def test_other_status_not_seen(response_data):  # pylint: disable=redefined-outer-name
+    """Verify that a response of the same payment with another status is not a duplicate."""
+    duplicates.mark_seen(response_data)
+    response_data["status"] = "15"
+    assert duplicates.is_seen(response_data) is False
+
+
+def test_mark_seen_ttl(response_data):  # pylint: disable=redefined-outer-name
+    """Verify that the response is remembered for the TTL."""
+    with patch("ecommerce_payfort.duplicates.cache") as mock_cache:
+        duplicates.mark_seen(response_data)
+    mock_cache.set.assert_called_once_with(duplicates.get_key(response_data), True, duplicates.TTL)
+
+
+def test_duplicate_counted(response_data):  # pylint: disable=redefined-outer-name
+    """Verify that the duplicates are counted by the instrumentation sink."""
+    duplicates.mark_seen(response_data)
+    with patch("ecommerce_payfort.duplicates.instrumentation.increment") as mock_increment:
+        duplicates.is_seen(response_data)
+    mock_increment.assert_called_once_with("callback.duplicate")
@@ -0,0 +1,145 @@
+"""Tests for instrumentation.py"""
+from unittest.mock import patch
+
+import pytest
+from django.db import connection
+from django.test import override_settings
+
+from ecommerce_payfort import instrumentation
+
+
+@pytest.fixture(autouse=True)
+def clear_sink():
+    """Drop the configured sink around each test."""
+    instrumentation.get_sink.cache_clear()
+    yield
+    instrumentation.get_sink.cache_clear()
+
+
+@pytest.fixture
+def in_memory_sink():
+    """Configure the in-memory sink."""
+    with override_settings(PAYFORT_INSTRUMENTATION_SINK="ecommerce_payfort.instrumentation.InMemorySink"):
+        instrumentation.get_sink.cache_clear()
+        yield instrumentation.get_sink()
+
+
+def test_get_sink_default():
+    """Verify that the no-op sink is used by default, and that the instance is reused."""
+    sink = instrumentation.get_sink()
+    assert type(sink) is instrumentation.NoOpSink  # pylint: disable=unidiomatic-typecheck
+    assert instrumentation.get_sink() is sink
+
+
+def test_no_op_sink():
+    """Verify that the no-op sink accepts the measurements, and that the stages skip the measurement."""
+    sink = instrumentation.NoOpSink()
+    assert sink.observe("a-stage", 1.0, 2) is None
+    assert sink.increment("a-counter") is None
+    with patch("ecommerce_payfort.instrumentation.time.perf_counter") as mock_perf_counter:
+        with instrumentation.stage("a-stage"):
+            pass
+    mock_perf_counter.assert_not_called()
+    instrumentation.increment("a-counter")
+
+
+def test_histogram():
+    """Verify that a histogram counts each value in the bucket of the lowest bound it doesn't exceed."""
+    histogram = instrumentation.Histogram((1, 5))
+    for value in (0, 1, 2, 5, 6, 100):
+        histogram.observe(value)
+    assert histogram.as_dict() == {"count": 6, "sum": 114, "buckets": {"1": 2, "5": 2, "+Inf": 2}}
+
+
+def test_logging_sink():
+    """Verify that the logging sink logs the histograms of a stage once every log_interval measurements."""
+    sink = instrumentation.LoggingSink()
+    sink.log_interval = 2
+    with patch("ecommerce_payfort.instrumentation.logger.info") as mock_info:
+        sink.observe("a-stage", 0.0125, 3)
+        mock_info.assert_not_called()
+        sink.observe("a-stage", 0.5, 3)
+        sink.increment("a-counter", 2)
+    assert mock_info.call_count == 2
+    message, stage_name, durations, queries = mock_info.call_args_list[0][0]
+    assert message == "PayFort stage %s histograms. Duration (s): %s. Queries: %s"
+    assert stage_name == "a-stage"
+    assert durations["count"] == 2
+    assert durations["buckets"]["0.025"] == 1
+    assert durations["buckets"]["0.5"] == 1
+    assert queries["buckets"]["5"] == 2
+    assert mock_info.call_args_list[1][0] == ("PayFort counter %s incremented by %d", "a-counter", 2)
+    assert sink.histograms("a-stage") is None
+
+
+def test_logging_sink_flush():
+    """Verify that flush logs the histograms not logged yet, and starts them over."""
+    sink = instrumentation.LoggingSink()
+    sink.observe("a-stage", 0.0125, 3)
+    sink.observe("another-stage", 20.0, 200)
+    with patch("ecommerce_payfort.instrumentation.logger.info") as mock_info:
+        sink.flush()
+    assert [call[0][1] for call in mock_info.call_args_list] == ["a-stage", "another-stage"]
+    assert mock_info.call_args_list[1][0][2]["buckets"]["+Inf"] == 1
+    assert mock_info.call_args_list[1][0][3]["buckets"]["+Inf"] == 1
+    assert sink.histograms("a-stage") is None
+
+
+def test_in_memory_sink():
+    """Verify that the in-memory sink keeps the measurements until cleared."""
+    sink = instrumentation.InMemorySink()
+    sink.observe("a-stage", 0.5, 1)
+    sink.observe("a-stage", 0.25, 2)
+    sink.increment("a-counter")
+    sink.increment("a-counter", 2)
+    assert sink.durations("a-stage") == [0.5, 0.25]
+    assert sink.queries("a-stage") == [1, 2]
+    assert sink.durations("another-stage") == []
+    assert sink.queries("another-stage") == []
+    assert sink.counters == {"a-counter": 3}
+    histograms = sink.histograms("a-stage")
+    assert histograms["duration"]["count"] == 2
+    assert histograms["duration"]["sum"] == 0.75
+    assert histograms["duration"]["buckets"]["0.25"] == 1
+    assert histograms["duration"]["buckets"]["0.5"] == 1
+    assert histograms["queries"]["buckets"] == {
+        "0": 0, "1": 1, "2": 1, "5": 0, "10": 0, "20": 0, "50": 0, "100": 0, "+Inf": 0,
+    }
+    assert sink.histograms("another-stage") is None
+    sink.clear()
+    assert sink.durations("a-stage") == []
+    assert sink.histograms("a-stage") is None
+    assert not sink.counters
+
+
+def test_stage_duration(in_memory_sink):  # pylint: disable=redefined-outer-name
+    """Verify that a stage reports its duration, even when its block raises."""
+    with patch("ecommerce_payfort.instrumentation.time.perf_counter", side_effect=[10.0, 10.5, 20.0, 20.25]):
+        with instrumentation.stage("a-stage"):
+            pass
+        with pytest.raises(ValueError):
+            with instrumentation.stage("a-stage"):
+                raise ValueError("failure")
+    assert in_memory_sink.durations("a-stage") == [0.5, 0.25]
+    assert in_memory_sink.queries("a-stage") == [0, 0]
+
+
+@pytest.mark.django_db
+def test_stage_queries(in_memory_sink):  # pylint: disable=redefined-outer-name
+    """Verify that a stage counts the queries of its block, including the ones of the nested stages."""
+    with instrumentation.stage("outer"):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        with instrumentation.stage("inner"):
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1")
+                cursor.execute("SELECT 1")
+    assert in_memory_sink.queries("outer") == [3]
+    assert in_memory_sink.queries("inner") == [2]
+
+
+def test_increment(in_memory_sink):  # pylint: disable=redefined-outer-name
+    """Verify that increment reaches the configured sink."""
+    instrumentation.increment("a-counter")
+    instrumentation.increment("a-counter", 4)
+    assert in_memory_sink.counters == {"a-counter": 5}
@@ -0,0 +1,88 @@
+"""Tests for locks.py"""
+from unittest.mock import patch
+
+import pytest
+from django.core.cache import cache
+from django.test import override_settings
+
+from ecommerce_payfort import locks
+
+
+@pytest.fixture(autouse=True)
+def clear_state():
+    """Clear the cache and the lock counters around each test."""
+    cache.clear()
+    locks.lock_stats.reset()
+    yield
+    cache.clear()
+    locks.lock_stats.reset()
+
+
+def test_acquire_release():
+    """Verify that a lock can be acquired again once released."""
+    token = locks.acquire_lock("1-2-3")
+    assert token is not None
+    assert locks.acquire_lock("1-2-3") is None
+    assert locks.acquire_lock("1-2-4") is not None
+    locks.release_lock("1-2-3", token)
+    assert locks.acquire_lock("1-2-3") is not None
+    assert locks.lock_stats.as_dict() == {"acquired": 3, "contended": 1}
+
+
+def test_acquire_timeout():
+    """Verify that the lock is added with its timeout."""
+    with patch("ecommerce_payfort.locks.cache") as mock_cache:
+        locks.acquire_lock("1-2-3", timeout=5)
+    assert mock_cache.add.call_args[0][0] == "payfort_lock:1-2-3"
+    assert mock_cache.add.call_args[0][2] == 5
+
+
+def test_acquire_default_timeout():
+    """Verify that the lock is added with the timeout of the lock timeout setting, if any."""
+    with patch("ecommerce_payfort.locks.cache") as mock_cache:
+        locks.acquire_lock("1-2-3")
+        with override_settings(PAYFORT_PAYMENT_LOCK_TIMEOUT=1800):
+            with locks.payment_lock("1-2-4"):
+                pass
+    assert [call[0][2] for call in mock_cache.add.call_args_list] == [locks.DEFAULT_LOCK_TIMEOUT, 1800]
+
+
+def test_acquire_contention_logged():
+    """Verify that the lock contention is logged."""
+    locks.acquire_lock("1-2-3")
+    with patch("ecommerce_payfort.locks.logger.info") as mock_info:
+        locks.acquire_lock("1-2-3")
+    mock_info.assert_called_once_with("PayFort lock contention on merchant_reference: %s", "1-2-3")
+
+
+def test_release_other_token():
+    """Verify that a lock acquired by someone else after expiring is not released."""
+    token = locks.acquire_lock("1-2-3")
+    locks.release_lock("1-2-3", "another-token")
+    assert cache.get(locks.get_lock_key("1-2-3")) == token
+
+
+def test_payment_lock():
+    """Verify that payment_lock tells whether the lock was acquired, and releases it at the end of the block."""
+    with locks.payment_lock("1-2-3") as acquired:
+        assert acquired is True
+        with locks.payment_lock("1-2-3") as acquired_again:
+            assert acquired_again is False
+        assert cache.get(locks.get_lock_key("1-2-3")) is not None
+    assert cache.get(locks.get_lock_key("1-2-3")) is None
+
+
+def test_payment_lock_released_on_error():
+    """Verify that payment_lock releases the lock when the block raises."""
+    with pytest.raises(ValueError):
+        with locks.payment_lock("1-2-3"):
+            raise ValueError("failure")
+    assert cache.get(locks.get_lock_key("1-2-3")) is None
+
+
+def test_acquire_counted():
+    """Verify that the acquired and the contended locks are counted by the instrumentation sink."""
+    with patch("ecommerce_payfort.locks.instrumentation.increment") as mock_increment:
+        locks.acquire_lock("1-2-3")
+        locks.acquire_lock("1-2-3")
+    assert [call[0][0] for call in mock_increment.call_args_list] == ["lock.acquired", "lock.contended"]
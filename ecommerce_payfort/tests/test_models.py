@@ -0,0 +1,134 @@
+""" Tests for the models of the PayFort payment processor. """
+from datetime import datetime, timezone
+from decimal import Decimal
+from unittest.mock import Mock
+
+import ddt
+from ecommerce.tests.testcases import TestCase
+
+from ecommerce_payfort.models import PayFortRefund, PayFortStatusCheck, PayFortTransaction
+
+
+@ddt.ddt
+class PayFortTransactionTests(TestCase):  # pylint: disable=too-many-ancestors
+    """ Tests for the PayFortTransaction model. """
+    def setUp(self):
+        """ Set up the test. """
+        super().setUp()
+        self.response_data = {
+            "merchant_reference": "1-2-3",
+            "fort_id": "169996200000000001",
+            "eci": "ECOMMERCE",
+            "status": "14",
+            "response_code": "14000",
+            "amount": "2000",
+        }
+
+    def test_build(self):
+        """ Verify that build reads the fields of the response data. """
+        created = datetime(2024, 1, 2, tzinfo=timezone.utc)
+        transaction = PayFortTransaction.build(18, self.response_data, created=created)
+        self.assertIsNone(transaction.pk)
+        self.assertEqual(transaction.processor_response_id, 18)
+        self.assertEqual(transaction.merchant_reference, "1-2-3")
+        self.assertEqual(transaction.basket_id, 3)
+        self.assertEqual(transaction.fort_id, "169996200000000001")
+        self.assertEqual(transaction.eci, "ECOMMERCE")
+        self.assertEqual(transaction.status, "14")
+        self.assertEqual(transaction.response_code, "14000")
+        self.assertEqual(transaction.amount, 2000)
+        self.assertEqual(transaction.created, created)
+        self.assertEqual(str(transaction), "1-2-3 (169996200000000001): 14")
+
+    def test_build_basket_id(self):
+        """ Verify that the given basket ID takes precedence over the merchant reference. """
+        self.assertEqual(PayFortTransaction.build(18, self.response_data, basket_id=7).basket_id, 7)
+
+    @ddt.data(
+        {},
+        {"merchant_reference": "bad", "amount": "bad"},
+        {"merchant_reference": "1-2--3", "amount": "-1"},
+        {"merchant_reference": "1-2-2147483648", "amount": "99999999999999999999"},
+        {"merchant_reference": None, "amount": None, "status": None},
+    )
+    def test_build_bad_format(self, response_data):
+        """ Verify that build reads the responses with a bad format leniently. """
+        transaction = PayFortTransaction.build(18, response_data)
+        self.assertIsNone(transaction.basket_id)
+        self.assertIsNone(transaction.amount)
+        self.assertEqual(transaction.status, "")
+        self.assertIsNotNone(transaction.created)
+
+    def test_build_truncated(self):
+        """ Verify that build truncates the values that are too long for their column. """
+        self.response_data["status"] = "1" * 20
+        self.assertEqual(PayFortTransaction.build(18, self.response_data).status, "1" * 8)
+
+    def test_record_out_of_range(self):
+        """ Verify that the values that don't fit their column are saved as None instead of failing. """
+        self.response_data.update({"merchant_reference": "1-2-2147483648", "amount": "2147483648"})
+        transaction = PayFortTransaction.record(Mock(id=18, basket_id=None, created=None), self.response_data)
+        transaction.refresh_from_db()
+        self.assertIsNone(transaction.basket_id)
+        self.assertIsNone(transaction.amount)
+
+    def test_record(self):
+        """ Verify that record saves the transaction of the processor response. """
+        created = datetime(2024, 1, 2, tzinfo=timezone.utc)
+        transaction = PayFortTransaction.record(Mock(id=18, basket_id=None, created=created), self.response_data)
+        self.assertEqual(PayFortTransaction.objects.get(), transaction)
+        self.assertEqual(transaction.basket_id, 3)
+        self.assertEqual(transaction.created, created)
+        self.assertEqual(PayFortTransaction.objects.filter(fort_id="169996200000000001").latest(), transaction)
+
+
+class PayFortStatusCheckTests(TestCase):  # pylint: disable=too-many-ancestors
+    """ Tests for the PayFortStatusCheck model. """
+    def test_build(self):
+        """ Verify that build reads the fields of the CHECK_STATUS response. """
+        checked = datetime(2024, 1, 2, tzinfo=timezone.utc)
+        status_check = PayFortStatusCheck.build("1-2-3", {
+            "merchant_reference": "1-2-3",
+            "fort_id": "169996200000000001",
+            "status": "12",
+            "response_code": "12000",
+            "transaction_status": "14",
+            "amount": "2000",
+        }, checked=checked)
+        self.assertEqual(status_check.basket_id, 3)
+        self.assertEqual(status_check.fort_id, "169996200000000001")
+        self.assertEqual(status_check.status, "12")
+        self.assertEqual(status_check.response_code, "12000")
+        self.assertEqual(status_check.transaction_status, "14")
+        self.assertEqual(status_check.amount, 2000)
+        self.assertEqual(status_check.error, "")
+        self.assertEqual(status_check.checked, checked)
+        self.assertEqual(str(status_check), "1-2-3: 14")
+
+    def test_build_error(self):
+        """ Verify that a failed query is built with its error. """
+        status_check = PayFortStatusCheck.build("bad", ValueError("failure"))
+        self.assertIsNone(status_check.basket_id)
+        self.assertEqual(status_check.transaction_status, "")
+        self.assertEqual(status_check.error, "failure")
+        self.assertIsNotNone(status_check.checked)
+        self.assertEqual(str(status_check), "bad: failure")
+        status_check.save()
+        self.assertEqual(PayFortStatusCheck.objects.latest(), status_check)
+
+
+class PayFortRefundTests(TestCase):  # pylint: disable=too-many-ancestors
+    """ Tests for the PayFortRefund model. """
+    def test_create(self):
+        """ Verify that a refund is created as pending, with the idempotency key of its job and order. """
+        refund = PayFortRefund.objects.create(
+            job_id="job-1",
+            order_number="EDX-100001",
+            idempotency_key=PayFortRefund.get_idempotency_key("job-1", "EDX-100001"),
+            amount=Decimal("20.00"),
+            currency="SAR",
+        )
+        self.assertEqual(refund.idempotency_key, "job-1-EDX-100001")
+        self.assertEqual(refund.status, PayFortRefund.PENDING)
+        self.assertEqual(refund.attempts, 0)
+        self.assertEqual(str(refund), "job-1: EDX-100001 (pending)")
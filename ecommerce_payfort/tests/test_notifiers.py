@@ -0,0 +1,111 @@
+"""Tests for notifiers.py"""
+import threading
+from unittest.mock import patch
+
+import pytest
+from django.core.cache import cache
+from django.test import override_settings
+
+from ecommerce_payfort import notifiers
+
+
+@pytest.fixture(autouse=True)
+def clear_state():
+    """Clear the cache and the configured notifier around each test."""
+    cache.clear()
+    notifiers.get_notifier.cache_clear()
+    yield
+    cache.clear()
+    notifiers.get_notifier.cache_clear()
+
+
+@pytest.mark.parametrize("method, args", [
+    ("notify", (1,)),
+    ("wait", (1, 0)),
+])
+def test_base_notifier_not_implemented(method, args):
+    """Verify that the base notifier does not implement the methods."""
+    with pytest.raises(NotImplementedError):
+        getattr(notifiers.BaseNotifier(), method)(*args)
+
+
+def test_cache_notifier_notified():
+    """Verify that the cache notifier returns immediately when the basket is already notified."""
+    notifier = notifiers.CacheNotifier()
+    notifier.notify(7)
+    with patch("ecommerce_payfort.notifiers.time.sleep") as mock_sleep:
+        assert notifier.wait(7, 10) is True
+    mock_sleep.assert_not_called()
+
+
+def test_cache_notifier_other_basket():
+    """Verify that the cache notifier only wakes up the waiters of the notified basket."""
+    notifier = notifiers.CacheNotifier()
+    notifier.notify(8)
+    assert notifier.wait(7, 0) is False
+
+
+def test_cache_notifier_notified_while_waiting():
+    """Verify that the cache notifier wakes up when the basket is notified while waiting."""
+    notifier = notifiers.CacheNotifier()
+    with patch("ecommerce_payfort.notifiers.time.sleep", side_effect=lambda _: notifier.notify(7)) as mock_sleep:
+        assert notifier.wait(7, 10) is True
+    mock_sleep.assert_called_once_with(notifier.POLL_INTERVAL)
+
+
+def test_cache_notifier_timeout():
+    """Verify that the cache notifier never sleeps beyond the timeout."""
+    notifier = notifiers.CacheNotifier()
+    with patch("ecommerce_payfort.notifiers.time.monotonic", side_effect=[100, 100.1, 100.2]):
+        with patch("ecommerce_payfort.notifiers.time.sleep") as mock_sleep:
+            assert notifier.wait(7, 0.2) is False
+    mock_sleep.assert_called_once()
+    assert mock_sleep.call_args[0][0] == pytest.approx(0.1)
+
+
+def test_cache_notifier_ttl():
+    """Verify that the cache notifier sets the key with its TTL."""
+    with patch("ecommerce_payfort.notifiers.cache") as mock_cache:
+        notifiers.CacheNotifier().notify(7)
+    mock_cache.set.assert_called_once_with("payfort_submitted:7", True, notifiers.CacheNotifier.TTL)
+
+
+def test_in_process_notifier():
+    """Verify that the in-process notifier wakes up a waiting thread."""
+    notifier = notifiers.InProcessNotifier()
+    result = {}
+
+    def wait():
+        result["notified"] = notifier.wait(7, 10)
+
+    thread = threading.Thread(target=wait)
+    thread.start()
+    notifier.notify(7)
+    thread.join()
+    assert result["notified"] is True
+
+
+def test_in_process_notifier_timeout():
+    """Verify that the in-process notifier returns False on timeout, and forgets the baskets when cleared."""
+    notifier = notifiers.InProcessNotifier()
+    assert notifier.wait(7, 0) is False
+    notifier.notify(7)
+    assert notifier.wait(7, 0) is True
+    notifier.clear()
+    assert notifier.wait(7, 0) is False
+
+
+def test_get_notifier_default():
+    """Verify that the cache notifier is used by default, and that the instance is reused."""
+    notifier = notifiers.get_notifier()
+    assert isinstance(notifier, notifiers.CacheNotifier)
+    assert notifiers.get_notifier() is notifier
+
+
+def test_get_notifier_setting():
+    """Verify that the notifier is replaced when the setting changes."""
+    default_notifier = notifiers.get_notifier()
+    with override_settings(PAYFORT_STATUS_NOTIFIER="ecommerce_payfort.notifiers.InProcessNotifier"):
+        assert isinstance(notifiers.get_notifier(), notifiers.InProcessNotifier)
+    assert notifiers.get_notifier() is not default_notifier
+    assert isinstance(notifiers.get_notifier(), notifiers.CacheNotifier)
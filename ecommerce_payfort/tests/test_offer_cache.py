@@ -0,0 +1,150 @@
+""" Tests for the cache of the offers applied to the frozen baskets. """
+from decimal import Decimal
+from unittest.mock import Mock, patch
+
+from django.core.cache import cache
+from ecommerce.tests.testcases import TestCase
+from oscar.apps.offer.applicator import Applicator
+from oscar.apps.partner import strategy
+from oscar.test import factories
+
+from ecommerce_payfort import offer_cache, utils
+
+
+class OfferCacheTests(TestCase):  # pylint: disable=too-many-ancestors
+    """ Tests for the offer cache. """
+    def setUp(self):
+        """ Set up the test with a frozen basket, discounted by a site offer. """
+        super().setUp()
+        cache.clear()
+        offer_range = factories.RangeFactory(includes_all_products=True)
+        self.offer = factories.ConditionalOfferFactory(
+            condition=factories.ConditionFactory(range=offer_range, type="Count", value=1),
+            benefit=factories.BenefitFactory(range=offer_range, type="Percentage", value=10),
+            offer_type="Site",
+        )
+        self.basket = factories.create_basket()
+        self.basket.strategy = strategy.Default()
+        Applicator().apply(self.basket, self.basket.owner, None)
+        self.basket.status = utils.Basket.FROZEN
+        self.basket.save()
+
+    def _load_basket(self):
+        """ Return the basket freshly loaded, with its strategy set. """
+        basket = utils.Basket.objects.get(id=self.basket.id)
+        basket.strategy = strategy.Default()
+        return basket
+
+    def test_record_and_apply(self):
+        """ Verify that the recorded offers give the same discounts, without looking up all the offers. """
+        offer_cache.record(self.basket)
+        self.assertEqual(cache.get(offer_cache.get_key(self.basket.id)), {
+            "offers": [(self.offer.id, None)],
+            "total_incl_tax": self.basket.total_incl_tax,
+        })
+
+        basket = self._load_basket()
+        with patch.object(Applicator, "get_offers") as mock_get_offers:
+            self.assertTrue(offer_cache.apply_recorded_offers(Applicator(), basket))
+        mock_get_offers.assert_not_called()
+        self.assertEqual(basket.total_incl_tax, self.basket.total_incl_tax)
+        self.assertEqual(basket.total_discount, self.basket.total_discount)
+        self.assertGreater(basket.total_discount, 0)
+        self.assertEqual([application["offer"] for application in basket.offer_applications], [self.offer])
+
+    def test_not_frozen(self):
+        """ Verify that only the offers of the frozen baskets are recorded and reused. """
+        self.basket.status = utils.Basket.OPEN
+        offer_cache.record(self.basket)
+        self.assertIsNone(cache.get(offer_cache.get_key(self.basket.id)))
+        self.assertFalse(offer_cache.apply_recorded_offers(Mock(), self.basket))
+
+    def test_not_recorded(self):
+        """ Verify that the offers must be applied in full when they are not recorded. """
+        applicator = Mock()
+        self.assertFalse(offer_cache.apply_recorded_offers(applicator, self._load_basket()))
+        applicator.apply_offers.assert_not_called()
+
+    def test_unsaved_offer_not_recorded(self):
+        """ Verify that the offers are not recorded when one of them is not saved in the database. """
+        self.basket.offer_applications.applications[None] = {"offer": Mock(pk=None), "voucher": None}
+        offer_cache.record(self.basket)
+        self.assertIsNone(cache.get(offer_cache.get_key(self.basket.id)))
+
+    def test_total_changed(self):
+        """ Verify that the offers must be applied in full when the recorded ones give another total. """
+        cache.set(offer_cache.get_key(self.basket.id), {
+            "offers": [(self.offer.id, None)],
+            "total_incl_tax": self.basket.total_incl_tax + Decimal("1.00"),
+        })
+        basket = self._load_basket()
+        with patch("ecommerce_payfort.offer_cache.logger.warning") as mock_warning:
+            self.assertFalse(offer_cache.apply_recorded_offers(Applicator(), basket))
+        mock_warning.assert_called_once()
+        self.assertEqual(len(basket.offer_applications), 0)
+
+    def test_offer_deleted(self):
+        """ Verify that the offers must be applied in full when a recorded offer no longer exists. """
+        cache.set(offer_cache.get_key(self.basket.id), {
+            "offers": [(self.offer.id + 1000, None)],
+            "total_incl_tax": self.basket.total_incl_tax,
+        })
+        applicator = Mock()
+        self.assertFalse(offer_cache.apply_recorded_offers(applicator, self._load_basket()))
+        applicator.apply_offers.assert_not_called()
+
+    def test_load_offers_voucher(self):
+        """ Verify that the voucher offers are given their voucher back, as long as the basket still has it. """
+        voucher = factories.VoucherFactory()
+        self.assertIsNone(offer_cache.load_offers(self.basket, [(self.offer.id, voucher.id)]))
+
+        self.basket.vouchers.add(voucher)
+        offers = offer_cache.load_offers(self.basket, [(self.offer.id, voucher.id)])
+        self.assertEqual(offers, [self.offer])
+        self.assertEqual(offers[0].get_voucher(), voucher)
+
+    def test_version_bumped(self):
+        """ Verify that changing an offer or a voucher drops the recorded offers. """
+        offer_cache.record(self.basket)
+        key = offer_cache.get_key(self.basket.id)
+        self.offer.priority += 1
+        self.offer.save()
+        self.assertNotEqual(offer_cache.get_key(self.basket.id), key)
+        self.assertFalse(offer_cache.apply_recorded_offers(Mock(), self._load_basket()))
+
+        key = offer_cache.get_key(self.basket.id)
+        factories.VoucherFactory()
+        self.assertNotEqual(offer_cache.get_key(self.basket.id), key)
+
+    def test_version_kept_on_usage(self):
+        """ Verify that recording the usage of an offer or a voucher keeps the recorded offers. """
+        voucher = factories.VoucherFactory()
+        order = factories.create_order()
+        offer = type(self.offer).objects.get(id=self.offer.id)
+        key = offer_cache.get_key(self.basket.id)
+        offer.record_usage({"freq": 1, "discount": Decimal("2.00")})
+        voucher.record_usage(order, factories.UserFactory())
+        voucher.record_discount({"discount": Decimal("2.00")})
+        voucher.save(update_fields=["num_orders"])
+        self.assertEqual(offer_cache.get_key(self.basket.id), key)
+
+        offer.suspend()
+        self.assertNotEqual(offer_cache.get_key(self.basket.id), key)
+
+    def test_is_definition_changed(self):
+        """ Verify that the saves of the usage counters are told apart, and that an unknown definition changed. """
+        self.assertFalse(offer_cache.is_definition_changed(self.offer, ["num_orders", "total_discount"]))
+        self.offer.__dict__.pop(offer_cache.DEFINITION_ATTRIBUTE, None)
+        self.assertTrue(offer_cache.is_definition_changed(self.offer))
+        self.assertFalse(offer_cache.is_definition_changed(self.offer))
+        self.offer.num_orders += 1
+        self.assertFalse(offer_cache.is_definition_changed(self.offer))
+        self.offer.priority += 1
+        self.assertTrue(offer_cache.is_definition_changed(self.offer))
+
+    def test_version_stable(self):
+        """ Verify that the offers version is kept until an offer changes. """
+        version = offer_cache.get_offers_version()
+        self.assertEqual(offer_cache.get_offers_version(), version)
+        cache.delete(offer_cache.VERSION_KEY)
+        self.assertNotEqual(offer_cache.get_offers_version(), version)
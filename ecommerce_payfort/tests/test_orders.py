@@ -0,0 +1,230 @@
+""" Tests for the order placement of the PayFort payments. """
+import threading
+from unittest.mock import Mock, patch
+
+from django.core.cache import cache
+from django.test import override_settings
+from ecommerce.tests.factories import UserFactory
+from ecommerce.tests.testcases import TestCase
+from oscar.apps.partner import strategy
+
+from ecommerce_payfort import locks, offer_cache, orders, status_cache, utils
+
+
+class OrderPlacementTests(TestCase):  # pylint: disable=too-many-ancestors
+    """ Tests for the order placement helpers and the OrderPlacer. """
+    def setUp(self):
+        """ Set up the test. """
+        super().setUp()
+        cache.clear()
+        self.user = UserFactory()
+        self.basket = utils.Basket.objects.create(owner=self.user, site=self.site, status=utils.Basket.FROZEN)
+        self.response_data = {"merchant_reference": f"{self.site.id}-{self.user.id}-{self.basket.id}"}
+
+    def test_prepare_basket(self):
+        """ Verify that prepare_basket sets the strategy and applies the offers. """
+        request = Mock()
+        with patch("ecommerce_payfort.orders.get_applicator") as mock_applicator:
+            self.assertIs(orders.prepare_basket(self.basket, request), self.basket)
+        self.assertIsNotNone(self.basket.strategy)
+        mock_applicator.return_value.apply.assert_called_once_with(self.basket, self.user, request)
+        self.assertIsNotNone(cache.get(offer_cache.get_key(self.basket.id)))
+
+    def test_prepare_basket_recorded_offers(self):
+        """ Verify that prepare_basket reuses the offers recorded for a frozen basket. """
+        self.basket.strategy = strategy.Default()
+        offer_cache.record(self.basket)
+        with patch("ecommerce_payfort.orders.get_applicator") as mock_applicator:
+            orders.prepare_basket(self.basket, Mock())
+        mock_applicator.return_value.apply_offers.assert_called_once_with(self.basket, [])
+        mock_applicator.return_value.apply.assert_not_called()
+
+    def test_announce_order(self):
+        """ Verify that announce_order caches the receipt URL, then notifies the waiting requests. """
+        request = Mock()
+        with patch("ecommerce_payfort.orders.get_receipt_page_url", return_value="a-url") as mock_url:
+            with patch("ecommerce_payfort.orders.get_notifier") as mock_notifier:
+                orders.announce_order(request, self.basket, "1-2-3", Mock(number="EDX-100001"))
+        mock_url.assert_called_once_with(
+            request=request,
+            site_configuration=self.site.siteconfiguration,
+            order_number="EDX-100001",
+        )
+        self.assertEqual(status_cache.get_receipt_url("1-2-3"), "a-url")
+        mock_notifier.return_value.notify.assert_called_once_with(self.basket.id)
+
+    def test_build_request(self):
+        """ Verify that build_request builds a request of the site and the user. """
+        request = orders.build_request(self.site, self.user)
+        self.assertEqual(request.site, self.site)
+        self.assertEqual(request.user, self.user)
+        self.assertEqual(request.get_host(), self.site.domain)
+
+    def test_place(self):
+        """ Verify that the OrderPlacer handles the payment and creates the order of a frozen basket. """
+        placer = orders.OrderPlacer(self.site)
+        with patch.object(placer, "handle_payment") as mock_handle_payment:
+            with patch.object(placer, "create_order") as mock_create_order:
+                with patch("ecommerce_payfort.orders.announce_order") as mock_announce:
+                    with patch("ecommerce_payfort.orders.prepare_basket") as mock_prepare:
+                        order = placer.place(self.basket.id, self.response_data)
+        self.assertEqual(order, mock_create_order.return_value)
+        mock_prepare.assert_called_once()
+        mock_handle_payment.assert_called_once_with(self.response_data, self.basket)
+        request = mock_create_order.call_args[0][0]
+        self.assertEqual(request.user, self.user)
+        mock_create_order.assert_called_once_with(request, self.basket)
+        mock_announce.assert_called_once_with(
+            request, self.basket, self.response_data["merchant_reference"], order,
+        )
+
+    def test_place_loads_basket_by_reference(self):
+        """ Verify that the OrderPlacer loads the basket by the full merchant reference. """
+        placer = orders.OrderPlacer(self.site)
+        with patch("ecommerce_payfort.orders.utils.load_callback_basket", return_value=None) as mock_load:
+            with self.assertRaises(utils.PayFortException):
+                placer.place(self.basket.id, self.response_data)
+        mock_load.assert_called_once_with(self.site.id, self.user.id, self.basket.id)
+
+    def test_place_mismatched_reference(self):
+        """ Verify that the OrderPlacer refuses a merchant reference of another basket, or a malformed one. """
+        placer = orders.OrderPlacer(self.site)
+        for merchant_reference in (f"{self.site.id}-{self.user.id}-{self.basket.id + 1}", "bad", None):
+            with self.assertRaises(utils.PayFortException):
+                placer.place(self.basket.id, {"merchant_reference": merchant_reference})
+
+    def test_place_submitted_basket(self):
+        """ Verify that the OrderPlacer skips a basket that is already submitted. """
+        self.basket.status = utils.Basket.SUBMITTED
+        self.basket.save()
+        placer = orders.OrderPlacer(self.site)
+        with patch.object(placer, "handle_payment") as mock_handle_payment:
+            self.assertIsNone(placer.place(self.basket.id, self.response_data))
+        mock_handle_payment.assert_not_called()
+
+    def test_place_locked(self):
+        """ Verify that the OrderPlacer skips a basket which order is being placed by another callback. """
+        locks.acquire_lock(self.response_data["merchant_reference"])
+        placer = orders.OrderPlacer(self.site)
+        with patch.object(placer, "handle_payment") as mock_handle_payment:
+            self.assertIsNone(placer.place(self.basket.id, self.response_data))
+        mock_handle_payment.assert_not_called()
+
+
+class OrderQueueTests(TestCase):  # pylint: disable=too-many-ancestors
+    """ Tests for the order placement queues. """
+    def setUp(self):
+        """ Set up the test. """
+        super().setUp()
+        cache.clear()
+        orders.get_order_queue.cache_clear()
+        self.addCleanup(orders.get_order_queue.cache_clear)
+        patcher = patch("ecommerce_payfort.orders.OrderPlacer")
+        self.mock_placer = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch("ecommerce_payfort.orders.time.sleep")
+        self.mock_sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_base_queue_enqueue(self):
+        """ Verify that the base queue does not implement enqueue. """
+        with self.assertRaises(NotImplementedError):
+            orders.BaseOrderQueue().enqueue(self.site.id, 7, {})
+
+    def test_execute_succeeded(self):
+        """ Verify that a successful job is recorded as succeeded. """
+        self.assertEqual(orders.BaseOrderQueue().execute(self.site.id, 7, {"a": 1}), orders.JOB_SUCCEEDED)
+        self.mock_placer.assert_called_once_with(self.site)
+        self.mock_placer.return_value.place.assert_called_once_with(7, {"a": 1})
+        self.assertEqual(orders.get_job_state(7), {"status": orders.JOB_SUCCEEDED, "attempts": 1, "error": None})
+
+    def test_execute_skipped(self):
+        """ Verify that a job of an already submitted basket is recorded as skipped. """
+        self.mock_placer.return_value.place.return_value = None
+        self.assertEqual(orders.BaseOrderQueue().execute(self.site.id, 7, {}), orders.JOB_SKIPPED)
+        self.assertEqual(orders.get_job_state(7)["status"], orders.JOB_SKIPPED)
+
+    def test_execute_retried(self):
+        """ Verify that a failed job is retried with an increasing delay, and keeps the last error visible. """
+        states = []
+
+        def place(*args):  # pylint: disable=unused-argument
+            """ Fail twice, recording the visible state of the job on each attempt. """
+            states.append(orders.get_job_state(7))
+            if len(states) < 3:
+                raise ValueError(f"failure {len(states)}")
+            return Mock()
+
+        self.mock_placer.return_value.place.side_effect = place
+        self.assertEqual(orders.BaseOrderQueue().execute(self.site.id, 7, {}), orders.JOB_SUCCEEDED)
+        self.assertEqual(states, [
+            {"status": orders.JOB_RUNNING, "attempts": 0, "error": None},
+            {"status": orders.JOB_RUNNING, "attempts": 1, "error": "ValueError: failure 1"},
+            {"status": orders.JOB_RUNNING, "attempts": 2, "error": "ValueError: failure 2"},
+        ])
+        self.assertEqual([call[0][0] for call in self.mock_sleep.call_args_list], [5, 10])
+        self.assertEqual(orders.get_job_state(7), {"status": orders.JOB_SUCCEEDED, "attempts": 3, "error": None})
+
+    def test_execute_failed(self):
+        """ Verify that a job failing on all its attempts is recorded as failed. """
+        self.mock_placer.return_value.place.side_effect = ValueError("failure")
+        with patch("ecommerce_payfort.orders.set_job_state", wraps=orders.set_job_state) as mock_set_state:
+            self.assertEqual(orders.BaseOrderQueue().execute(self.site.id, 7, {}), orders.JOB_FAILED)
+        self.assertIn(((7, orders.JOB_RETRYING, 1, "ValueError: failure"),), mock_set_state.call_args_list)
+        self.assertEqual(self.mock_sleep.call_count, 2)
+        self.assertEqual(orders.get_job_state(7), {
+            "status": orders.JOB_FAILED, "attempts": 3, "error": "ValueError: failure",
+        })
+
+    def test_eager_queue(self):
+        """ Verify that the eager queue runs the job right away, without retries. """
+        self.mock_placer.return_value.place.side_effect = ValueError("failure")
+        orders.EagerOrderQueue().enqueue(self.site.id, 7, {})
+        self.mock_placer.return_value.place.assert_called_once_with(7, {})
+        self.mock_sleep.assert_not_called()
+        self.assertEqual(orders.get_job_state(7)["status"], orders.JOB_FAILED)
+
+    def test_thread_pool_queue(self):
+        """ Verify that the thread pool queue runs the job in a worker thread, and closes its connections. """
+        queue = orders.ThreadPoolOrderQueue()
+        self.addCleanup(queue.shutdown)
+        with patch.object(queue, "execute") as mock_execute:
+            with patch("ecommerce_payfort.orders.connections") as mock_connections:
+                queue.enqueue(self.site.id, 7, {"a": 1})
+                queue.shutdown()
+        mock_execute.assert_called_once_with(self.site.id, 7, {"a": 1})
+        mock_connections.close_all.assert_called_once()
+        self.assertEqual(orders.get_job_state(7)["status"], orders.JOB_QUEUED)
+
+    def test_thread_pool_queue_pending(self):
+        """ Verify that a basket is not enqueued again while its job is pending. """
+        queue = orders.ThreadPoolOrderQueue()
+        self.addCleanup(queue.shutdown)
+        started = threading.Event()
+        release = threading.Event()
+
+        def execute(*args):  # pylint: disable=unused-argument
+            """ Block the worker thread until released. """
+            started.set()
+            release.wait(5)
+
+        with patch.object(queue, "execute", side_effect=execute) as mock_execute:
+            with patch("ecommerce_payfort.orders.connections"):
+                queue.enqueue(self.site.id, 7, {})
+                started.wait(5)
+                queue.enqueue(self.site.id, 7, {})
+                release.set()
+                queue.shutdown()
+        self.assertEqual(mock_execute.call_count, 1)
+
+    def test_get_order_queue_default(self):
+        """ Verify that no order queue is configured by default. """
+        self.assertIsNone(orders.get_order_queue())
+
+    def test_get_order_queue_setting(self):
+        """ Verify that the configured order queue is reused, and replaced when the setting changes. """
+        with override_settings(PAYFORT_ORDER_QUEUE="ecommerce_payfort.orders.EagerOrderQueue"):
+            queue = orders.get_order_queue()
+            self.assertIsInstance(queue, orders.EagerOrderQueue)
+            self.assertIs(orders.get_order_queue(), queue)
+        self.assertIsNone(orders.get_order_queue())
@@ -1,13 +1,30 @@
 """ Tests for the PayFort payment processor. """
+import copy
+from decimal import Decimal
 from unittest.mock import patch
 import ddt
 from django.conf import settings as django_settings
+from django.core.cache import cache
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from ecommerce.courses.tests.factories import CourseFactory
 from ecommerce.extensions.payment.processors import HandledProcessorResponse
 from ecommerce.extensions.payment.tests.processors.mixins import PaymentProcessorTestCaseMixin
+from ecommerce.tests.factories import SiteConfigurationFactory, UserFactory
 from ecommerce.tests.testcases import TestCase
+from oscar.apps.partner import strategy
+from oscar.apps.payment.exceptions import GatewayError
+from oscar.core.loading import get_model
+from oscar.test.factories import create_product, create_stockrecord
 
-from ecommerce_payfort.processors import PayFort
-from ecommerce_payfort import utils
+from ecommerce_payfort.client import DEFAULT_API_URL
+from ecommerce_payfort.processors import DEFAULT_GATEWAY_URL, PayFort, ProcessorCache, get_processor, processor_cache
+from ecommerce_payfort import instrumentation, offer_cache, utils
+from ecommerce_payfort.models import PayFortTransaction
+from ecommerce_payfort.tests.fake_gateway import FakePayFortGateway
+
+PaymentProcessorResponse = get_model("payment", "PaymentProcessorResponse")
 
 
 @ddt.ddt
@@ -16,18 +33,26 @@ class PayFortTests(PaymentProcessorTestCaseMixin, TestCase):  # pylint: disable=
     processor_name = "payfort"
     processor_class = PayFort
 
-    @classmethod
-    def setUpClass(cls):
-        """ Set up the test class. """
-        super().setUpClass()
-        cls.patcher = patch("ecommerce_payfort.utils.get_currency", return_value=utils.VALID_CURRENCY)
-        cls.mock_get_currency = cls.patcher.start()
+    def setUp(self):
+        """ Set up the test. """
+        super().setUp()
+        self.basket.all_lines().update(price_currency=utils.VALID_CURRENCY)
+
+    def _create_basket(self, line_count):
+        """ Create a basket of seats in different courses, where the course is set on the parent product. """
+        basket = utils.Basket.objects.create(owner=UserFactory(), site=self.site)
+        basket.strategy = strategy.Default()
+        for _ in range(line_count):
+            parent = create_product(title="Parent", structure="parent", course=CourseFactory(partner=self.partner))
+            product = create_product(title="Seat", parent=parent)
+            create_stockrecord(
+                product, price_excl_tax=Decimal("20.00"), num_in_stock=10, currency=utils.VALID_CURRENCY,
+            )
+            basket.add_product(product)
 
-    @classmethod
-    def tearDownClass(cls):
-        """ Tear down the test class. """
-        cls.patcher.stop()
-        super().tearDownClass()
+        basket = utils.Basket.objects.get(id=basket.id)
+        basket.strategy = strategy.Default()
+        return basket
 
     def test_init(self):
         """ Verify the processor initializes from the configuration. """
@@ -40,25 +65,75 @@ class PayFortTests(PaymentProcessorTestCaseMixin, TestCase):  # pylint: disable=
         self.assertEqual(processor.response_sha_phrase, settings["response_sha_phrase"])
         self.assertEqual(processor.sha_method, settings["sha_method"])
         self.assertEqual(processor.ecommerce_url_root, settings["ecommerce_url_root"])
+        self.assertEqual(processor.api_url, settings.get("api_url", DEFAULT_API_URL))
+        self.assertEqual(processor.gateway_url, settings.get("gateway_url", DEFAULT_GATEWAY_URL))
+        self.assertEqual(processor.direct_submit, settings.get("direct_submit", False))
+
+    def test_api_client(self):
+        """ Verify that the processor keeps one API client, configured like the processor. """
+        processor = self.processor_class(self.site)
+        client = processor.api_client
+        self.assertIs(processor.api_client, client)
+        self.assertEqual(client.access_code, processor.access_code)
+        self.assertEqual(client.response_sha_phrase, processor.response_sha_phrase)
+        self.assertEqual(client.api_url, processor.api_url)
+
+    def test_signers(self):
+        """ Verify that the processor uses the shared signers of its SHA phrases. """
+        processor = self.processor_class(self.site)
+        self.assertIs(
+            processor.request_signer,
+            utils.get_signer(processor.request_sha_phrase, processor.sha_method),
+        )
+        self.assertIs(
+            processor.response_signer,
+            utils.get_signer(processor.response_sha_phrase, processor.sha_method),
+        )
+
+    def _get_response_data(self):
+        """ Return a valid response data. """
+        return {
+            "merchant_reference": f"{self.site.id}-{self.basket.owner.id}-{self.basket.id}",
+            "command": "PURCHASE",
+            "merchant_identifier": "mid123",
+            "amount": "2000",
+            "currency": "SAR",
+            "response_code": "14000",
+            "signature": "the-signature",
+            "status": utils.SUCCESS_STATUS,
+            "eci": "ECOMMERCE",
+            "fort_id": "1234567890",
+            "card_number": "1234",
+            "payment_option": "VISA",
+        }
 
     def test_handle_processor_response(self):
         """ Verify that the processor creates the appropriate PaymentEvent and Source objects. """
-        with patch("ecommerce_payfort.utils.get_transaction_id", return_value="1234567890"):
-            response = {
-                "amount": "2000",
-                "currency": "SAR",
-                "card_number": "1234",
-                "payment_option": "VISA",
-            }
-            expected_result = HandledProcessorResponse(
-                transaction_id="1234567890",
-                total=20.0,
-                currency="SAR",
-                card_number="1234",
-                card_type="VISA"
-            )
+        expected_result = HandledProcessorResponse(
+            transaction_id="ECOMMERCE-1234567890",
+            total=20.0,
+            currency="SAR",
+            card_number="1234",
+            card_type="VISA"
+        )
+        actual_result = self.processor.handle_processor_response(self._get_response_data())
+        self.assertEqual(expected_result, actual_result)
+
+    def test_handle_processor_response_parsed(self):
+        """ Verify that the processor uses the parsed response as-is without verifying it again. """
+        response = utils.verify_response_format(self._get_response_data())
+        with patch("ecommerce_payfort.utils.verify_response_format") as mock_verify_response_format:
             actual_result = self.processor.handle_processor_response(response)
-            self.assertEqual(expected_result, actual_result)
+        mock_verify_response_format.assert_not_called()
+        self.assertEqual(actual_result.transaction_id, "ECOMMERCE-1234567890")
+        self.assertEqual(actual_result.total, 20.0)
+
+    def test_handle_processor_response_bad_format(self):
+        """ Verify that the processor refuses a raw response with a bad format. """
+        response_data = self._get_response_data()
+        response_data["currency"] = "USD"
+        with self.assertRaises(utils.PayFortException):
+            self.processor.handle_processor_response(response_data)
 
     def test_get_transaction_parameters(self):
         """ Verify the processor returns the appropriate parameters required to complete a transaction. """
@@ -89,14 +164,184 @@ class PayFortTests(PaymentProcessorTestCaseMixin, TestCase):  # pylint: disable=
         print("actual_result: ", actual_result)
         self.assertDictEqual(expected_result, actual_result)
 
-    def test_issue_credit_error(self):
-        """not used"""
+    def test_get_transaction_parameters_queries(self):
+        """ Verify that the number of queries does not grow with the number of lines in the basket. """
+        query_counts = []
+        for line_count in (1, 5):
+            basket = self._create_basket(line_count)
+            with CaptureQueriesContext(connection) as queries:
+                self.processor.get_transaction_parameters(basket, request=self.request)
+            query_counts.append(len(queries))
+        self.assertEqual(query_counts[0], query_counts[1])
+
+    def test_get_transaction_parameters_snapshot(self):
+        """ Verify that the processor builds the basket fields from a single snapshot of the basket. """
+        basket = self._create_basket(3)
+        with patch("ecommerce_payfort.utils.get_amount") as mock_get_amount:
+            actual_result = self.processor.get_transaction_parameters(basket, request=self.request)
+        mock_get_amount.assert_not_called()
+        self.assertEqual(actual_result["amount"], 6000)
+        self.assertEqual(actual_result["order_description"], utils.get_order_description(basket))
+
+    def test_get_transaction_parameters_records_offers(self):
+        """ Verify that the offers applied to the frozen basket are recorded for the PayFort callbacks. """
+        basket = self._create_basket(1)
+        basket.status = utils.Basket.FROZEN
+        self.processor.get_transaction_parameters(basket, request=self.request)
+        self.assertEqual(
+            cache.get(offer_cache.get_key(basket.id)),
+            {"offers": [], "total_incl_tax": basket.total_incl_tax},
+        )
+
+    def test_get_transaction_parameters_instrumented(self):
+        """ Verify that the stages of get_transaction_parameters are reported to the instrumentation sink. """
+        basket = self._create_basket(2)
+        with override_settings(PAYFORT_INSTRUMENTATION_SINK="ecommerce_payfort.instrumentation.InMemorySink"):
+            sink = instrumentation.get_sink()
+            with CaptureQueriesContext(connection) as queries:
+                self.processor.get_transaction_parameters(basket, request=self.request)
+        for stage_name in ("processor.get_transaction_parameters", "processor.basket_snapshot", "processor.sign"):
+            self.assertEqual(len(sink.durations(stage_name)), 1)
+        self.assertEqual(sink.queries("processor.get_transaction_parameters"), [len(queries)])
+        self.assertEqual(sink.queries("processor.sign"), [0])
+
+    def _start_gateway(self):
+        """ Start a fake gateway knowing the payment of the basket, and return a processor configured to use it. """
+        gateway = FakePayFortGateway().start()
+        self.addCleanup(gateway.stop)
+        gateway.add_payment(utils.get_merchant_reference(self.site.id, self.basket), fort_id="1234567890")
+        with patch.dict(django_settings.PAYMENT_PROCESSOR_CONFIG["edx"]["payfort"], {"api_url": gateway.url}):
+            processor = self.processor_class(self.site)
+        return gateway, processor
 
     def test_issue_credit(self):
-        """Verify that issue_credit raises a NotImplementedError."""
-        with self.assertRaises(NotImplementedError) as exc:
-            self.processor.issue_credit("order_number", self.basket, "reference_number", 2000, "SAR")
+        """ Verify that issue_credit refunds the payment, and records the response. """
+        gateway, processor = self._start_gateway()
+        transaction_id = processor.issue_credit(
+            "EDX-100001", self.basket, "ECOMMERCE-1234567890", Decimal("15.00"), "SAR", maintenance_reference="key-1",
+        )
+        self.assertEqual(transaction_id, "REFUND-key-1")
+        query = gateway.requests[0]
+        self.assertEqual(query["command"], "REFUND")
+        self.assertEqual(query["merchant_reference"], utils.get_merchant_reference(self.site.id, self.basket))
+        self.assertEqual(
+            (query["amount"], query["fort_id"], query["maintenance_reference"]),
+            (1500, "1234567890", "key-1"),
+        )
+
+        processor_response = PaymentProcessorResponse.objects.get(transaction_id=transaction_id)
+        self.assertEqual(processor_response.basket, self.basket)
+        self.assertEqual(processor_response.response["command"], "REFUND")
+        self.assertEqual(processor_response.response["response"]["status"], "06")
+        self.assertEqual(PayFortTransaction.objects.get(processor_response_id=processor_response.id).status, "06")
+
+    def test_issue_credit_maintenance_reference(self):
+        """ Verify that issue_credit uses a new maintenance reference when not given, and no unknown fort_id. """
+        gateway, processor = self._start_gateway()
+        transaction_id = processor.issue_credit("EDX-100001", self.basket, "none-none", Decimal("15.00"), "SAR")
+        maintenance_reference = gateway.requests[0]["maintenance_reference"]
+        self.assertEqual(len(maintenance_reference), 32)
+        self.assertEqual(transaction_id, f"REFUND-{maintenance_reference}")
+        self.assertNotIn("fort_id", gateway.requests[0])
+
+    def test_issue_credit_error(self):
+        """ Verify that a declined refund is recorded, and raises a GatewayError. """
+        _, processor = self._start_gateway()
+        with self.assertRaises(GatewayError) as exc:
+            processor.issue_credit("EDX-100001", self.basket, "ECOMMERCE-1234567890", Decimal("25.00"), "SAR")
         self.assertEqual(
             str(exc.exception),
-            "PayFort processor cannot issue credits or refunds from Open edX ecommerce."
+            "PayFort refund declined! order_number: EDX-100001. "
+            "response_code: 00029. response_message: Amount exceeded",
+        )
+        self.assertEqual(PayFortTransaction.objects.get().status, "07")
+
+    def test_issue_credit_request_failed(self):
+        """ Verify that a refund which request failed raises a GatewayError, without recording a response. """
+        gateway, processor = self._start_gateway()
+        gateway.fail_next = [503]
+        with self.assertRaises(GatewayError) as exc:
+            processor.issue_credit("EDX-100001", self.basket, "ECOMMERCE-1234567890", Decimal("15.00"), "SAR")
+        self.assertIn(
+            "PayFort refund failed! order_number: EDX-100001. PayFort API request failed!",
+            str(exc.exception),
         )
+        self.assertFalse(PayFortTransaction.objects.exists())
+
+
+class ProcessorCacheTests(TestCase):  # pylint: disable=too-many-ancestors
+    """ Tests for the cache of PayFort processors. """
+    def setUp(self):
+        """ Set up the test. """
+        super().setUp()
+        self.cache = ProcessorCache(maxsize=2)
+
+    def test_get_processor(self):
+        """ Verify that get_processor returns the same processor for the same site. """
+        processor = get_processor(self.site)
+        self.assertIsInstance(processor, PayFort)
+        self.assertEqual(processor.site, self.site)
+        self.assertIs(get_processor(self.site), processor)
+
+    def test_get_cached(self):
+        """ Verify that the processor is created only once per site. """
+        with patch("ecommerce_payfort.processors.PayFort", wraps=PayFort) as mock_payfort:
+            processor = self.cache.get(self.site)
+            self.assertIs(self.cache.get(self.site), processor)
+        mock_payfort.assert_called_once_with(self.site)
+
+    def test_get_partner_changed(self):
+        """ Verify that the processor is created again when the partner of the site changes. """
+        processor = self.cache.get(self.site)
+        self.site.siteconfiguration.partner.short_code = "other"
+        self.assertIsNot(self.cache.get(self.site), processor)
+
+    def test_max_size(self):
+        """ Verify that the least recently used processor is evicted when the cache is full. """
+        sites = [SiteConfigurationFactory(partner=self.partner).site for _ in range(2)]
+        processor = self.cache.get(self.site)
+        self.cache.get(sites[0])
+        self.assertIs(self.cache.get(self.site), processor)
+        self.cache.get(sites[1])
+        self.assertEqual(len(self.cache), 2)
+        self.assertIs(self.cache.get(self.site), processor)
+        self.assertIsNot(self.cache.get(sites[0]), processor)
+
+    def test_clear_while_creating(self):
+        """ Verify that a processor created before clearing the cache is not cached. """
+        def clear_then_create(site):
+            """ Clear the cache while the processor is being created. """
+            self.cache.clear()
+            return PayFort(site)
+
+        with patch("ecommerce_payfort.processors.PayFort", side_effect=clear_then_create):
+            self.cache.get(self.site)
+        self.assertEqual(len(self.cache), 0)
+
+    def test_cleared_on_site_configuration_change(self):
+        """ Verify that the cached processors are dropped when a site configuration changes. """
+        processor = get_processor(self.site)
+        self.site.siteconfiguration.save()
+        self.assertEqual(len(processor_cache), 0)
+        self.assertIsNot(get_processor(self.site), processor)
+
+    def test_cleared_on_partner_change(self):
+        """ Verify that the cached processors are dropped when a partner changes. """
+        get_processor(self.site)
+        self.partner.save()
+        self.assertEqual(len(processor_cache), 0)
+
+    def test_cleared_on_payment_config_change(self):
+        """ Verify that the cached processors are dropped when the payment processors configuration changes. """
+        processor = get_processor(self.site)
+        config = copy.deepcopy(django_settings.PAYMENT_PROCESSOR_CONFIG)
+        config["edx"]["payfort"]["access_code"] = "changed"
+        with override_settings(PAYMENT_PROCESSOR_CONFIG=config):
+            self.assertEqual(get_processor(self.site).access_code, "changed")
+        self.assertIsNot(get_processor(self.site), processor)
+
+    def test_not_cleared_on_other_setting_change(self):
+        """ Verify that the cached processors are kept when any other setting changes. """
+        processor = get_processor(self.site)
+        with override_settings(PAYFORT_UNRELATED_SETTING=True):
+            self.assertIs(get_processor(self.site), processor)
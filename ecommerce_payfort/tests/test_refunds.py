@@ -0,0 +1,157 @@
+""" Tests for the bulk refunds of the PayFort payments. """
+from decimal import Decimal
+from unittest.mock import patch
+
+from django.conf import settings
+from ecommerce.tests.factories import UserFactory
+from ecommerce.tests.testcases import TestCase
+from oscar.core.loading import get_model
+from oscar.test import factories
+
+from ecommerce_payfort import utils
+from ecommerce_payfort.models import PayFortRefund
+from ecommerce_payfort.processors import PayFort
+from ecommerce_payfort.refunds import RefundJob
+from ecommerce_payfort.tests.fake_gateway import FakePayFortGateway
+
+Order = get_model("order", "Order")
+Source = get_model("payment", "Source")
+SourceType = get_model("payment", "SourceType")
+
+
+class RefundJobTests(TestCase):  # pylint: disable=too-many-ancestors
+    """ Tests for the RefundJob. """
+    def setUp(self):
+        """ Set up the test, with three orders paid with PayFort and a fake gateway knowing their payments. """
+        super().setUp()
+        self.gateway = FakePayFortGateway().start()
+        self.addCleanup(self.gateway.stop)
+        patcher = patch.dict(settings.PAYMENT_PROCESSOR_CONFIG["edx"]["payfort"], {"api_url": self.gateway.url})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.processor = PayFort(self.site)
+        self.orders = [self._create_order(f"ECOMMERCE-{index}") for index in range(3)]
+
+    def _create_order(self, reference, source_type_name=PayFort.NAME):
+        """ Create an order paid with the given payment source, and add its payment to the fake gateway. """
+        basket = factories.create_basket()
+        basket.owner = UserFactory()
+        basket.site = self.site
+        basket.save()
+        order = factories.create_order(basket=basket, user=basket.owner)
+        Source.objects.create(
+            order=order,
+            source_type=SourceType.objects.get_or_create(name=source_type_name)[0],
+            reference=reference,
+            amount_allocated=order.total_incl_tax,
+        )
+        self.gateway.add_payment(
+            utils.get_merchant_reference(self.site.id, basket),
+            fort_id=reference.split("-")[-1],
+            amount=str(int(order.total_incl_tax * 100)),
+        )
+        return order
+
+    def _get_orders(self):
+        """ Return the queryset of the orders of the test. """
+        return Order.objects.filter(id__in=[order.id for order in self.orders])
+
+    def test_get_refunds(self):
+        """ Verify that the refunds are created as pending once per job and order. """
+        job = RefundJob("job-1", self.processor)
+        refunds = job.get_refunds(self.orders[:2])
+        self.assertEqual(sorted(refunds), sorted(order.number for order in self.orders[:2]))
+        refund = refunds[self.orders[0].number]
+        self.assertEqual(refund.status, PayFortRefund.PENDING)
+        self.assertEqual(refund.idempotency_key, f"job-1-{self.orders[0].number}")
+        self.assertEqual(refund.amount, self.orders[0].total_incl_tax)
+        self.assertEqual(refund.currency, self.orders[0].currency)
+
+        self.assertEqual(job.get_refunds(self.orders)[self.orders[0].number], refund)
+        self.assertEqual(PayFortRefund.objects.count(), 3)
+        RefundJob("job-2", self.processor).get_refunds(self.orders)
+        self.assertEqual(PayFortRefund.objects.count(), 6)
+
+    def test_run(self):
+        """ Verify that the orders are refunded in chunks, and that the failures are recorded. """
+        other_order = self._create_order("other", source_type_name="other")
+        self.orders.append(other_order)
+        with patch.object(RefundJob, "chunk_size", 2):
+            summary = RefundJob("job-1", self.processor, max_workers=1).run(self._get_orders())
+
+        self.assertEqual(summary["job_id"], "job-1")
+        self.assertEqual(summary["orders"], 4)
+        self.assertEqual(summary[PayFortRefund.SUCCEEDED], 3)
+        self.assertEqual(summary[PayFortRefund.FAILED], 1)
+        self.assertEqual(summary["failures"], [{
+            "order_number": other_order.number,
+            "error": "ValueError: The order was not paid with PayFort",
+        }])
+        self.assertIn("duration", summary)
+
+        refund = PayFortRefund.objects.get(order_number=self.orders[0].number)
+        self.assertEqual(refund.status, PayFortRefund.SUCCEEDED)
+        self.assertEqual(refund.transaction_id, f"REFUND-{refund.idempotency_key}")
+        self.assertEqual(refund.attempts, 1)
+        self.assertEqual(len(self.gateway.refunds), 3)
+
+    def test_run_resumed(self):
+        """ Verify that a job run again skips the succeeded refunds, and sends the others with the same key. """
+        job = RefundJob("job-1", self.processor, max_workers=1)
+        pending = job.get_refunds([self.orders[0]])[self.orders[0].number]
+        self.processor.issue_credit(
+            self.orders[0].number,
+            self.orders[0].basket,
+            "ECOMMERCE-0",
+            pending.amount,
+            pending.currency,
+            maintenance_reference=pending.idempotency_key,
+        )
+        self.gateway.fail_next = [400]
+
+        summary = job.run(self._get_orders())
+        self.assertEqual(summary[PayFortRefund.SUCCEEDED], 2)
+        self.assertEqual(summary[PayFortRefund.FAILED], 1)
+
+        summary = job.run(self._get_orders())
+        self.assertEqual(summary["already_refunded"], 2)
+        self.assertEqual(summary[PayFortRefund.SUCCEEDED], 1)
+        self.assertEqual(len(self.gateway.refunds), 3)
+        for order in self.orders:
+            merchant_reference = utils.get_merchant_reference(self.site.id, order.basket)
+            payment = self.gateway.payments[merchant_reference]
+            self.assertEqual(payment["refunded_amount"], payment["amount"])
+        self.assertEqual(PayFortRefund.objects.get(order_number=self.orders[0].number).attempts, 2)
+
+    def test_run_refunded_by_other_job(self):
+        """ Verify that a new job skips the orders already refunded by another job, but retries its failures. """
+        RefundJob("job-1", self.processor, max_workers=1).run(self._get_orders().filter(id=self.orders[0].id))
+        self.gateway.fail_next = [400]
+        RefundJob("job-2", self.processor, max_workers=1).run(self._get_orders().filter(id=self.orders[1].id))
+        self.assertEqual(len(self.gateway.refunds), 1)
+
+        summary = RefundJob("job-3", self.processor, max_workers=1).run(self._get_orders())
+        self.assertEqual(summary["already_refunded"], 1)
+        self.assertEqual(summary[PayFortRefund.SUCCEEDED], 2)
+        self.assertEqual(len(self.gateway.refunds), 3)
+        self.assertFalse(PayFortRefund.objects.filter(job_id="job-3", order_number=self.orders[0].number).exists())
+
+    def test_run_worker_pool(self):
+        """ Verify that the refunds are issued in the worker threads, which close their database connections. """
+        with patch.object(RefundJob, "refund", return_value=PayFortRefund.SUCCEEDED) as mock_refund:
+            with patch("ecommerce_payfort.refunds.connections") as mock_connections:
+                summary = RefundJob("job-1", self.processor, max_workers=3).run(self._get_orders())
+        self.assertEqual(summary[PayFortRefund.SUCCEEDED], 3)
+        self.assertEqual(mock_connections.close_all.call_count, 3)
+        self.assertEqual(
+            sorted(call[0][1].number for call in mock_refund.call_args_list),
+            sorted(order.number for order in self.orders),
+        )
+
+    def test_amount(self):
+        """ Verify that the full amount of the order is refunded. """
+        self.orders[0].total_incl_tax = Decimal("12.34")
+        self.orders[0].save()
+        RefundJob("job-1", self.processor, max_workers=1).run(self._get_orders().filter(id=self.orders[0].id))
+        self.assertEqual(self.gateway.requests[0]["amount"], 1234)
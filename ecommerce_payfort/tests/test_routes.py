@@ -0,0 +1,121 @@
+"""Tests for routes.py"""
+from unittest.mock import patch
+
+import pytest
+from django.http import HttpResponse
+from django.test import override_settings
+from django.urls import NoReverseMatch, clear_url_caches, include, re_path, reverse, set_script_prefix, set_urlconf
+
+from ecommerce_payfort import routes
+
+
+def dummy_view(request):  # pylint: disable=unused-argument
+    """Dummy view of the test routes."""
+    return HttpResponse()
+
+
+payfort_patterns = [
+    re_path(r"^response/$", dummy_view, name="response"),
+    re_path(r"^status/$", dummy_view, name="status"),
+    re_path(r"^handle_internal_error/(.+)/$", dummy_view, name="handle-internal-error"),
+]
+
+urlpatterns = [
+    re_path(r"^payfort/", include((payfort_patterns, "payfort"))),
+]
+
+
+class OtherURLConf:  # pylint: disable=too-few-public-methods
+    """URLconf serving the PayFort routes under another path."""
+    urlpatterns = [
+        re_path(r"^other/", include((payfort_patterns, "payfort"))),
+    ]
+
+
+@pytest.fixture(autouse=True)
+def urlconf():
+    """Use the routes of this module."""
+    with override_settings(ROOT_URLCONF=__name__):
+        yield
+    set_urlconf(None)
+    set_script_prefix("/")
+
+
+def test_reverse():
+    """Verify that the URL of a route is reversed once, then served from the cache."""
+    with patch("ecommerce_payfort.routes.django_reverse", wraps=reverse) as mock_reverse:
+        assert routes.reverse("payfort:status") == "/payfort/status/"
+        assert routes.reverse("payfort:status") == "/payfort/status/"
+    mock_reverse.assert_called_once_with("payfort:status")
+
+
+@pytest.mark.parametrize(
+    "arg", ["eci-123", "none-none", "with space", "a/b", "100%", "?query#fragment", "عربي", 42],
+)
+def test_reverse_with_arg(arg):
+    """Verify that the URL built from the prefix is the one reversed by Django."""
+    assert routes.reverse_with_arg("payfort:handle-internal-error", arg) == reverse(
+        "payfort:handle-internal-error", args=[arg],
+    )
+
+
+def test_reverse_with_arg_cached():
+    """Verify that the route is reversed once for all the arguments."""
+    with patch("ecommerce_payfort.routes.django_reverse", wraps=reverse) as mock_reverse:
+        assert routes.reverse_with_arg("payfort:handle-internal-error", "1-2") == "/payfort/handle_internal_error/1-2/"
+        assert routes.reverse_with_arg("payfort:handle-internal-error", "3-4") == "/payfort/handle_internal_error/3-4/"
+    mock_reverse.assert_called_once_with("payfort:handle-internal-error", args=[routes.ARG_PLACEHOLDER])
+
+
+def test_reverse_with_empty_arg():
+    """Verify that an empty argument doesn't match the route."""
+    with pytest.raises(NoReverseMatch):
+        routes.reverse_with_arg("payfort:handle-internal-error", "")
+
+
+def test_reverse_with_arg_unexpected_url():
+    """Verify that the route is reversed with the argument when the placeholder isn't found once in its URL."""
+    def reverse_twice(route_name, args):  # pylint: disable=unused-argument
+        """Return a URL holding the argument twice."""
+        return f"/{args[0]}/{args[0]}/"
+
+    with patch("ecommerce_payfort.routes.django_reverse", side_effect=reverse_twice):
+        assert routes.reverse_with_arg("payfort:handle-internal-error", "1-2") == "/1-2/1-2/"
+
+
+def test_absolute_url():
+    """Verify that the absolute URL joins the root URL of the site and the URL of the route."""
+    assert routes.absolute_url("https://ecommerce.example.com", "payfort:response") == (
+        "https://ecommerce.example.com/payfort/response/"
+    )
+    assert routes.absolute_url("https://other.example.com/", "payfort:response") == (
+        "https://other.example.com/payfort/response/"
+    )
+
+
+def test_cache_per_urlconf():
+    """Verify that the URLs follow the URLconf of the request."""
+    assert routes.reverse("payfort:status") == "/payfort/status/"
+    set_urlconf(OtherURLConf)
+    assert routes.reverse("payfort:status") == "/other/status/"
+    set_urlconf(None)
+    assert routes.reverse("payfort:status") == "/payfort/status/"
+
+
+def test_cache_per_script_prefix():
+    """Verify that the URLs follow the script prefix."""
+    assert routes.reverse("payfort:status") == "/payfort/status/"
+    set_script_prefix("/prefix/")
+    assert routes.reverse("payfort:status") == "/prefix/payfort/status/"
+    assert routes.reverse_with_arg("payfort:handle-internal-error", "1-2") == (
+        "/prefix/payfort/handle_internal_error/1-2/"
+    )
+
+
+def test_cache_dropped_on_reload():
+    """Verify that the cached URLs are dropped when the URLconfs are reloaded."""
+    routes.reverse("payfort:status")
+    clear_url_caches()
+    with patch("ecommerce_payfort.routes.django_reverse", wraps=reverse) as mock_reverse:
+        routes.reverse("payfort:status")
+    mock_reverse.assert_called_once_with("payfort:status")
@@ -0,0 +1,45 @@
+"""Tests for status_cache.py"""
+from unittest.mock import patch
+
+import pytest
+from django.core.cache import cache
+
+from ecommerce_payfort import status_cache
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    """Clear the cache around each test."""
+    cache.clear()
+    yield
+    cache.clear()
+
+
+def test_get_key():
+    """Verify that the key is prefixed."""
+    assert status_cache.get_key("1-2-3") == "payfort_status:1-2-3"
+
+
+def test_set_get_evict():
+    """Verify that a cached receipt URL is returned until it's evicted."""
+    assert status_cache.get_receipt_url("1-2-3") is None
+    status_cache.set_receipt_url("1-2-3", "a-url")
+    assert status_cache.get_receipt_url("1-2-3") == "a-url"
+    assert status_cache.get_receipt_url("1-2-4") is None
+    status_cache.evict("1-2-3")
+    assert status_cache.get_receipt_url("1-2-3") is None
+
+
+@pytest.mark.parametrize("merchant_reference", [None, ""])
+def test_get_receipt_url_empty_merchant_reference(merchant_reference):
+    """Verify that the cache is not read for an empty merchant reference."""
+    with patch("ecommerce_payfort.status_cache.cache") as mock_cache:
+        assert status_cache.get_receipt_url(merchant_reference) is None
+    mock_cache.get.assert_not_called()
+
+
+def test_set_receipt_url_ttl():
+    """Verify that the receipt URL is cached with the TTL."""
+    with patch("ecommerce_payfort.status_cache.cache") as mock_cache:
+        status_cache.set_receipt_url("1-2-3", "a-url")
+    mock_cache.set.assert_called_once_with("payfort_status:1-2-3", "a-url", status_cache.TTL)
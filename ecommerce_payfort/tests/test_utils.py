@@ -1,6 +1,12 @@
 """Tests for payfort_utils.py"""
+import hashlib
+import re
+from collections.abc import Mapping
 from unittest.mock import Mock, patch
+from urllib.parse import urlencode
+
 import pytest
+from django.http import QueryDict
 
 from ecommerce_payfort import utils
 from ecommerce_payfort.utils import verify_param as original_verify_param
@@ -128,6 +134,54 @@ def test_sanitize_text_max_length_dots_not_allowed():
     ) == "Some text with _ sig"
 
 
+@pytest.mark.parametrize("field", ["customer_name", "order_description"])
+@pytest.mark.parametrize(
+    "text",
+    [
+        "",
+        "Some text with $ sign, a plus + and numbers like 123 and a dash -!!",
+        "Good _\\/-.' Bad!+%^*()[@+123]<> Arabic عربي",
+        "\t\n\x00\x7f ~`|{}",
+    ]
+)
+def test_text_sanitizer_matches_pattern(field, text):
+    """Verify that the sanitizers give the same result as substituting the pattern, for ASCII and non-ASCII text."""
+    sanitizer = utils.TextSanitizer(utils.VALID_PATTERNS[field])
+    assert sanitizer(text) == re.sub(utils.VALID_PATTERNS[field], "_", text)
+
+
+@pytest.mark.parametrize("text", ["Some text with $ sign", "Some text with $ sign عربي"])
+def test_text_sanitizer_long_replacement(text):
+    """Verify that the sanitizer falls back to the pattern when the replacement is not a single ASCII character."""
+    sanitizer = utils.TextSanitizer(r"[^A-Za-z0-9 !]", replacement="<>")
+    assert sanitizer(text) == re.sub(r"[^A-Za-z0-9 !]", "<>", text)
+
+
+@pytest.mark.parametrize(
+    "ellipsis, max_length, expected_result",
+    [
+        (True, None, "Some text with _ sign"),
+        (True, 21, "Some text with _ sign"),
+        (True, 20, "Some text with _ ..."),
+        (False, 20, "Some text with _ sig"),
+    ]
+)
+def test_text_sanitizer_max_length(ellipsis, max_length, expected_result):
+    """Verify that the sanitizer truncates the text according to its own policy."""
+    sanitizer = utils.TextSanitizer(r"[^A-Za-z0-9 !]", max_length=max_length, ellipsis=ellipsis)
+    assert sanitizer("Some text with $ sign") == expected_result
+
+
+def test_sanitizers_policies():
+    """Protect the truncation policy of the fields sent to PayFort from being changed by mistake."""
+    assert {
+        field: (sanitizer.max_length, sanitizer.ellipsis) for field, sanitizer in utils.SANITIZERS.items()
+    } == {
+        "customer_name": (50, True),
+        "order_description": (utils.MAX_ORDER_DESCRIPTION_LENGTH, True),
+    }
+
+
 def test_verify_param():
     """Verify that verify_param raises an exception if the parameter is None or not of the required type."""
     with pytest.raises(utils.PayFortException) as exc:
@@ -138,6 +192,24 @@ def test_verify_param():
     assert "verify_param failed: param is required and must be (int), but got (str)" in str(exc.value)
 
 
+def test_lazy_models():
+    """Verify that the Oscar models and classes are loaded on first use, and once."""
+    utils.get_oscar_model.cache_clear()
+    with patch("ecommerce_payfort.utils.get_model", return_value="a-model") as mock_get_model:
+        assert utils.Basket == "a-model"
+        assert utils.get_basket_model() == "a-model"
+    mock_get_model.assert_called_once_with("basket", "Basket")
+    utils.get_oscar_model.cache_clear()
+
+    with patch("ecommerce_payfort.utils.get_class", return_value="a-class") as mock_get_class:
+        assert utils.get_oscar_class("offer.applicator", "Applicator-test") == "a-class"
+        assert utils.get_oscar_class("offer.applicator", "Applicator-test") == "a-class"
+    mock_get_class.assert_called_once_with("offer.applicator", "Applicator-test")
+
+    with pytest.raises(AttributeError):
+        utils.NotAModel  # pylint: disable=pointless-statement
+
+
 def test_get_amount(mocked_basket):  # pylint: disable=redefined-outer-name
     """Verify that get_amount returns the amount of the basket."""
     assert utils.get_amount(mocked_basket) == 9876
@@ -223,6 +295,21 @@ def test_get_merchant_reference(mocked_basket):  # pylint: disable=redefined-out
     assert utils.get_merchant_reference(26, mocked_basket) == "26-77-1"
 
 
+@pytest.mark.parametrize("merchant_reference, expected_result", [
+    ("26-77-1", (26, 77, 1)),
+    ("026-77-100", (26, 77, 100)),
+    ("77-1", None),
+    ("test-1", None),
+    ("26-77-1-2", None),
+    ("26-77-", None),
+    ("", None),
+    (None, None),
+])
+def test_parse_merchant_reference(merchant_reference, expected_result):
+    """Verify that parse_merchant_reference returns the three IDs of a well-formed merchant reference only."""
+    assert utils.parse_merchant_reference(merchant_reference) == expected_result
+
+
 @pytest.mark.parametrize(
     "self_key, self_title, parent_key, parent_title, expected_with_parent, expected_without_parent",
     [
@@ -288,6 +375,110 @@ def test_get_signature_bad_method():
     assert "Unsupported SHA method: bad_method" in str(exc)
 
 
+def test_get_order_description_stops_at_max_length(mocked_basket):  # pylint: disable=redefined-outer-name
+    """Verify that get_order_description stops describing lines once the description is long enough."""
+    mocked_basket.internal_lines = [
+        mocked_basket.Line(mocked_basket.Product(course_key=f"course-v1:Org+Course{index}+2024"))
+        for index in range(100)
+    ]
+    full_description = " // ".join(
+        f"1 X course-v1:Org_Course{index}_2024" for index in range(100)
+    )
+    with patch(
+        "ecommerce_payfort.utils._get_product_description", wraps=utils._get_product_description,
+    ) as mock_get_product_description:
+        description = utils.get_order_description(mocked_basket)
+
+    assert description == full_description[:utils.MAX_ORDER_DESCRIPTION_LENGTH - 3] + "..."
+    assert mock_get_product_description.call_count == 5
+
+
+@pytest.mark.parametrize("line_count", [0, 1, 2, 5, 6, 7, 100])
+def test_get_order_description_same_as_full_description(
+        mocked_basket, line_count
+):  # pylint: disable=redefined-outer-name
+    """Verify that stopping early gives the same description as sanitizing the description of all lines."""
+    mocked_basket.internal_lines = [
+        mocked_basket.Line(mocked_basket.Product(course_key=f"course-v1:Org+Course{index}+2024"), quantity=index)
+        for index in range(line_count)
+    ]
+    full_description = " // ".join(
+        f"{index} X course-v1:Org+Course{index}+2024" for index in range(line_count)
+    )
+    assert utils.get_order_description(mocked_basket) == utils.SANITIZERS["order_description"](full_description)
+
+
+@pytest.fixture
+def mocked_prefetch():
+    """Mock the prefetching of the related objects of the basket lines."""
+    with patch("ecommerce_payfort.utils.prefetch_related_objects") as mock_prefetch:
+        yield mock_prefetch
+
+
+def test_basket_payment_snapshot(mocked_basket, mocked_prefetch):  # pylint: disable=redefined-outer-name
+    """Verify that BasketPaymentSnapshot computes the same values as the separate getters."""
+    snapshot = utils.BasketPaymentSnapshot(mocked_basket)
+    assert snapshot.amount == utils.get_amount(mocked_basket)
+    assert snapshot.currency == utils.get_currency(mocked_basket)
+    assert snapshot.customer_email == utils.get_customer_email(mocked_basket)
+    assert snapshot.customer_name == utils.get_customer_name(mocked_basket)
+    assert snapshot.order_description == utils.get_order_description(mocked_basket)
+    mocked_prefetch.assert_called_once_with(
+        mocked_basket.internal_lines, "product__course", "product__parent__course",
+    )
+
+
+def test_basket_payment_snapshot_bad_currency(mocked_basket, mocked_prefetch):  # pylint: disable=redefined-outer-name
+    """Verify that BasketPaymentSnapshot raises an exception if a line currency is not supported."""
+    mocked_basket.internal_lines.append(
+        mocked_basket.Line(mocked_basket.Product("course-v1:C1+CC1+2024"), price_currency="USD")
+    )
+    with pytest.raises(utils.PayFortException) as exc:
+        utils.BasketPaymentSnapshot(mocked_basket)
+    assert "Currency not supported: USD" in str(exc)
+    mocked_prefetch.assert_called_once()
+
+
+def test_signer_sign():
+    """Verify that Signer.sign returns the same signature as get_signature."""
+    signer = utils.Signer("secret!", "SHA-256")
+    assert signer.sign(
+        {"param1": "value1", "param2": "value2"}
+    ) == "811171c0e6a56ed10e69f0954a20aeeef71b4003303165ae16e9e02d7d659d73"
+
+
+def test_signer_sign_keeps_seeded_state():
+    """Verify that signing does not alter the seeded state of the signer."""
+    signer = utils.Signer("secret!", "SHA-512")
+    parameters = {"B_param": 2, "a_param": "value", "c_param": "عربي"}
+    first_signature = signer.sign(parameters)
+    signer.sign({"other": "value"})
+    assert signer.sign(parameters) == first_signature
+    assert first_signature == hashlib.sha512(
+        "secret!a_param=valueB_param=2c_param=عربيsecret!".encode()
+    ).hexdigest()
+
+
+def test_signer_bad_method():
+    """Verify that Signer raises an exception if the method is not supported."""
+    with pytest.raises(utils.PayFortException) as exc:
+        utils.Signer("any", "bad_method")
+    assert "Unsupported SHA method: bad_method" in str(exc)
+
+
+def test_signer_bad_parameters():
+    """Verify that Signer.sign raises an exception if the parameters are not a dict."""
+    with pytest.raises(utils.PayFortException) as exc:
+        utils.Signer("any", "SHA-256").sign(None)
+    assert "verify_param failed: transaction_parameters is required and must be (dict)" in str(exc)
+
+
+def test_get_signer_is_shared():
+    """Verify that get_signer returns the same signer for the same phrase and method."""
+    assert utils.get_signer("secret!", "SHA-256") is utils.get_signer("secret!", "SHA-256")
+    assert utils.get_signer("secret!", "SHA-256") is not utils.get_signer("secret!", "SHA-512")
+
+
 @pytest.mark.parametrize(
     "response_data, expected_result",
     [
@@ -354,6 +545,9 @@ def test_verify_response_format_not_string(valid_response_data):  # pylint: disa
         ("amount", "abc", "Invalid amount in response (not a positive integer): abc"),
         ("amount", "1.2", "Invalid amount in response (not a positive integer): 1.2"),
         ("amount", "-1", "Invalid amount in response (not a positive integer): -1"),
+        ("amount", "0012", "Invalid amount in response (not a positive integer): 0012"),
+        ("amount", " 12", "Invalid amount in response (not a positive integer):  12"),
+        ("amount", "١٢", "Invalid amount in response (not a positive integer): ١٢"),
         ("currency", "USD", "Invalid currency in response: USD"),
         ("command", "AUTHORIZATION", "Invalid command in response: AUTHORIZATION"),
         ("merchant_reference", "1-2-3-4", "Invalid merchant_reference in response: 1-2-3-4"),
@@ -371,6 +565,42 @@ def test_verify_response_format_bad(
     assert expected_error_msg in str(exc)
 
 
+def test_verify_response_format_parsed(valid_response_data):  # pylint: disable=redefined-outer-name
+    """Verify that verify_response_format returns the values parsed out of the response."""
+    response = utils.verify_response_format(valid_response_data)
+    assert response.data is valid_response_data
+    assert (response.site_id, response.owner_id, response.basket_id) == (1, 2, 1)
+    assert response.merchant_reference == "1-2-1"
+    assert response.amount == 2000
+    assert response.currency == "SAR"
+    assert response.response_code == "200"
+    assert response.transaction_id == utils.get_transaction_id(valid_response_data)
+    assert response.success is True
+    assert response.card_number is None
+    assert repr(response) == "<PayFortResponse 1-2-1 eci-value-fort-id-value status=14>"
+
+
+def test_verify_response_format_failed_payment(valid_response_data):  # pylint: disable=redefined-outer-name
+    """Verify that verify_response_format flags failed payments as not successful."""
+    valid_response_data.update({"status": "13", "eci": None, "fort_id": None, "amount": "0"})
+    response = utils.verify_response_format(valid_response_data)
+    assert response.success is False
+    assert response.amount == 0
+    assert response.transaction_id == "none-none"
+
+
+def test_payfort_response_read_only(valid_response_data):  # pylint: disable=redefined-outer-name
+    """Verify that the parsed response cannot be altered."""
+    response = utils.verify_response_format(valid_response_data)
+    with pytest.raises(AttributeError):
+        response.amount = 1
+    with pytest.raises(AttributeError):
+        del response.amount
+    with pytest.raises(AttributeError):
+        response.anything = 1
+    assert not hasattr(response, "__dict__")
+
+
 def test_verify_signature(valid_response_data):  # pylint: disable=redefined-outer-name
     """Verify that verify_signature returns successfully if the signature is valid."""
     utils.verify_signature("secret@res", "SHA-256", valid_response_data)
@@ -394,6 +624,52 @@ def test_verify_signature_missing(valid_response_data):  # pylint: disable=redef
     assert "Signature not found!" in str(exc)
 
 
+def test_verify_signature_query_dict(valid_response_data):  # pylint: disable=redefined-outer-name
+    """Verify that verify_signature accepts the read-only POST data as-is."""
+    utils.verify_signature("secret@res", "SHA-256", QueryDict(urlencode(valid_response_data)))
+
+
+def test_verify_signature_read_only_mapping(valid_response_data):  # pylint: disable=redefined-outer-name
+    """Verify that verify_signature works on a read-only mapping that cannot be copied or altered."""
+    class ReadOnlyData(Mapping):
+        """Read-only view of the response data."""
+        def __getitem__(self, key):
+            return valid_response_data[key]
+
+        def __iter__(self):
+            return iter(valid_response_data)
+
+        def __len__(self):
+            return len(valid_response_data)
+
+    utils.verify_signature("secret@res", "SHA-256", ReadOnlyData())
+
+
+def test_verify_signature_constant_time(valid_response_data):  # pylint: disable=redefined-outer-name
+    """Verify that verify_signature compares the signatures in constant time."""
+    with patch("ecommerce_payfort.core.hmac.compare_digest", return_value=False) as mock_compare_digest:
+        with pytest.raises(utils.PayFortBadSignatureException):
+            utils.verify_signature("secret@res", "SHA-256", valid_response_data)
+    mock_compare_digest.assert_called_once_with(
+        valid_response_data["signature"].encode(), valid_response_data["signature"].encode(),
+    )
+
+
+def test_verify_signature_non_ascii_signature(valid_response_data):  # pylint: disable=redefined-outer-name
+    """Verify that a non-ASCII signature is reported as a mismatch."""
+    valid_response_data["signature"] = "عربي"
+    with pytest.raises(utils.PayFortBadSignatureException) as exc:
+        utils.verify_signature("secret@res", "SHA-256", valid_response_data)
+    assert "Response signature mismatch. merchant_reference: 1-2-1" in str(exc)
+
+
+def test_verify_signature_not_a_mapping():
+    """Verify that verify_signature raises an exception if the data is not a mapping."""
+    with pytest.raises(utils.PayFortException) as exc:
+        utils.verify_signature("secret@res", "SHA-256", ["signature"])
+    assert "verify_param failed: response_data is required and must be (Mapping), but got (list)" in str(exc)
+
+
 def test_verify_signature_bad_method(valid_response_data):  # pylint: disable=redefined-outer-name
     """Verify that verify_signature raises an exception if the method is not supported."""
     with pytest.raises(utils.PayFortException) as exc:
@@ -421,3 +697,14 @@ def test_get_ip_address_no_proxy():
         "REMOTE_ADDR": " 4.4.4.4 ",
     })
     assert utils.get_ip_address(request) == "4.4.4.4"
+
+
+@pytest.mark.parametrize("response, expected", [
+    ({"view": "a-view", "response": {"a": 1}}, {"a": 1}),
+    ({"a": 1}, {"a": 1}),
+    ({"response": "not-a-dict"}, {}),
+    (None, {}),
+])
+def test_get_recorded_response_data(response, expected):
+    """Verify that the response data is unwrapped from the recorded response."""
+    assert utils.get_recorded_response_data(response) == expected
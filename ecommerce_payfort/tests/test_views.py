@@ -1,29 +1,44 @@
 """Test the views of the app."""
+import copy
 import json
 import logging
 import unittest
+from decimal import Decimal
 from unittest.mock import Mock, patch, PropertyMock
 
 import ddt
+from django.conf import settings
 from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
 from django.core.handlers.wsgi import WSGIRequest
 from django.http import Http404
-from django.test import Client, RequestFactory
+from django.test import Client, RequestFactory, override_settings
 from django.urls import reverse
-from ecommerce.tests.factories import UserFactory
+from ecommerce.tests.factories import SiteConfigurationFactory, UserFactory
 from ecommerce.tests.testcases import TestCase
+from oscar.apps.partner import strategy
+from oscar.test import factories
 
-from ecommerce_payfort import utils
+from ecommerce_payfort import duplicates, instrumentation, locks, status_cache, utils
 from ecommerce_payfort import views
-from ecommerce_payfort.processors import PayFort
+from ecommerce_payfort.models import PayFortTransaction
+from ecommerce_payfort.processors import DEFAULT_GATEWAY_URL, PayFort
 from ecommerce_payfort.tests.test_mixins import MockPatcherMixin
 
+original_record_transaction = PayFortTransaction.record
+
+
+def parsed_response(data):
+    """Return the parsed response of the given data without verifying its format."""
+    return utils.PayFortResponse(data, site_id=1, owner_id=2, basket_id=3, amount=2000)
+
 
 class BaseTests(TestCase):  # pylint: disable=too-many-ancestors
     """Base test class."""
     def setUp(self):
         """Set up the test."""
         super().setUp()
+        cache.clear()
         self.client = Client()
         self.user = UserFactory(username="testuser", password="12345")
         self.payment_data = {
@@ -61,11 +76,26 @@ class TestPayFortPaymentRedirectView(BaseTests):  # pylint: disable=too-many-anc
         self.assertEqual(response.status_code, 200)
         self.assertTemplateUsed(response, "payfort_payment/form.html")
 
+        self.assertEqual(response["Cache-Control"], "no-store")
+
         content = response.content.decode("utf-8")
         self.assertIn("Redirecting to the Payment Gateway...", content)
+        self.assertIn(f"<form action=\"{DEFAULT_GATEWAY_URL}\" method=\"post\" name=\"payment_form\">", content)
         for key, value in self.payment_data.items():
             self.assertIn(f"<input type=\"hidden\" name=\"{key}\" value=\"{value}\">", content)
 
+    def test_post_gateway_url(self):
+        """Verify that the form is submitted to the PayFort payment page configured for the site."""
+        self.login()
+        config = copy.deepcopy(settings.PAYMENT_PROCESSOR_CONFIG)
+        config["edx"]["payfort"]["gateway_url"] = "https://checkout.payfort.com/FortAPI/paymentPage"
+        with override_settings(PAYMENT_PROCESSOR_CONFIG=config):
+            response = self.client.post(reverse("payfort:form"), self.payment_data)
+        self.assertIn(
+            "<form action=\"https://checkout.payfort.com/FortAPI/paymentPage\" method=\"post\"",
+            response.content.decode("utf-8"),
+        )
+
     def test_must_be_logged_in(self):
         """Test the POST method."""
         response = self.client.post(reverse("payfort:form"), self.payment_data)
@@ -105,6 +135,17 @@ class TestPayFortPaymentRedirectView(BaseTests):  # pylint: disable=too-many-anc
             " and the form."
         )
 
+    def test_payment_data_direct_submit(self):
+        """Verify that the direct submit sends the signed payment data to the PayFort payment page, and nothing else."""
+        processor = PayFort(self.site)
+        processor.direct_submit = True
+        with patch("ecommerce_payfort.processors.utils"), patch("ecommerce_payfort.processors.get_token") as mock_token:
+            transaction_parameters = processor.get_transaction_parameters(Mock())
+
+        mock_token.assert_not_called()
+        self.assertEqual(transaction_parameters.pop("payment_page_url"), processor.gateway_url)
+        self.assertEqual(set(transaction_parameters), set(self.payment_data))
+
 
 class TestPayFortPaymentHandleInternalErrorView(BaseTests):  # pylint: disable=too-many-ancestors
     """Test the PayFortPaymentHandleInternalErrorView."""
@@ -142,18 +183,17 @@ class TestPayFortCallBaseView(MockPatcherMixin, BaseTests):  # pylint: disable=t
             "return_value": "the-transaction-id",
         }),
         "log_error": ("ecommerce_payfort.views.PayFortCallBaseView.log_error", {}),
-        "verify_signature": ("ecommerce_payfort.utils.verify_signature", {
-            "autospec": True
-        }),
         "verify_response_format": ("ecommerce_payfort.utils.verify_response_format", {
             "autospec": True
         }),
+        "record_transaction": ("ecommerce_payfort.views.PayFortTransaction.record", {}),
     }
 
     def setUp(self):
         """Set up the test."""
         super().setUp()
         self.view = views.PayFortCallBaseView()
+        self.mocks["verify_response_format"].return_value = None
 
     def _set_request(self, data, method="post", path="/", user=None):
         """Helper method to set the request."""
@@ -173,21 +213,93 @@ class TestPayFortCallBaseView(MockPatcherMixin, BaseTests):  # pylint: disable=t
 
     def test_basket_with_non_existent_basket(self):
         """Verify that basket property returns None when the basket does not exist."""
-        self._set_request(data={"merchant_reference": "test-1"})
+        self._set_request(data={"merchant_reference": f"{self.site.id}-{self.user.id}-0"})
         self.assertIsNone(self.view.basket)
 
     def test_basket_with_existent_basket(self):
         """Verify that basket property returns the basket when it exists."""
-        basket = utils.Basket.objects.create()
-        self._set_request(data={"merchant_reference": f"test-{basket.id}"})
+        basket = utils.Basket.objects.create(owner=self.user, site=self.site)
+        self._set_request(data={"merchant_reference": f"{self.site.id}-{self.user.id}-{basket.id}"})
+        self.assertEqual(self.view.basket, basket)
+
+    def test_basket_with_parsed_response(self):
+        """Verify that basket property uses the merchant reference of the parsed response when available."""
+        basket = utils.Basket.objects.create(owner=self.user, site=self.site)
+        self._set_request(data={"merchant_reference": "1-2-0"})
+        self.view.payfort_response = utils.PayFortResponse(
+            {}, site_id=self.site.id, owner_id=self.user.id, basket_id=basket.id, amount=0
+        )
         self.assertEqual(self.view.basket, basket)
 
     def test_basket_with_existent_basket_bad_merchant_reference(self):
-        """Verify that basket property returns the basket when it exists."""
-        basket = utils.Basket.objects.create()
-        self._set_request(data={"merchant_reference": f"test{basket.id}"})
+        """Verify that basket property returns None when the merchant reference is malformed."""
+        basket = utils.Basket.objects.create(owner=self.user, site=self.site)
+        for merchant_reference in (f"test{basket.id}", f"test-{basket.id}", f"{self.user.id}-{basket.id}"):
+            self._set_request(data={"merchant_reference": merchant_reference})
+            self.assertIsNone(self.view.basket)
+
+    def test_basket_with_other_owner(self):
+        """Verify that basket property returns None when the owner doesn't match the merchant reference."""
+        basket = utils.Basket.objects.create(owner=self.user, site=self.site)
+        self._set_request(data={"merchant_reference": f"{self.site.id}-{UserFactory().id}-{basket.id}"})
         self.assertIsNone(self.view.basket)
 
+    def test_basket_with_other_site(self):
+        """Verify that basket property loads the basket of another site, and logs the mismatch."""
+        basket = utils.Basket.objects.create(owner=self.user, site=self.site)
+        other_site = SiteConfigurationFactory(partner=self.site.siteconfiguration.partner).site
+        self._set_request(data={"merchant_reference": f"{other_site.id}-{self.user.id}-{basket.id}"})
+        with patch("ecommerce_payfort.utils.logger.warning") as mock_warning:
+            self.assertEqual(self.view.basket, basket)
+        mock_warning.assert_called_once_with(
+            "PayFort basket [%s] belongs to site [%s] instead of the site of the merchant reference [%s]",
+            basket.id, self.site.id, other_site.id,
+        )
+
+    def test_basket_without_site(self):
+        """Verify that basket property loads the basket without a site, and logs the mismatch."""
+        basket = utils.Basket.objects.create(owner=self.user)
+        self._set_request(data={"merchant_reference": f"{self.site.id}-{self.user.id}-{basket.id}"})
+        with patch("ecommerce_payfort.utils.logger.warning") as mock_warning:
+            self.assertEqual(self.view.basket, basket)
+        mock_warning.assert_called_once()
+
+    def _create_basket(self, line_count):
+        """Create a basket of the site and the user, with the given number of lines."""
+        basket = utils.Basket.objects.create(owner=self.user, site=self.site)
+        basket.strategy = strategy.Default()
+        for _ in range(line_count):
+            product = factories.create_product()
+            factories.create_stockrecord(product, price_excl_tax=Decimal("20.00"), num_in_stock=10)
+            basket.add_product(product)
+        return basket
+
+    def test_basket_queries(self):
+        """Verify that the basket is loaded in a fixed number of queries, whatever the number of its lines."""
+        # The basket with its owner, site and site configuration, the lines with their products and stock records,
+        # then the prefetched line attributes, product images, partners and product classes.
+        for line_count, expected_queries in ((0, 2), (1, 6), (3, 6)):
+            basket = self._create_basket(line_count)
+            self.view = views.PayFortCallBaseView()
+            self._set_request(data={"merchant_reference": f"{self.site.id}-{self.user.id}-{basket.id}"})
+            with patch("ecommerce_payfort.views.prepare_basket") as mock_prepare_basket:
+                mock_prepare_basket.side_effect = lambda loaded_basket, request: loaded_basket
+                with self.assertNumQueries(expected_queries):
+                    self.assertEqual(self.view.basket, basket)
+
+    def test_basket_related_objects_loaded(self):
+        """Verify that reading what the callback needs from the loaded basket doesn't query the database."""
+        basket = utils.load_callback_basket(self.site.id, self.user.id, self._create_basket(2).id)
+        with self.assertNumQueries(0):
+            self.assertEqual(basket.owner, self.user)
+            self.assertEqual(basket.site.siteconfiguration, self.site.siteconfiguration)
+            lines = list(basket.all_lines())
+            self.assertEqual(len(lines), 2)
+            for line in lines:
+                self.assertIsNotNone(line.stockrecord.partner.name)
+                self.assertIsNotNone(line.product.get_product_class())
+                self.assertIsNone(line.product.course)
+
     def test_basket_with_existent_basket_with_missing_merchant_reference(self):
         """Verify that basket property returns None when merchant_reference is missing."""
         utils.Basket.objects.create()
@@ -217,6 +329,55 @@ class TestPayFortCallBaseView(MockPatcherMixin, BaseTests):  # pylint: disable=t
             basket=view.basket,
         )
 
+    def test_save_payment_processor_response_records_transaction(self):
+        """Verify that save_payment_processor_response records the PayFortTransaction of the response."""
+        view = self.DerivedView()
+        view.payment_processor = Mock(record_processor_response=Mock())
+        view._basket = Mock(id=7)  # pylint: disable=protected-access
+        payment_processor_response = view.save_payment_processor_response({"any": "any"})
+        self.assertIs(payment_processor_response, view.payment_processor.record_processor_response.return_value)
+        self.mocks["record_transaction"].assert_called_once_with(payment_processor_response, {"any": "any"})
+
+    def test_save_payment_processor_response_atomic(self):
+        """Verify that the processor response is not saved when its PayFortTransaction cannot be recorded."""
+        self.mocks["record_transaction"].side_effect = Exception("Test exception")
+        basket = utils.Basket.objects.create(site=self.site)
+        view = self.DerivedView()
+        view.payment_processor = PayFort(self.site)
+        view._basket = basket  # pylint: disable=protected-access
+        with self.assertRaises(Http404):
+            view.save_payment_processor_response({"merchant_reference": f"1-2-{basket.id}"})
+        self.assertFalse(basket.paymentprocessorresponse_set.exists())
+
+    def test_save_payment_processor_response_real_transaction(self):
+        """Verify that save_payment_processor_response saves the PayFortTransaction with the processor response."""
+        self.mocks["record_transaction"].side_effect = original_record_transaction
+        basket = utils.Basket.objects.create(site=self.site)
+        view = self.DerivedView()
+        view.payment_processor = PayFort(self.site)
+        view._basket = basket  # pylint: disable=protected-access
+        response_data = {
+            "merchant_reference": f"1-2-{basket.id}", "fort_id": "123", "status": "14", "amount": "2000",
+        }
+        payment_processor_response = view.save_payment_processor_response(response_data)
+        transaction = PayFortTransaction.objects.get(fort_id="123")
+        self.assertEqual(transaction.processor_response_id, payment_processor_response.id)
+        self.assertEqual(transaction.basket_id, basket.id)
+        self.assertEqual(transaction.amount, 2000)
+
+    def test_save_payment_processor_response_parsed(self):
+        """Verify that save_payment_processor_response uses the transaction ID of the parsed response."""
+        view = self.DerivedView()
+        view.payment_processor = Mock(record_processor_response=Mock())
+        view._basket = Mock(id=7)  # pylint: disable=protected-access
+        view.payfort_response = parsed_response({"eci": "ECOMMERCE", "fort_id": "123"})
+        view.save_payment_processor_response({"any": "any"})
+        self.assertEqual(
+            view.payment_processor.record_processor_response.call_args[1]["transaction_id"],
+            "ECOMMERCE-123",
+        )
+        self.mocks["get_transaction_id"].assert_not_called()
+
     def test_save_payment_processor_response_exception(self):
         """Verify that save_payment_processor_response logs the exception when record_processor_response fails."""
         view = self.DerivedView()
@@ -245,40 +406,61 @@ class TestPayFortCallBaseView(MockPatcherMixin, BaseTests):  # pylint: disable=t
     def test_validate_response_success(self):
         """Verify that validate_response calls the appropriate functions."""
         response_data = self._validate_response_success()
-        self.mocks["verify_signature"].assert_called_once_with(
-            self.view.payment_processor.response_sha_phrase,
-            self.view.payment_processor.sha_method,
-            response_data,
-        )
+        self.view.payment_processor.response_signer.verify.assert_called_once_with(response_data)
         self.mocks["verify_response_format"].assert_called_once_with(response_data)
 
+    def test_validate_response_returns_parsed_response(self):
+        """Verify that validate_response returns and keeps the parsed response."""
+        response_data = {
+            "status": utils.SUCCESS_STATUS,
+            "merchant_reference": "test-1"
+        }
+        self.mocks["verify_response_format"].return_value = parsed_response(response_data)
+        self.view.payment_processor = Mock()
+        self.view._basket = Mock(id=7)  # pylint: disable=protected-access
+        response = self.view.validate_response(response_data)
+        self.assertIs(response, self.mocks["verify_response_format"].return_value)
+        self.assertIs(self.view.payfort_response, response)
+
     def test_validate_response_first_verify_signature_then_verify_response_format(self):
         """Verify that validate_response calls the appropriate functions."""
-        self._validate_response_success()
-        self.assertEqual(self.mocks["verify_signature"].call_count, 1)
-        self.assertEqual(self.mocks["verify_response_format"].call_count, 1)
-        for call in self.mocks["verify_signature"].mock_calls + self.mocks["verify_response_format"].mock_calls:
-            self.assertNotIn(call, self.mocks["verify_response_format"].mock_calls)
-            if call in self.mocks["verify_signature"].mock_calls:
-                break
+        self.mocks["verify_response_format"].side_effect = (
+            lambda data: self.view.payment_processor.response_signer.verify.assert_called_once_with(data)
+        )
+        response_data = self._validate_response_success()
+        self.mocks["verify_response_format"].assert_called_once_with(response_data)
+
+    def test_validate_response_checks_duplicate_after_signature(self):
+        """Verify that validate_response checks for duplicates after verifying the signature, before the format."""
+        response_data = {"status": utils.SUCCESS_STATUS, "merchant_reference": "test-1"}
+        self.view.payment_processor = Mock()
+        with patch.object(self.view, "check_duplicate", side_effect=duplicates.DuplicateResponse) as mock_check:
+            with self.assertRaises(duplicates.DuplicateResponse):
+                self.view.validate_response(response_data)
+        mock_check.assert_called_once_with(response_data)
+        self.view.payment_processor.response_signer.verify.assert_called_once()
+        self.mocks["verify_response_format"].assert_not_called()
+
+    def test_check_duplicate_base(self):
+        """Verify that the base view does not check for duplicates."""
+        duplicates.mark_seen({"fort_id": "1", "status": utils.SUCCESS_STATUS, "signature": "sig"})
+        self.assertIsNone(
+            self.view.check_duplicate({"fort_id": "1", "status": utils.SUCCESS_STATUS, "signature": "sig"})
+        )
 
     def test_validate_response_bad_signature(self):
-        """Verify that validate_response logs the exception when verify_signature fails."""
+        """Verify that validate_response logs the exception when the signature verification fails."""
         response_data = {
             "status": "99",
             "merchant_reference": "test-1"
         }
-        self.mocks["verify_signature"].side_effect = utils.PayFortBadSignatureException(
+        self.view.payment_processor = Mock()
+        self.view.payment_processor.response_signer.verify.side_effect = utils.PayFortBadSignatureException(
             "Signature verification failed for response data: %s" % response_data,
         )
-        self.view.payment_processor = Mock()
         with self.assertRaises(utils.PayFortBadSignatureException):
             self.view.validate_response(response_data)
-        self.mocks["verify_signature"].assert_called_once_with(
-            self.view.payment_processor.response_sha_phrase,
-            self.view.payment_processor.sha_method,
-            response_data,
-        )
+        self.view.payment_processor.response_signer.verify.assert_called_once_with(response_data)
         self.mocks["verify_response_format"].assert_not_called()
         self.mocks["log_error"].assert_called_once_with(
             "Signature verification failed for response data: {'status': '99', 'merchant_reference': 'test-1'}"
@@ -294,7 +476,7 @@ class TestPayFortCallBaseView(MockPatcherMixin, BaseTests):  # pylint: disable=t
         with self.assertRaises(Http404):
             self.view.validate_response(response_data)
 
-        self.mocks["verify_signature"].assert_called_once()
+        self.view.payment_processor.response_signer.verify.assert_called_once()
         self.mocks["verify_response_format"].assert_called_once_with(response_data)
 
     def test_validate_response_bad_format(self):
@@ -334,11 +516,7 @@ class TestPayFortCallBaseView(MockPatcherMixin, BaseTests):  # pylint: disable=t
         self.view.payment_processor = Mock()
         with self.assertRaises(Http404):
             self.view.validate_response(response_data)
-        self.mocks["verify_signature"].assert_called_once_with(
-            self.view.payment_processor.response_sha_phrase,
-            self.view.payment_processor.sha_method,
-            response_data,
-        )
+        self.view.payment_processor.response_signer.verify.assert_called_once_with(response_data)
         self.mocks["verify_response_format"].assert_called_once_with(response_data)
         self.mocks["log_error"].assert_called_once_with("Basket not found! merchant_reference: test-1")
 
@@ -365,6 +543,7 @@ class TestPayFortRedirectionResponseView(MockPatcherMixin, BaseTests):  # pylint
             "response_code": "00",
         }
         self.url = reverse("payfort:response")
+        self.mocks["validate_response"].side_effect = parsed_response
 
     def test_retry_settings(self):
         """Verify that the retry settings are reasonable."""
@@ -383,12 +562,20 @@ class TestPayFortRedirectionResponseView(MockPatcherMixin, BaseTests):  # pylint
                 args=["the-transaction-id"]
             ),
             "ecommerce_status_url": reverse("payfort:status"),
+            "ecommerce_status_wait_url": "",
             "ecommerce_max_attempts": views.PayFortRedirectionResponseView.MAX_ATTEMPTS,
             "ecommerce_wait_time": views.PayFortRedirectionResponseView.WAIT_TIME,
         })
         for key, value in self.data.items():
             self.assertEqual(response.context[key], value)
 
+    @override_settings(PAYFORT_STATUS_LONG_POLL=True)
+    def test_post_success_long_poll(self):
+        """Verify that the status page is given the long-poll URL when the long-poll is enabled."""
+        response = self.client.post(self.url, self.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context["ecommerce_status_wait_url"], reverse("payfort:status-wait"))
+
     def test_post_bad_signature(self):
         """Verify that the POST method does not save the response when the signature is bad."""
         self.mocks["validate_response"].side_effect = utils.PayFortBadSignatureException(
@@ -432,9 +619,8 @@ class TestPayFortRedirectionResponseView(MockPatcherMixin, BaseTests):  # pylint
 class TestPayFortStatusView(MockPatcherMixin, BaseTests):  # pylint: disable=too-many-ancestors
     """Test the PayFortStatusView."""
     patching_config = {
-        "basket": ("ecommerce_payfort.views.PayFortStatusView.basket", {
+        "get_basket_status": ("ecommerce_payfort.views.PayFortStatusView.get_basket_status", {
             "return_value": None,
-            "new_callable": PropertyMock,
         }),
     }
 
@@ -445,31 +631,303 @@ class TestPayFortStatusView(MockPatcherMixin, BaseTests):  # pylint: disable=too
 
     def test_post_invalid_basket(self):
         """Verify that the POST method returns 404 when the basket is not found."""
-        self.mocks["basket"].return_value = None
+        self.mocks["get_basket_status"].return_value = None
         response = self.client.post(self.url)
         self.assertEqual(response.status_code, 404)
 
     def test_post_frozen_basket(self):
         """Verify that the POST method returns 204 when the basket is still frozen."""
-        self.mocks["basket"].return_value = Mock(status=views.Basket.FROZEN)
+        self.mocks["get_basket_status"].return_value = {
+            "status": utils.Basket.FROZEN, "site_id": self.site.id, "order__number": None,
+        }
         response = self.client.post(self.url)
         self.assertEqual(response.status_code, 204)
 
     def test_post_not_frozen_not_submitted_basket(self):
         """Verify that the POST method returns 404 when the basket is neither frozen nor submitted."""
-        self.mocks["basket"].return_value = Mock(status="something-else")
+        self.mocks["get_basket_status"].return_value = {
+            "status": "something-else", "site_id": self.site.id, "order__number": None,
+        }
         response = self.client.post(self.url)
         self.assertEqual(response.status_code, 404)
 
     def test_post_submitted_basket(self):
         """Verify that the POST method returns 200 and the receipt_url when the basket is submitted."""
-        self.mocks["basket"].return_value = Mock(status=views.Basket.SUBMITTED)
-        with patch("ecommerce_payfort.views.get_receipt_page_url", return_value="a-url-to-the-receipt"):
+        self.mocks["get_basket_status"].return_value = {
+            "status": utils.Basket.SUBMITTED, "site_id": self.site.id, "order__number": "EDX-100001",
+        }
+        with patch("ecommerce_payfort.views.get_receipt_page_url", return_value="a-url-to-the-receipt") as mock_url:
             response = self.client.post(self.url)
         self.assertEqual(response.status_code, 200)
         self.assertEqual(json.loads(response.content.decode("utf-8")), {
             "receipt_url": "a-url-to-the-receipt",
         })
+        self.assertEqual(mock_url.call_args[1]["site_configuration"], self.site.siteconfiguration)
+        self.assertEqual(mock_url.call_args[1]["order_number"], "EDX-100001")
+
+    def test_post_submitted_basket_fills_cache(self):
+        """Verify that the POST method caches the receipt_url of a submitted basket."""
+        self.mocks["get_basket_status"].return_value = {
+            "status": utils.Basket.SUBMITTED, "site_id": self.site.id, "order__number": "EDX-100001",
+        }
+        with patch("ecommerce_payfort.views.get_receipt_page_url", return_value="a-url-to-the-receipt"):
+            self.client.post(self.url, {"merchant_reference": "1-2-3"})
+        self.assertEqual(status_cache.get_receipt_url("1-2-3"), "a-url-to-the-receipt")
+
+    def test_post_cached(self):
+        """Verify that the POST method answers from the status cache without reading the basket status."""
+        status_cache.set_receipt_url("1-2-3", "a-cached-url")
+        response = self.client.post(self.url, {"merchant_reference": "1-2-3"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content.decode("utf-8")), {"receipt_url": "a-cached-url"})
+        self.mocks["get_basket_status"].assert_not_called()
+
+    def test_post_cached_other_merchant_reference(self):
+        """Verify that the cached receipt_url of another merchant reference is not used."""
+        status_cache.set_receipt_url("1-2-4", "a-cached-url")
+        response = self.client.post(self.url, {"merchant_reference": "1-2-3"})
+        self.assertEqual(response.status_code, 404)
+        self.mocks["get_basket_status"].assert_called_once()
+
+    def test_post_does_not_load_basket(self):
+        """Verify that the POST method neither loads the basket nor applies the offers."""
+        self.mocks["get_basket_status"].return_value = {
+            "status": utils.Basket.FROZEN, "site_id": self.site.id, "order__number": None,
+        }
+        with patch("ecommerce_payfort.orders.get_applicator") as mock_applicator:
+            with patch.object(utils.Basket.objects, "get") as mock_get:
+                self.client.post(self.url)
+        mock_applicator.assert_not_called()
+        mock_get.assert_not_called()
+
+
+@override_settings(PAYFORT_STATUS_LONG_POLL=True)
+class TestPayFortStatusWaitView(MockPatcherMixin, BaseTests):  # pylint: disable=too-many-ancestors
+    """Test the PayFortStatusWaitView."""
+    patching_config = {
+        "get_basket_status": ("ecommerce_payfort.views.PayFortStatusView.get_basket_status", {
+            "return_value": None,
+        }),
+        "get_notifier": ("ecommerce_payfort.views.get_notifier", {}),
+        "get_receipt_page_url": ("ecommerce_payfort.views.get_receipt_page_url", {
+            "return_value": "a-url-to-the-receipt",
+        }),
+    }
+
+    def setUp(self):
+        """Set up the test."""
+        super().setUp()
+        self.url = reverse("payfort:status-wait")
+        self.data = {"merchant_reference": f"{self.site.id}-2-7"}
+        self.frozen = {"status": utils.Basket.FROZEN, "site_id": self.site.id, "order__number": None}
+        self.submitted = {"status": utils.Basket.SUBMITTED, "site_id": self.site.id, "order__number": "EDX-100001"}
+
+    def test_wait_timeout(self):
+        """Verify that the timeout is short enough to keep a worker busy only briefly."""
+        self.assertTrue(0 < views.PayFortStatusWaitView.WAIT_TIMEOUT <= 10)
+
+    @override_settings(PAYFORT_STATUS_LONG_POLL=False)
+    def test_post_long_poll_disabled(self):
+        """Verify that the POST method answers right away without waiting when the long-poll is disabled."""
+        self.mocks["get_basket_status"].return_value = self.frozen
+        response = self.client.post(self.url, self.data)
+        self.assertEqual(response.status_code, 204)
+        self.mocks["get_notifier"].return_value.wait.assert_not_called()
+
+    def test_post_invalid_basket(self):
+        """Verify that the POST method returns 404 without waiting when the basket is not found."""
+        response = self.client.post(self.url, self.data)
+        self.assertEqual(response.status_code, 404)
+        self.mocks["get_notifier"].return_value.wait.assert_not_called()
+
+    def test_post_submitted_basket(self):
+        """Verify that the POST method returns the receipt_url without waiting when the basket is submitted."""
+        self.mocks["get_basket_status"].return_value = self.submitted
+        response = self.client.post(self.url, self.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content.decode("utf-8")), {"receipt_url": "a-url-to-the-receipt"})
+        self.mocks["get_notifier"].return_value.wait.assert_not_called()
+
+    def test_post_frozen_basket_notified(self):
+        """Verify that the POST method waits for the notification, then returns the receipt_url."""
+        self.mocks["get_basket_status"].side_effect = [self.frozen, self.submitted]
+        self.mocks["get_notifier"].return_value.wait.return_value = True
+        response = self.client.post(self.url, self.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content.decode("utf-8")), {"receipt_url": "a-url-to-the-receipt"})
+        self.mocks["get_notifier"].return_value.wait.assert_called_once_with(
+            7, views.PayFortStatusWaitView.WAIT_TIMEOUT,
+        )
+
+    def test_post_cached(self):
+        """Verify that the POST method answers from the status cache without waiting."""
+        status_cache.set_receipt_url(self.data["merchant_reference"], "a-cached-url")
+        response = self.client.post(self.url, self.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content.decode("utf-8")), {"receipt_url": "a-cached-url"})
+        self.mocks["get_basket_status"].assert_not_called()
+        self.mocks["get_notifier"].return_value.wait.assert_not_called()
+
+    def test_post_frozen_basket_notified_cached(self):
+        """Verify that the POST method answers from the status cache filled before the notification."""
+        def wait(*args):  # pylint: disable=unused-argument
+            """Fill the cache as the feedback view does before notifying."""
+            status_cache.set_receipt_url(self.data["merchant_reference"], "a-cached-url")
+            return True
+
+        self.mocks["get_basket_status"].return_value = self.frozen
+        self.mocks["get_notifier"].return_value.wait.side_effect = wait
+        response = self.client.post(self.url, self.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content.decode("utf-8")), {"receipt_url": "a-cached-url"})
+        self.assertEqual(self.mocks["get_basket_status"].call_count, 1)
+
+    def test_post_frozen_basket_timeout(self):
+        """Verify that the POST method returns 204 when the wait times out."""
+        self.mocks["get_basket_status"].return_value = self.frozen
+        self.mocks["get_notifier"].return_value.wait.return_value = False
+        response = self.client.post(self.url, self.data)
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(self.mocks["get_basket_status"].call_count, 1)
+
+
+class TestPayFortStatusViewQueries(BaseTests):  # pylint: disable=too-many-ancestors
+    """Test the narrow queries of PayFortStatusView."""
+    def setUp(self):
+        """Set up the test."""
+        super().setUp()
+        self.view = views.PayFortStatusView()
+        self.view.request = RequestFactory().post("/", {"merchant_reference": "1-2-0"})
+        self.view.request.site = self.site
+
+    def _set_merchant_reference(self, basket_id, site_id=None, owner_id=None):
+        """Set the merchant reference of the request to the given basket, of the user and the site by default."""
+        site_id = self.site.id if site_id is None else site_id
+        owner_id = self.user.id if owner_id is None else owner_id
+        self.view.request = RequestFactory().post("/", {"merchant_reference": f"{site_id}-{owner_id}-{basket_id}"})
+        self.view.request.site = self.site
+
+    def test_get_basket_status_frozen(self):
+        """Verify that get_basket_status reads the status of the basket in a single query."""
+        basket = utils.Basket.objects.create(owner=self.user, site=self.site, status=utils.Basket.FROZEN)
+        self._set_merchant_reference(basket.id)
+        with self.assertNumQueries(1):
+            basket_status = self.view.get_basket_status()
+        self.assertEqual(basket_status, {
+            "status": utils.Basket.FROZEN, "site_id": self.site.id, "order__number": None,
+        })
+
+    def test_get_basket_status_submitted(self):
+        """Verify that get_basket_status reads the order number along with the status in a single query."""
+        basket = factories.create_basket()
+        basket.site = self.site
+        basket.owner = self.user
+        basket.save()
+        order = factories.create_order(basket=basket, user=self.user)
+        basket.submit()
+        self._set_merchant_reference(basket.id)
+        with self.assertNumQueries(1):
+            basket_status = self.view.get_basket_status()
+        self.assertEqual(basket_status, {
+            "status": utils.Basket.SUBMITTED, "site_id": self.site.id, "order__number": order.number,
+        })
+
+    def test_order_deleted_evicts_cache(self):
+        """Verify that deleting an order evicts the cached receipt_url of its basket."""
+        basket = factories.create_basket()
+        basket.site = self.site
+        basket.owner = self.user
+        basket.save()
+        order = factories.create_order(basket=basket, user=self.user)
+        merchant_reference = f"{order.site_id}-{self.user.id}-{basket.id}"
+        status_cache.set_receipt_url(merchant_reference, "a-cached-url")
+        order.delete()
+        self.assertIsNone(status_cache.get_receipt_url(merchant_reference))
+
+    def test_get_basket_status_instrumented(self):
+        """Verify that get_basket_status reports its stage and its single query to the instrumentation sink."""
+        basket = utils.Basket.objects.create(owner=self.user, site=self.site, status=utils.Basket.FROZEN)
+        self._set_merchant_reference(basket.id)
+        with override_settings(PAYFORT_INSTRUMENTATION_SINK="ecommerce_payfort.instrumentation.InMemorySink"):
+            sink = instrumentation.get_sink()
+            self.view.get_basket_status()
+        self.assertEqual(sink.queries("status.basket_status"), [1])
+
+    def test_get_basket_status_not_found(self):
+        """Verify that get_basket_status returns None when the basket does not exist."""
+        self._set_merchant_reference(0)
+        self.assertIsNone(self.view.get_basket_status())
+
+    def test_get_basket_status_other_owner(self):
+        """Verify that get_basket_status returns None when the owner of the reference doesn't match."""
+        basket = utils.Basket.objects.create(owner=self.user, site=self.site, status=utils.Basket.FROZEN)
+        self._set_merchant_reference(basket.id, owner_id=UserFactory().id)
+        self.assertIsNone(self.view.get_basket_status())
+
+    def test_post_other_site(self):
+        """Verify that the order of a basket of another site is shown, as the callbacks place it for that basket."""
+        other_site = SiteConfigurationFactory(partner=self.site.siteconfiguration.partner).site
+        basket = factories.create_basket()
+        basket.site = self.site
+        basket.owner = self.user
+        basket.save()
+        order = factories.create_order(basket=basket, user=self.user)
+        basket.submit()
+        with patch("ecommerce_payfort.views.get_receipt_page_url", return_value="a-url-to-the-receipt") as mock_url:
+            with patch("ecommerce_payfort.utils.logger.warning") as mock_warning:
+                response = self.client.post(
+                    reverse("payfort:status"), {"merchant_reference": f"{other_site.id}-{self.user.id}-{basket.id}"},
+                )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content.decode("utf-8")), {"receipt_url": "a-url-to-the-receipt"})
+        self.assertEqual(mock_url.call_args[1]["site_configuration"], self.site.siteconfiguration)
+        self.assertEqual(mock_url.call_args[1]["order_number"], order.number)
+        mock_warning.assert_called_once_with(
+            "PayFort basket [%s] belongs to site [%s] instead of the site of the merchant reference [%s]",
+            basket.id, self.site.id, other_site.id,
+        )
+
+    def test_post_malformed_merchant_reference(self):
+        """Verify that a malformed merchant reference is answered with 404, without reaching the cache."""
+        with patch("ecommerce_payfort.views.status_cache.cache") as mock_cache:
+            response = self.client.post(reverse("payfort:status"), {"merchant_reference": "bad reference"})
+        self.assertEqual(response.status_code, 404)
+        mock_cache.get.assert_not_called()
+
+    def test_get_basket_status_no_site(self):
+        """Verify that get_basket_status accepts the basket without a site, whatever the site of the reference."""
+        basket = utils.Basket.objects.create(owner=self.user, status=utils.Basket.FROZEN)
+        self._set_merchant_reference(basket.id, site_id=self.site.id + 1000)
+        self.assertEqual(self.view.get_basket_status()["status"], utils.Basket.FROZEN)
+
+    def test_status_reference(self):
+        """Verify that the status cache is keyed by the merchant reference rebuilt from its parsed IDs."""
+        self.view.request = RequestFactory().post("/", {"merchant_reference": "01-2-003"})
+        self.assertEqual(self.view.get_status_reference(), "1-2-3")
+        for merchant_reference in ("bad reference with spaces", "1-2", ""):
+            self.view.request = RequestFactory().post("/", {"merchant_reference": merchant_reference})
+            self.assertIsNone(self.view.get_status_reference())
+            self.assertIsNone(self.view.get_cached_response())
+
+    def test_get_basket_status_bad_merchant_reference(self):
+        """Verify that get_basket_status returns None without querying when the merchant reference is invalid."""
+        self.view.request = RequestFactory().post("/", {"merchant_reference": "bad"})
+        with self.assertNumQueries(0):
+            self.assertIsNone(self.view.get_basket_status())
+
+    def test_get_site_configuration_of_request(self):
+        """Verify that get_site_configuration reuses the site configuration of the request."""
+        with self.assertNumQueries(0):
+            self.assertEqual(self.view.get_site_configuration(self.site.id), self.site.siteconfiguration)
+            self.assertEqual(self.view.get_site_configuration(None), self.site.siteconfiguration)
+
+    def test_get_site_configuration_of_other_site(self):
+        """Verify that get_site_configuration loads the site configuration of another site."""
+        other_site_configuration = SiteConfigurationFactory(partner=self.site.siteconfiguration.partner)
+        self.assertEqual(
+            self.view.get_site_configuration(other_site_configuration.site.id),
+            other_site_configuration,
+        )
 
 
 @ddt.ddt
@@ -483,6 +941,11 @@ class TestPayFortFeedbackView(MockPatcherMixin, BaseTests, unittest.TestCase):
         "log_error": ("ecommerce_payfort.views.PayFortFeedbackView.log_error", {}),
         "handle_payment": ("ecommerce_payfort.views.PayFortFeedbackView.handle_payment", {}),
         "create_order": ("ecommerce_payfort.views.PayFortFeedbackView.create_order", {}),
+        "get_notifier": ("ecommerce_payfort.orders.get_notifier", {}),
+        "get_receipt_page_url": ("ecommerce_payfort.orders.get_receipt_page_url", {
+            "return_value": "a-url-to-the-receipt",
+        }),
+        "get_order_queue": ("ecommerce_payfort.views.get_order_queue", {"return_value": None}),
         "basket": ("ecommerce_payfort.views.PayFortFeedbackView.basket", {
             "return_value": None,
             "new_callable": PropertyMock,
@@ -498,6 +961,7 @@ class TestPayFortFeedbackView(MockPatcherMixin, BaseTests, unittest.TestCase):
             "merchant_reference": "test-1",
             "response_code": "00",
         }
+        self.mocks["validate_response"].side_effect = parsed_response
 
     def test_post_successful_payment(self):
         """Verify that the POST method works."""
@@ -507,16 +971,23 @@ class TestPayFortFeedbackView(MockPatcherMixin, BaseTests, unittest.TestCase):
                 """Check if the object is a WSGIRequest."""
                 return isinstance(other, WSGIRequest)
 
-        basket = Mock()
+        basket = Mock(id=7)
         self.mocks["basket"].return_value = basket
         response = self.client.post(self.url, self.data)
         self.assertEqual(response.status_code, 200)
         self.mocks["save_response"].assert_called_once_with(self.data)
-        self.mocks["handle_payment"].assert_called_once_with(
-            {'status': '14', 'merchant_reference': 'test-1', 'response_code': '00'},
-            basket
-        )
+        self.mocks["handle_payment"].assert_called_once()
+        response, handled_basket = self.mocks["handle_payment"].call_args[0]
+        self.assertIsInstance(response, utils.PayFortResponse)
+        self.assertEqual(response.data, {'status': '14', 'merchant_reference': 'test-1', 'response_code': '00'})
+        self.assertEqual(handled_basket, basket)
         self.mocks["create_order"].assert_called_once_with(IsWSGIRequest(), basket)
+        self.mocks["get_notifier"].return_value.notify.assert_called_once_with(7)
+        self.assertEqual(
+            self.mocks["get_receipt_page_url"].call_args[1]["order_number"],
+            self.mocks["create_order"].return_value.number,
+        )
+        self.assertEqual(status_cache.get_receipt_url("test-1"), "a-url-to-the-receipt")
 
     def _verify_save_with_200_response(self, response):
         """Helper method to verify the save_response is called and a 200 is returned."""
@@ -566,12 +1037,120 @@ class TestPayFortFeedbackView(MockPatcherMixin, BaseTests, unittest.TestCase):
             "Response was recorded in entry no. (%d: %s). Exception: %s: %s",
             7, 18, "the-transaction-id", "Exception", "Test exception"
         )
+        self.mocks["get_notifier"].return_value.notify.assert_not_called()
+        self.assertIsNone(status_cache.get_receipt_url("test-1"))
+
+    def test_post_successful_payment_queued(self):
+        """Verify that the POST method enqueues the order placement, and marks the callback as seen."""
+        self.mocks["basket"].return_value = Mock(id=7)
+        self.mocks["get_order_queue"].return_value = Mock()
+        with patch("ecommerce_payfort.views.duplicates.mark_seen") as mock_mark_seen:
+            response = self.client.post(self.url, self.data)
+        self.assertEqual(response.status_code, 200)
+        self.mocks["save_response"].assert_called_once_with(self.data)
+        self.mocks["get_order_queue"].return_value.enqueue.assert_called_once_with(self.site.id, 7, self.data)
+        mock_mark_seen.assert_called_once_with(self.data)
+        self.mocks["handle_payment"].assert_not_called()
+        self.mocks["create_order"].assert_not_called()
+
+    def test_post_payment_locked(self):
+        """Verify that the POST method returns 200 right away when another callback is placing the order."""
+        self.mocks["basket"].return_value = Mock(id=7)
+        token = locks.acquire_lock("test-1")
+        response = self.client.post(self.url, self.data)
+        self._verify_save_with_200_response(response)
+        self.assertEqual(cache.get(locks.get_lock_key("test-1")), token)
+
+    def test_post_payment_submitted_while_waiting_for_lock(self):
+        """Verify that the POST method does not place the order when the basket was submitted before the lock."""
+        basket = Mock(id=7)
+
+        def refresh_from_db(**kwargs):  # pylint: disable=unused-argument
+            """Simulate the basket being submitted by another callback."""
+            basket.status = utils.Basket.SUBMITTED
+
+        basket.refresh_from_db.side_effect = refresh_from_db
+        self.mocks["basket"].return_value = basket
+        with patch("ecommerce_payfort.views.duplicates.mark_seen") as mock_mark_seen:
+            response = self.client.post(self.url, self.data)
+        self._verify_save_with_200_response(response)
+        basket.refresh_from_db.assert_called_once_with(fields=["status"])
+        mock_mark_seen.assert_called_once_with(self.data)
+
+    def test_post_payment_releases_lock(self):
+        """Verify that the POST method releases the lock once the order is placed."""
+        self.mocks["basket"].return_value = Mock(id=7)
+        response = self.client.post(self.url, self.data)
+        self.assertEqual(response.status_code, 200)
+        self.mocks["create_order"].assert_called_once()
+        self.assertIsNone(cache.get(locks.get_lock_key("test-1")))
+
+    def test_check_duplicate(self):
+        """Verify that the feedback view raises DuplicateResponse for a response that was already processed."""
+        view = views.PayFortFeedbackView()
+        data = {"fort_id": "1", "status": utils.SUCCESS_STATUS, "signature": "sig"}
+        view.check_duplicate(data)
+        duplicates.mark_seen(data)
+        with self.assertRaises(duplicates.DuplicateResponse):
+            view.check_duplicate(data)
+
+    def test_post_duplicate(self):
+        """Verify that the POST method acknowledges a duplicate without recording it or loading the basket."""
+        self.mocks["validate_response"].side_effect = duplicates.DuplicateResponse
+        response = self.client.post(self.url, self.data)
+        self.assertEqual(response.status_code, 200)
+        self.mocks["save_response"].assert_not_called()
+        self.mocks["basket"].assert_not_called()
+        self.mocks["handle_payment"].assert_not_called()
+
+    def test_post_marks_seen(self):
+        """Verify that the POST method remembers the responses it processed."""
+        self.mocks["basket"].return_value = Mock(id=7)
+        with patch("ecommerce_payfort.views.duplicates.mark_seen") as mock_mark_seen:
+            self.client.post(self.url, self.data)
+        mock_mark_seen.assert_called_once_with(self.data)
+
+    def test_post_failed_payment_marks_seen(self):
+        """Verify that the POST method remembers the failed payments it recorded."""
+        self.data["status"] = "99"
+        with patch("ecommerce_payfort.views.duplicates.mark_seen") as mock_mark_seen:
+            self.client.post(self.url, self.data)
+        mock_mark_seen.assert_called_once_with(self.data)
+
+    def test_post_not_marked_seen_on_failure(self):
+        """Verify that the POST method does not remember a response which order placement failed."""
+        self.mocks["basket"].return_value = Mock(id=7)
+        self.mocks["handle_payment"].side_effect = Exception("Test exception")
+        with patch("ecommerce_payfort.views.duplicates.mark_seen") as mock_mark_seen:
+            response = self.client.post(self.url, self.data)
+        self.assertEqual(response.status_code, 422)
+        mock_mark_seen.assert_not_called()
+
+    def test_post_not_marked_seen_when_locked(self):
+        """Verify that the POST method does not remember a response while another callback places the order."""
+        self.mocks["basket"].return_value = Mock(id=7)
+        locks.acquire_lock("test-1")
+        with patch("ecommerce_payfort.views.duplicates.mark_seen") as mock_mark_seen:
+            self.client.post(self.url, self.data)
+        mock_mark_seen.assert_not_called()
+
+    def test_post_instrumented(self):
+        """Verify that the stages of the feedback view are reported to the instrumentation sink."""
+        self.mocks["basket"].return_value = Mock(id=7)
+        with override_settings(PAYFORT_INSTRUMENTATION_SINK="ecommerce_payfort.instrumentation.InMemorySink"):
+            sink = instrumentation.get_sink()
+            self.client.post(self.url, self.data)
+        for stage_name in ("view.PayFortFeedbackView", "feedback.handle_payment", "feedback.create_order"):
+            self.assertEqual(len(sink.durations(stage_name)), 1)
+        self.assertEqual(sink.counters, {"lock.acquired": 1})
 
     def test_already_processed_payment(self):
         """Verify that the POST method returns 200 when the payment is already processed."""
-        self.mocks["basket"].return_value = Mock(status=views.Basket.SUBMITTED)
-        response = self.client.post(self.url, self.data)
+        self.mocks["basket"].return_value = Mock(status=utils.Basket.SUBMITTED)
+        with patch("ecommerce_payfort.views.duplicates.mark_seen") as mock_mark_seen:
+            response = self.client.post(self.url, self.data)
         self._verify_save_with_200_response(response)
+        mock_mark_seen.assert_called_once_with(self.data)
 
     def test_notification_view(self):
         """Verify that the notification PayFortNotificationView view works is derived from feedback view."""
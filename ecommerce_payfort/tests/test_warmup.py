@@ -0,0 +1,68 @@
+""" Tests for the warm-up of the PayFort hot-path state. """
+from unittest.mock import patch
+
+from django.apps import apps
+from django.test import override_settings
+from ecommerce.tests.factories import SiteConfigurationFactory
+from ecommerce.tests.testcases import TestCase
+
+from ecommerce_payfort import warmup
+from ecommerce_payfort.processors import processor_cache
+
+
+class WarmUpTests(TestCase):  # pylint: disable=too-many-ancestors
+    """ Tests for the warm-up. """
+    def setUp(self):
+        """ Set up the test with an empty processor cache. """
+        super().setUp()
+        processor_cache.clear()
+
+    def test_warm_up(self):
+        """ Verify that the templates, the routes and the processor of the site are warmed up. """
+        with patch("ecommerce_payfort.warmup.logger.info") as mock_info:
+            summary = warmup.warm_up()
+
+        self.assertEqual(summary["templates"], len(warmup.TEMPLATES))
+        self.assertEqual(summary["routes"], (len(warmup.ROUTES) + len(warmup.ROUTES_WITH_ARG)) * 2)
+        self.assertEqual(summary["processors"], 1)
+        self.assertGreaterEqual(summary["duration"], 0)
+        self.assertEqual(len(processor_cache), 1)
+        self.assertIn("PayFort warm-up took", mock_info.call_args[0][0])
+
+    def test_warm_up_skips_unconfigured_sites(self):
+        """ Verify that a site whose partner isn't configured for PayFort is skipped. """
+        other_site = SiteConfigurationFactory(partner__short_code="other").site
+        with patch("ecommerce_payfort.warmup.logger.info") as mock_info:
+            summary = warmup.warm_up()
+
+        self.assertEqual(summary["processors"], 1)
+        self.assertEqual(mock_info.call_args_list[0][0][1], other_site.domain)
+
+    def test_warm_up_failed(self):
+        """ Verify that a failed warm-up is logged and doesn't raise. """
+        with patch("ecommerce_payfort.warmup.warm_up_routes", side_effect=RuntimeError("no urls")):
+            with patch("ecommerce_payfort.warmup.logger.exception") as mock_exception:
+                summary = warmup.warm_up()
+
+        mock_exception.assert_called_once_with("PayFort warm-up failed!")
+        self.assertEqual(summary["templates"], len(warmup.TEMPLATES))
+        self.assertEqual(summary["routes"], 0)
+        self.assertEqual(summary["processors"], 0)
+
+    def test_warm_up_close_connections(self):
+        """ Verify that the database connections are closed only when asked. """
+        with patch("ecommerce_payfort.warmup.connections") as mock_connections:
+            warmup.warm_up()
+            mock_connections.close_all.assert_not_called()
+            warmup.warm_up(close_connections=True)
+            mock_connections.close_all.assert_called_once_with()
+
+    def test_ready(self):
+        """ Verify that the application warms up when ready, only when the PAYFORT_WARM_UP setting is set. """
+        app_config = apps.get_app_config("ecommerce_payfort")
+        with patch("ecommerce_payfort.warmup.warm_up") as mock_warm_up:
+            app_config.ready()
+            mock_warm_up.assert_not_called()
+            with override_settings(PAYFORT_WARM_UP=True):
+                app_config.ready()
+            mock_warm_up.assert_called_once_with(close_connections=True)
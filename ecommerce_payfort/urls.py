@@ -8,6 +8,7 @@ from .views import (
     PayFortPaymentRedirectView,
     PayFortRedirectionResponseView,
     PayFortStatusView,
+    PayFortStatusWaitView,
 )
 
 app_name = 'payfort'
@@ -17,6 +18,7 @@ urlpatterns = [
     re_path(r'^response/$', PayFortRedirectionResponseView.as_view(), name='response'),
     re_path(r'^feedback/$', PayFortFeedbackView.as_view(), name='feedback'),
     re_path(r'^status/$', PayFortStatusView.as_view(), name='status'),
+    re_path(r'^status/wait/$', PayFortStatusWaitView.as_view(), name='status-wait'),
 
     re_path(
         r'^handle_internal_error/(.+)/$',
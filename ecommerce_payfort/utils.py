@@ -1,83 +1,96 @@
-"""Utility functions for the Payfort payment gateway."""
+"""
+Utility functions for the Payfort payment gateway.
+
+The signing, verification, sanitizing and response parsing live in core.py, which doesn't depend on Django. They are
+re-exported here for the code that needs the basket helpers as well. The Oscar models are loaded on first use, so that
+importing this module doesn't need the application registry.
+"""
 from __future__ import annotations
 
-import hashlib
-import re
-from typing import Any
-
-from oscar.apps.payment.exceptions import GatewayError
-from oscar.core.loading import get_model
-
-Basket = get_model("basket", "Basket")
-
-MANDATORY_RESPONSE_FIELDS = [
-    "merchant_reference",
-    "command",
-    "merchant_identifier",
-    "amount",
-    "currency",
-    "response_code",
-    "signature",
-    "status",
-]
-MAX_ORDER_DESCRIPTION_LENGTH = 150
-SUCCESS_STATUS = "14"
-SUPPORTED_SHA_METHODS = {
-    "SHA-256": hashlib.sha256,
-    "SHA-512": hashlib.sha512,
-}
-VALID_CURRENCY = "SAR"
-VALID_PATTERNS = {
-    "order_description": r"[^A-Za-z0-9 '/\._\-#:$]",
-    "customer_name": r"[^A-Za-z _\\/\-\.']",
-}
-
-
-class PayFortException(GatewayError):
-    """PayFort exception."""
-
-
-class PayFortBadSignatureException(PayFortException):
-    """PayFort bad signature exception."""
-
-
-def sanitize_text(
-        text_to_sanitize: str, valid_pattern: str, max_length: int | None = None, replacement: str = "_"
-) -> str:
+import functools
+import logging
+from typing import TYPE_CHECKING, Any
+
+from django.db.models import prefetch_related_objects
+from oscar.core.loading import get_class, get_model
+
+from ecommerce_payfort.core import (  # pylint: disable=unused-import
+    AMOUNT_PATTERN,
+    MANDATORY_RESPONSE_FIELDS,
+    MAX_CUSTOMER_NAME_LENGTH,
+    MAX_ORDER_DESCRIPTION_LENGTH,
+    MERCHANT_REFERENCE_PATTERN,
+    SANITIZERS,
+    SIGNER_CACHE_SIZE,
+    SUCCESS_STATUS,
+    SUPPORTED_SHA_METHODS,
+    VALID_CURRENCY,
+    VALID_PATTERNS,
+    PayFortBadSignatureException,
+    PayFortException,
+    PayFortResponse,
+    Signer,
+    TextSanitizer,
+    format_merchant_reference,
+    get_recorded_response_data,
+    get_signature,
+    get_signer,
+    get_transaction_id,
+    parse_merchant_reference,
+    sanitize_text,
+    verify_param,
+    verify_response_format,
+    verify_signature,
+)
+
+if TYPE_CHECKING:  # pragma: no cover
+    from ecommerce.extensions.basket.models import Basket
+
+logger = logging.getLogger(__name__)
+
+CALLBACK_BASKET_LINE_PREFETCHES = (
+    "stockrecord__partner",
+    "product__product_class",
+    "product__course",
+    "product__parent__product_class",
+    "product__parent__course",
+)
+
+
+@functools.lru_cache(maxsize=None)
+def get_oscar_model(app_label: str, model_name: str) -> Any:
     """
-    Sanitize the text by replacing invalid characters with the replacement character.
+    Return the given Oscar model, loaded on first use.
 
-    @param text_to_sanitize: The text to sanitize
-    @param valid_pattern: The valid pattern to match the text against
-    @param max_length: The maximum length of the sanitized text
-    @param replacement: The replacement character for invalid characters
-    @return: The sanitized text
+    @param app_label: The label of the application of the model
+    @param model_name: The name of the model
+    @return: The model class
     """
-    if (valid_pattern or "") == "":
-        return ""
-
-    sanitized = re.sub(valid_pattern, replacement, text_to_sanitize)
-    if max_length is None or max_length <= 0:
-        return sanitized
+    return get_model(app_label, model_name)
 
-    if len(sanitized) > max_length and r'\.' in valid_pattern:
-        return sanitized[:max_length - 3] + "..."
-    return sanitized[:max_length]
 
-
-def verify_param(param: Any, param_name: str, required_type: Any):
+@functools.lru_cache(maxsize=None)
+def get_oscar_class(module_label: str, class_name: str) -> Any:
     """
-    Verify a parameter type
+    Return the given Oscar class, loaded on first use.
 
-    @param param: The parameter to verify
-    @param param_name: The name of the parameter to be used in the exception message
-    @param required_type: The required type of the parameter
+    @param module_label: The label of the module of the class, e.g. "order.utils"
+    @param class_name: The name of the class
+    @return: The class
     """
-    if param is None or not isinstance(param, required_type):
-        raise PayFortException(
-            f"verify_param failed: {param_name} is required and must be "
-            f"({required_type.__name__}), but got ({type(param).__name__})"
-        )
+    return get_class(module_label, class_name)
+
+
+def get_basket_model() -> type[Basket]:
+    """Return the Basket model."""
+    return get_oscar_model("basket", "Basket")
+
+
+def __getattr__(name: str) -> Any:
+    """Resolve the Basket model on first use, for the callers of utils.Basket."""
+    if name == "Basket":
+        return get_basket_model()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def get_amount(basket: Basket) -> int:
@@ -87,7 +100,7 @@ def get_amount(basket: Basket) -> int:
     @param basket: The basket
     @return: The amount
     """
-    verify_param(basket, "basket", Basket)
+    verify_param(basket, "basket", get_basket_model())
 
     return int(round(basket.total_incl_tax * 100, 0))
 
@@ -99,7 +112,7 @@ def get_currency(basket: Basket) -> str:
     @param basket: The basket
     @return: The currency
     """
-    verify_param(basket, "basket", Basket)
+    verify_param(basket, "basket", get_basket_model())
 
     for line in basket.all_lines():
         if line.price_currency and line.price_currency != VALID_CURRENCY:
@@ -115,7 +128,7 @@ def get_customer_email(basket: Basket) -> str:
     @param basket: The basket
     @return: The customer email
     """
-    verify_param(basket, "basket", Basket)
+    verify_param(basket, "basket", get_basket_model())
 
     return basket.owner.email
 
@@ -127,13 +140,9 @@ def get_customer_name(basket: Basket) -> str:
     @param basket: The basket
     @return: The customer name
     """
-    verify_param(basket, "basket", Basket)
+    verify_param(basket, "basket", get_basket_model())
 
-    return sanitize_text(
-        basket.owner.get_full_name() or "Name not set",
-        VALID_PATTERNS["customer_name"],
-        max_length=50,
-    )
+    return SANITIZERS["customer_name"](basket.owner.get_full_name() or "Name not set")
 
 
 def get_language(request: Any) -> str:
@@ -159,169 +168,162 @@ def get_merchant_reference(site_id: int, basket: Basket) -> str:
     @return: The merchant reference
     """
     verify_param(site_id, "site_id", int)
-    verify_param(basket, "basket", Basket)
+    verify_param(basket, "basket", get_basket_model())
 
-    return f"{site_id}-{basket.owner_id}-{basket.id}"
+    return format_merchant_reference(site_id, basket.owner_id, basket.id)
 
 
-def get_order_description(basket: Basket) -> str:
-    """
-    Return the order description for the given basket.
+def _get_course_id(product: Any) -> str | None:
+    """Return the course ID of the product."""
+    if product.course:
+        return product.course.id
+    if product.parent and product.parent.course:
+        return product.parent.course.id
+
+    return None
 
-    @param basket: The basket
-    @return: The order description
-    """
-    def _get_course_id(product: Any) -> str | None:
-        """Return the course ID."""
-        if product.course:
-            return product.course.id
-        if product.parent and product.parent.course:
-            return product.parent.course.id
 
+def _get_product_title(product: Any) -> str | None:
+    """Return the product title."""
+    result = (product.title or "").strip()
+    if result != "":
+        return result
+
+    if not product.parent:
         return None
 
-    def _get_product_title(product: Any) -> str | None:
-        """Return the product title."""
-        result = (product.title or "").strip()
-        if result != "":
-            return result
+    return (product.parent.title or "").strip()
 
-        if not product.parent:
-            return None
 
-        return (product.parent.title or "").strip()
+def _get_product_description(product: Any) -> str:
+    """Return the product description."""
+    result = _get_course_id(product)
+    if result is None:
+        result = _get_product_title(product)
 
-    def _get_product_description(product: Any) -> str:
-        """Return the product description."""
-        result = _get_course_id(product)
-        if result is None:
-            result = _get_product_title(product)
+    return result or "-"
 
-        return result or "-"
 
-    verify_param(basket, "basket", Basket)
+class _OrderDescriptionBuilder:
+    """
+    Build the order description line by line, and stop describing lines once it's long enough to be truncated.
+    """
+    separator = " // "
 
-    description = ""
-    max_index = len(basket.all_lines()) - 1
-    for index, line in enumerate(basket.all_lines()):
-        description += f"{line.quantity} X {_get_product_description(line.product).replace(';', '_') or '-'}"
-        if index < max_index:
-            description += " // "
+    def __init__(self):
+        """Initialize the builder."""
+        self.parts = []
+        self.length = 0
 
-    return sanitize_text(
-        description,
-        VALID_PATTERNS["order_description"],
-        max_length=MAX_ORDER_DESCRIPTION_LENGTH
-    )
+    def add(self, line: Any):
+        """
+        Add the description of the line, unless the description is already long enough to be truncated.
 
+        @param line: The basket line
+        """
+        if self.length > MAX_ORDER_DESCRIPTION_LENGTH:
+            return
 
-def get_signature(sha_phrase: str, sha_method: str, transaction_parameters: dict) -> str:
-    """
-    Return the signature for the given transaction parameters.
+        part = f"{line.quantity} X {_get_product_description(line.product).replace(';', '_') or '-'}"
+        self.length += len(part) + (len(self.separator) if self.parts else 0)
+        self.parts.append(part)
 
-    @param sha_phrase: The SHA phrase
-    @param sha_method: The SHA method
-    @param transaction_parameters: The transaction parameters
-    @return: The calculated signature
-    """
-    verify_param(sha_phrase, "sha_phrase", str)
-    verify_param(sha_method, "sha_method", str)
-    verify_param(transaction_parameters, "transaction_parameters", dict)
+    def build(self) -> str:
+        """Return the sanitized order description."""
+        return SANITIZERS["order_description"](self.separator.join(self.parts))
 
-    sha_method_fnc = SUPPORTED_SHA_METHODS.get(sha_method)
-    if sha_method_fnc is None:
-        raise PayFortException(f"Unsupported SHA method: {sha_method}")
 
-    sorted_keys = sorted(transaction_parameters, key=lambda arg: arg.lower())
-    sorted_dict = {key: transaction_parameters[key] for key in sorted_keys}
+def get_order_description(basket: Basket) -> str:
+    """
+    Return the order description for the given basket.
+
+    @param basket: The basket
+    @return: The order description
+    """
+    verify_param(basket, "basket", get_basket_model())
 
-    result_string = f"{sha_phrase}{''.join(f'{key}={value}' for key, value in sorted_dict.items())}{sha_phrase}"
+    builder = _OrderDescriptionBuilder()
+    for line in basket.all_lines():
+        builder.add(line)
 
-    return sha_method_fnc(result_string.encode()).hexdigest()
+    return builder.build()
 
 
-def get_transaction_id(response_data: dict) -> str:
+class BasketPaymentSnapshot:  # pylint: disable=too-few-public-methods
     """
-    Return the transaction ID from the response data.
+    Payment details of a basket, computed in a single traversal of its lines.
 
-    @param response_data: The response data
-    @return: The transaction ID
+    The products, their parents and courses are prefetched for all lines at once, and the owner is loaded once.
     """
-    verify_param(response_data, "response_data", dict)
-
-    return f"{response_data.get('eci') or 'none'}-{response_data.get('fort_id') or 'none'}"
-
-
-def verify_response_format(response_data):
-    """Verify the format of the response from PayFort."""
-    for field in MANDATORY_RESPONSE_FIELDS:
-        if field not in response_data:
-            raise PayFortException(f"Missing field in response: {field}")
-        if not isinstance(response_data[field], str):
-            raise PayFortException((
-                f"Invalid field type in response: {field}. "
-                f"Should be <str>, but got <{type(response_data[field]).__name__}>"
-            ))
-
-    try:
-        amount = int(response_data["amount"])
-        if amount < 0 or response_data["amount"] != str(amount):
-            raise ValueError
-    except ValueError as exc:
-        raise PayFortException(
-            f"Invalid amount in response (not a positive integer): {response_data['amount']}"
-        ) from exc
-
-    if response_data["currency"] != VALID_CURRENCY:
-        raise PayFortException(f"Invalid currency in response: {response_data['currency']}")
-
-    if response_data["command"] != "PURCHASE":
-        raise PayFortException(f"Invalid command in response: {response_data['command']}")
-
-    if re.fullmatch(r"\d+-\d+-\d+", response_data["merchant_reference"]) is None:
-        raise PayFortException(
-            f"Invalid merchant_reference in response: {response_data['merchant_reference']}"
-        )
+    def __init__(self, basket: Basket):
+        """
+        Initialize the snapshot.
 
-    if (
-            (response_data.get("eci") is None or response_data.get("fort_id") is None) and
-            response_data['status'] == SUCCESS_STATUS
-    ):
-        raise PayFortException(
-            f"Unexpected successful payment that lacks eci or fort_id: {response_data['merchant_reference']}"
-        )
+        @param basket: The basket
+        """
+        verify_param(basket, "basket", get_basket_model())
 
+        lines = list(basket.all_lines())
+        prefetch_related_objects(lines, "product__course", "product__parent__course")
 
-def verify_signature(sha_phrase: str, sha_method: str, data: dict):
+        builder = _OrderDescriptionBuilder()
+        for line in lines:
+            if line.price_currency and line.price_currency != VALID_CURRENCY:
+                raise PayFortException(f"Currency not supported: {line.price_currency}")
+            builder.add(line)
+
+        owner = basket.owner
+        self.amount = int(round(basket.total_incl_tax * 100, 0))
+        self.currency = VALID_CURRENCY
+        self.customer_email = owner.email
+        self.customer_name = SANITIZERS["customer_name"](owner.get_full_name() or "Name not set")
+        self.order_description = builder.build()
+
+
+def check_basket_site(basket_id: int, basket_site_id: int | None, site_id: int) -> None:
     """
-    Verify the data signature.
+    Log a warning when the basket doesn't belong to the site of its merchant reference.
 
-    @param sha_phrase: The SHA phrase
-    @param sha_method: The SHA method
-    @param data: The response data
+    The basket is used anyway, since the payment was made for it, e.g. when it has no site. The callbacks and the
+    payment status page share this policy, so that the learner is shown the order placed by the callback.
+
+    @param basket_id: The basket ID
+    @param basket_site_id: The site ID of the basket, None if the basket has no site
+    @param site_id: The site ID of the merchant reference
     """
-    verify_param(data, "response_data", dict)
-
-    sha_method_fnc = SUPPORTED_SHA_METHODS.get(sha_method)
-    if sha_method_fnc is None:
-        raise PayFortException(f"Unsupported SHA method: {sha_method}")
-
-    data = data.copy()
-    signature = data.pop("signature", None)
-    if signature is None:
-        raise PayFortBadSignatureException("Signature not found!")
-
-    expected_signature = get_signature(
-        sha_phrase,
-        sha_method,
-        data,
-    )
-    if signature != expected_signature:
-        raise PayFortBadSignatureException(
-            f"Response signature mismatch. merchant_reference: {data.get('merchant_reference', 'none')}"
+    if basket_site_id != site_id:
+        logger.warning(
+            "PayFort basket [%s] belongs to site [%s] instead of the site of the merchant reference [%s]",
+            basket_id, basket_site_id, site_id,
         )
 
 
+def load_callback_basket(site_id: int, owner_id: int, basket_id: int) -> Basket | None:
+    """
+    Load the basket of a PayFort callback, along with everything the callback reads from it.
+
+    The basket must match the owner and the basket IDs of the merchant reference. A basket of another site, or without
+    a site, is still loaded, but the mismatch is logged by check_basket_site. Its owner, site and site
+    configuration are joined in the same query. Its lines are loaded once into the cache served by basket.all_lines(),
+    with their products, stock records, partners, product classes and courses, so that applying the offers and placing
+    the order don't load them line by line.
+
+    @param site_id: The site ID of the merchant reference
+    @param owner_id: The owner ID of the merchant reference
+    @param basket_id: The basket ID of the merchant reference
+    @return: The basket, or None if no basket of the owner matches the merchant reference
+    """
+    basket = get_basket_model().objects.select_related("owner", "site__siteconfiguration").filter(
+        id=basket_id, owner_id=owner_id,
+    ).first()
+    if basket is None:
+        return None
+
+    check_basket_site(basket_id, basket.site_id, site_id)
+    prefetch_related_objects(list(basket.all_lines()), *CALLBACK_BASKET_LINE_PREFETCHES)
+    return basket
+
+
 def get_ip_address(request: Any) -> str:
     """
     Return the customer IP address from the request.
@@ -1,37 +1,45 @@
 """Views related to the PayFort payment processor."""
 import logging
 
+from django.conf import settings
 from django.contrib.auth.mixins import LoginRequiredMixin
-from django.core.exceptions import ObjectDoesNotExist
 from django.db.transaction import atomic, non_atomic_requests
 from django.http import Http404, HttpResponse, JsonResponse
 from django.shortcuts import redirect, render
-from django.urls import reverse
 from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_exempt
 from django.views.generic import TemplateView, View
 from ecommerce.extensions.checkout.mixins import EdxOrderPlacementMixin
 from ecommerce.extensions.checkout.utils import get_receipt_page_url
-from oscar.apps.partner import strategy
-from oscar.core.loading import get_class, get_model
 
-from ecommerce_payfort import utils
-from ecommerce_payfort.processors import PayFort
+from ecommerce_payfort import duplicates, instrumentation, routes, status_cache, utils
+from ecommerce_payfort.locks import payment_lock
+from ecommerce_payfort.models import PayFortTransaction
+from ecommerce_payfort.notifiers import get_notifier
+from ecommerce_payfort.orders import announce_order, get_order_queue, prepare_basket
+from ecommerce_payfort.processors import get_processor
 
 logger = logging.getLogger(__name__)
 
-Applicator = get_class("offer.applicator", "Applicator")
-Basket = get_model("basket", "Basket")
-OrderNumberGenerator = get_class("order.utils", "OrderNumberGenerator")
+LONG_POLL_SETTING = "PAYFORT_STATUS_LONG_POLL"
+
+
+def is_long_poll_enabled():
+    """Return True if the payment status page may hold its status requests until the order is created."""
+    return bool(getattr(settings, LONG_POLL_SETTING, False))
 
 
 class PayFortPaymentRedirectView(LoginRequiredMixin, TemplateView):
-    """Render the template which loads the PayFort payment form via JavaScript"""
+    """Render the minimal page that submits the signed payment form to the PayFort payment page of the site."""
     template_name = "payfort_payment/form.html"
 
     def post(self, request):
         """Handles the POST request."""
-        return render(request=request, template_name=self.template_name, context=request.POST.dict())
+        context = request.POST.dict()
+        context["gateway_url"] = get_processor(request.site).gateway_url
+        response = render(request=request, template_name=self.template_name, context=context)
+        response["Cache-Control"] = "no-store"
+        return response
 
 
 class PayFortCallBaseView(EdxOrderPlacementMixin, View):
@@ -40,6 +48,7 @@ class PayFortCallBaseView(EdxOrderPlacementMixin, View):
         """Initialize the PayFortCallBaseView."""
         super().__init__(*args, **kwargs)
         self.payment_processor = None
+        self.payfort_response = None
         self.request = None
         self._basket = None
 
@@ -47,7 +56,8 @@ class PayFortCallBaseView(EdxOrderPlacementMixin, View):
     @method_decorator(csrf_exempt)
     def dispatch(self, request, *args, **kwargs):
         """Dispatch the request to the appropriate handler."""
-        return super().dispatch(request, *args, **kwargs)
+        with instrumentation.stage(f"view.{self.__class__.__name__}"):
+            return super().dispatch(request, *args, **kwargs)
 
     @property
     def basket(self):
@@ -58,35 +68,52 @@ class PayFortCallBaseView(EdxOrderPlacementMixin, View):
         if not self.request:
             return None
 
-        merchant_reference = self.request.POST.get("merchant_reference", "")
-
-        try:
-            basket_id = int(merchant_reference.split('-')[-1])
-            basket = Basket.objects.get(id=basket_id)
-            basket.strategy = strategy.Default()
-            Applicator().apply(basket, basket.owner, self.request)
+        basket_reference = self.get_basket_reference()
+        if basket_reference is None:
+            return None
 
-            self._basket = basket
-        except (ValueError, ObjectDoesNotExist):
+        with instrumentation.stage("basket.load"):
+            basket = utils.load_callback_basket(*basket_reference)
+        if basket is None:
             return None
 
+        with instrumentation.stage("basket.apply_offers"):
+            self._basket = prepare_basket(basket, self.request)
+
         return self._basket
 
+    def get_basket_reference(self):
+        """
+        Return the site ID, the owner ID and the basket ID from the parsed response, or from the merchant reference of
+        the request.
+        """
+        if self.payfort_response is not None:
+            return self.payfort_response.site_id, self.payfort_response.owner_id, self.payfort_response.basket_id
+
+        return utils.parse_merchant_reference(self.request.POST.get("merchant_reference"))
+
     def log_error(self, message):
         """Log the error message."""
         logger.error("%s: %s", self.__class__.__name__, message)
 
     def save_payment_processor_response(self, response_data):
-        """Save the payment processor response to the database."""
+        """Save the payment processor response, and its PayFortTransaction, to the database in one transaction."""
         try:
-            return self.payment_processor.record_processor_response(
-                response={
-                    "view": self.__class__.__name__,
-                    "response": response_data
-                },
-                transaction_id=utils.get_transaction_id(response_data),
-                basket=self.basket
-            )
+            basket = self.basket
+            with instrumentation.stage("callback.record_processor_response"), atomic():
+                payment_processor_response = self.payment_processor.record_processor_response(
+                    response={
+                        "view": self.__class__.__name__,
+                        "response": response_data
+                    },
+                    transaction_id=(
+                        self.payfort_response.transaction_id if self.payfort_response is not None
+                        else utils.get_transaction_id(response_data)
+                    ),
+                    basket=basket
+                )
+                PayFortTransaction.record(payment_processor_response, response_data)
+            return payment_processor_response
         except Exception as exc:
             self.log_error(
                 f"Recording payment processor response failed! "
@@ -95,22 +122,29 @@ class PayFortCallBaseView(EdxOrderPlacementMixin, View):
             )
             raise Http404 from exc
 
+    def check_duplicate(self, response_data):
+        """
+        Check whether the verified response was already processed. Called right after verifying the signature.
+
+        @param response_data: The verified response data from PayFort
+        """
+
     def validate_response(self, response_data):
-        """Validate the response from PayFort."""
+        """Validate the response from PayFort and return the parsed response."""
         try:
-            utils.verify_signature(
-                self.payment_processor.response_sha_phrase,
-                self.payment_processor.sha_method,
-                response_data,
-            )
+            with instrumentation.stage("callback.verify_signature"):
+                self.payment_processor.response_signer.verify(response_data)
         except utils.PayFortBadSignatureException as exc:
             self.log_error(str(exc))
             raise
 
+        self.check_duplicate(response_data)
+
         success = response_data.get("status", "") == utils.SUCCESS_STATUS
 
         try:
-            utils.verify_response_format(response_data)
+            with instrumentation.stage("callback.verify_response_format"):
+                self.payfort_response = utils.verify_response_format(response_data)
         except utils.PayFortException as exc:
             self.log_error(str(exc))
             if success and self.basket:
@@ -127,6 +161,8 @@ class PayFortCallBaseView(EdxOrderPlacementMixin, View):
             )
             raise Http404()
 
+        return self.payfort_response
+
 
 class PayFortRedirectionResponseView(PayFortCallBaseView):
     """Handle the response from PayFort sent to customer after processing the payment."""
@@ -137,77 +173,181 @@ class PayFortRedirectionResponseView(PayFortCallBaseView):
     def post(self, request):
         """Handle the POST request from PayFort after processing the payment."""
         data = request.POST.dict()
-        self.payment_processor = PayFort(request.site)
+        self.payment_processor = get_processor(request.site)
         self.request = request
 
         try:
-            self.validate_response(data)
+            response = self.validate_response(data)
         except utils.PayFortBadSignatureException as exc:
             raise Http404 from exc
         except utils.PayFortException:
             self.save_payment_processor_response(data)
-            return redirect(reverse(
+            return redirect(routes.reverse_with_arg(
                 'payfort:handle-internal-error',
-                args=[utils.get_transaction_id(data)]
+                utils.get_transaction_id(data)
             ))
         except Http404:
             self.save_payment_processor_response(data)
             raise
 
         payment_processor_response = self.save_payment_processor_response(data)
-        if data["status"] == utils.SUCCESS_STATUS:
+        if response.success:
             data["ecommerce_transaction_id"] = payment_processor_response.transaction_id
-            data["ecommerce_error_url"] = reverse(
+            data["ecommerce_error_url"] = routes.reverse_with_arg(
                 'payfort:handle-internal-error',
-                args=[payment_processor_response.transaction_id]
+                payment_processor_response.transaction_id
+            )
+            data["ecommerce_status_url"] = routes.reverse("payfort:status")
+            data["ecommerce_status_wait_url"] = (
+                routes.reverse("payfort:status-wait") if is_long_poll_enabled() else ""
             )
-            data["ecommerce_status_url"] = reverse("payfort:status")
             data["ecommerce_max_attempts"] = self.MAX_ATTEMPTS
             data["ecommerce_wait_time"] = self.WAIT_TIME
             return render(request=request, template_name=self.template_name, context=data)
 
         self.log_error(
-            f"Payfort payment failed! merchant_reference: {data['merchant_reference']}. "
-            f"response_code: {data['response_code']}"
+            f"Payfort payment failed! merchant_reference: {response.merchant_reference}. "
+            f"response_code: {response.response_code}"
         )
-        return redirect(reverse("payment_error"))
+        return redirect(routes.reverse("payment_error"))
 
 
 class PayFortStatusView(PayFortCallBaseView):
     """Handle the status request from PayFort."""
-    def post(self, request):
-        """Handle the POST request from PayFort."""
-        if not self.basket:
+    def get_status_reference(self):
+        """
+        Return the merchant reference of the request rebuilt from its parsed IDs, or None if it's malformed.
+
+        The rebuilt reference is the key of the status cache, so a malformed value never reaches the cache.
+        """
+        basket_reference = self.get_basket_reference()
+        if basket_reference is None:
+            return None
+
+        return utils.format_merchant_reference(*basket_reference)
+
+    def get_basket_status(self):
+        """
+        Return the status, the site ID and the order number of the basket in a single narrow query.
+
+        The basket must match the owner of the merchant reference. A basket of another site, or without a site, is
+        answered like the callbacks load it, see utils.check_basket_site. The basket itself is not loaded, and no
+        offers are applied to it.
+        """
+        basket_reference = self.get_basket_reference()
+        if basket_reference is None:
+            return None
+
+        site_id, owner_id, basket_id = basket_reference
+        with instrumentation.stage("status.basket_status"):
+            basket_status = utils.Basket.objects.filter(id=basket_id, owner_id=owner_id).values(
+                "status", "site_id", "order__number",
+            ).first()
+
+        if basket_status is None:
+            return None
+
+        utils.check_basket_site(basket_id, basket_status["site_id"], site_id)
+        return basket_status
+
+    def get_site_configuration(self, site_id):
+        """Return the site configuration of the given site, reusing the one of the request when possible."""
+        if site_id is None or site_id == self.request.site.id:
+            return self.request.site.siteconfiguration
+
+        return utils.get_oscar_model("core", "SiteConfiguration").objects.get(site_id=site_id)
+
+    def get_status_response(self, basket_status):
+        """Return the response matching the given basket status."""
+        if not basket_status:
             return HttpResponse(status=404)
 
-        if self.basket.status == Basket.FROZEN:
+        if basket_status["status"] == utils.Basket.FROZEN:
             return HttpResponse(status=204)
 
-        if self.basket.status == Basket.SUBMITTED:
-            return JsonResponse(
-                {
-                    "receipt_url": get_receipt_page_url(
-                        request=request,
-                        site_configuration=self.basket.site.siteconfiguration,
-                        order_number=self.basket.order_number,
-                    ),
-                },
-                status=200,
-            )
+        if basket_status["status"] == utils.Basket.SUBMITTED:
+            with instrumentation.stage("status.receipt_url"):
+                receipt_url = get_receipt_page_url(
+                    request=self.request,
+                    site_configuration=self.get_site_configuration(basket_status["site_id"]),
+                    order_number=basket_status["order__number"],
+                )
+            merchant_reference = self.get_status_reference()
+            if merchant_reference is not None:
+                status_cache.set_receipt_url(merchant_reference, receipt_url)
+            return JsonResponse({"receipt_url": receipt_url}, status=200)
 
         return HttpResponse(status=404)
 
+    def get_cached_response(self):
+        """Return the response of a submitted basket from the status cache, or None if it's not cached."""
+        receipt_url = status_cache.get_receipt_url(self.get_status_reference())
+        if receipt_url is None:
+            return None
+
+        return JsonResponse({"receipt_url": receipt_url}, status=200)
+
+    def post(self, request):
+        """Handle the POST request from PayFort."""
+        response = self.get_cached_response()
+        if response is not None:
+            return response
+
+        return self.get_status_response(self.get_basket_status())
+
+
+class PayFortStatusWaitView(PayFortStatusView):
+    """
+    Long-poll variant of the status view.
+
+    The request is held until the feedback handler signals that the basket is submitted, or until WAIT_TIMEOUT
+    seconds have passed. A frozen basket is then answered with 204, and the browser may send a new request.
+
+    Each waiting request holds a worker, so the long-poll is only enabled by the PAYFORT_STATUS_LONG_POLL setting.
+    Otherwise, this view answers right away, like PayFortStatusView.
+    """
+    WAIT_TIMEOUT = 5
+
+    def post(self, request):
+        """Handle the POST request from PayFort."""
+        if not is_long_poll_enabled():
+            return super().post(request)
+
+        response = self.get_cached_response()
+        if response is not None:
+            return response
+
+        basket_status = self.get_basket_status()
+        if basket_status and basket_status["status"] == utils.Basket.FROZEN:
+            with instrumentation.stage("status.wait"):
+                notified = get_notifier().wait(self.get_basket_reference()[2], self.WAIT_TIMEOUT)
+            if notified:
+                response = self.get_cached_response()
+                if response is not None:
+                    return response
+
+                basket_status = self.get_basket_status()
+
+        return self.get_status_response(basket_status)
+
 
 class PayFortFeedbackView(PayFortCallBaseView):
     """Handle the response from PayFort sent to customer after processing the payment."""
+    def check_duplicate(self, response_data):
+        """Raise DuplicateResponse when the verified response was already processed."""
+        if duplicates.is_seen(response_data):
+            raise duplicates.DuplicateResponse()
+
     def post(self, request):
         """Handle the POST request from PayFort after processing the payment."""
         data = request.POST.dict()
-        self.payment_processor = PayFort(request.site)
+        self.payment_processor = get_processor(request.site)
         self.request = request
 
         try:
-            self.validate_response(data)
+            response = self.validate_response(data)
+        except duplicates.DuplicateResponse:
+            return HttpResponse(status=200)
         except utils.PayFortBadSignatureException as exc:
             raise Http404 from exc
         except (Http404, utils.PayFortException) as exc:
@@ -215,20 +355,49 @@ class PayFortFeedbackView(PayFortCallBaseView):
             raise Http404 from exc
 
         payment_processor_response = self.save_payment_processor_response(data)
-        if data["status"] != utils.SUCCESS_STATUS:
+        if not response.success:
             self.log_error(
-                f"Payfort payment failed! merchant_reference: {data['merchant_reference']}. "
-                f"response_code: {data['response_code']}"
+                f"Payfort payment failed! merchant_reference: {response.merchant_reference}. "
+                f"response_code: {response.response_code}"
             )
+            duplicates.mark_seen(data)
+            return HttpResponse(status=200)
+
+        if self.basket.status == utils.Basket.SUBMITTED:
+            duplicates.mark_seen(data)
             return HttpResponse(status=200)
 
-        if self.basket.status == Basket.SUBMITTED:
+        order_queue = get_order_queue()
+        if order_queue is not None:
+            order_queue.enqueue(request.site.id, self.basket.id, data)
+            duplicates.mark_seen(data)
             return HttpResponse(status=200)
 
+        with payment_lock(response.merchant_reference) as acquired:
+            if not acquired:
+                return HttpResponse(status=200)
+
+            self.basket.refresh_from_db(fields=["status"])
+            if self.basket.status == utils.Basket.SUBMITTED:
+                duplicates.mark_seen(data)
+                return HttpResponse(status=200)
+
+            return self.place_order(response, payment_processor_response)
+
+    def place_order(self, response, payment_processor_response):
+        """
+        Handle the payment and create the order of the basket.
+
+        @param response: The parsed response from PayFort
+        @param payment_processor_response: The recorded payment processor response
+        @return: The HTTP response to PayFort
+        """
         try:
             with atomic():
-                self.handle_payment(data, self.basket)
-                self.create_order(request, self.basket)
+                with instrumentation.stage("feedback.handle_payment"):
+                    self.handle_payment(response, self.basket)
+                with instrumentation.stage("feedback.create_order"):
+                    order = self.create_order(self.request, self.basket)
         except Exception as exc:  # pylint:disable=broad-except
             logger.exception(
                 "Processing payment for basket [%d] failed! "
@@ -243,6 +412,8 @@ class PayFortFeedbackView(PayFortCallBaseView):
             )
             return HttpResponse(status=422)
 
+        announce_order(self.request, self.basket, response.merchant_reference, order)
+        duplicates.mark_seen(response.data)
         return HttpResponse(status=200)
 
 
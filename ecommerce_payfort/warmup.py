@@ -0,0 +1,120 @@
+"""
+Warm-up of the state used by the PayFort checkout and callbacks.
+
+The first callback handled by a worker process otherwise pays for loading the templates, resolving the URLs of the
+routes, and creating the processor of the site with its signers. Enable the PAYFORT_WARM_UP setting to warm them up
+when the application is ready, or call warm_up() from a post-fork hook of the application server, e.g. gunicorn's
+post_worker_init.
+"""
+import logging
+import time
+
+from django.contrib.sites.models import Site
+from django.db import connections
+from django.template.loader import get_template
+from django.utils import translation
+
+from ecommerce_payfort import instrumentation, routes, utils
+from ecommerce_payfort.processors import get_processor
+
+logger = logging.getLogger(__name__)
+
+WARM_UP_SETTING = "PAYFORT_WARM_UP"
+
+LANGUAGES = ("en", "ar")
+TEMPLATES = (
+    "payfort_payment/form.html",
+    "payfort_payment/wait_feedback.html",
+    "payfort_payment/handle_internal_error.html",
+    "payfort_payment/handle_format_error.html",
+)
+ROUTES = (
+    "payfort:form",
+    "payfort:response",
+    "payfort:status",
+    "payfort:status-wait",
+    "payment_error",
+)
+ROUTES_WITH_ARG = (
+    "payfort:handle-internal-error",
+    "payfort:handle-format-error",
+)
+
+
+def warm_up_templates():
+    """
+    Load and compile the templates of the PayFort views, so that the cached template loader keeps them.
+
+    @return: The number of loaded templates
+    """
+    for template_name in TEMPLATES:
+        get_template(template_name)
+    return len(TEMPLATES)
+
+
+def warm_up_routes():
+    """
+    Resolve and cache the URLs of the PayFort routes in every supported language.
+
+    @return: The number of resolved routes
+    """
+    for language in LANGUAGES:
+        with translation.override(language):
+            for route_name in ROUTES:
+                routes.reverse(route_name)
+            for route_name in ROUTES_WITH_ARG:
+                routes.reverse_with_arg(route_name, "none")
+    return (len(ROUTES) + len(ROUTES_WITH_ARG)) * len(LANGUAGES)
+
+
+def warm_up_processors():
+    """
+    Create the processor of every site configured for PayFort, along with its signers and return URL.
+
+    A site whose partner isn't configured for PayFort is skipped.
+
+    @return: The number of warmed up processors
+    """
+    count = 0
+    for site in Site.objects.filter(siteconfiguration__isnull=False).select_related("siteconfiguration__partner"):
+        try:
+            processor = get_processor(site)
+            processor.request_signer  # pylint: disable=pointless-statement
+            processor.response_signer  # pylint: disable=pointless-statement
+            processor.return_url  # pylint: disable=pointless-statement
+        except Exception as exc:  # pylint: disable=broad-except
+            logger.info("PayFort warm-up skipped the site [%s]: %s", site.domain, exc)
+        else:
+            count += 1
+    return count
+
+
+def warm_up(close_connections=False):
+    """
+    Warm up the templates, the routes and the processors of the configured sites, and log how long it took.
+
+    The warm-up never fails: an error is logged, and the state is then loaded by the first requests as usual.
+
+    @param close_connections: Whether to close the database connections once done, e.g. before the process forks
+    @return: The summary of the warm-up
+    """
+    start = time.perf_counter()
+    summary = {"templates": 0, "routes": 0, "processors": 0}
+    try:
+        with instrumentation.stage("warm_up"):
+            utils.get_basket_model()
+            summary["templates"] = warm_up_templates()
+            summary["routes"] = warm_up_routes()
+            summary["processors"] = warm_up_processors()
+    except Exception:  # pylint: disable=broad-except
+        logger.exception("PayFort warm-up failed!")
+    finally:
+        if close_connections:
+            connections.close_all()
+
+    summary["duration"] = round(time.perf_counter() - start, 3)
+    logger.info(
+        "PayFort warm-up took %.3f s: %d templates, %d routes and %d processors",
+        summary["duration"], summary["templates"], summary["routes"], summary["processors"],
+    )
+    return summary